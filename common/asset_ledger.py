@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+
+#The purpose of this code is to skip assets that have not changed since they were last ingested
+#The content hash of an asset covers the data it is made from (arrays or source files) and its metadata
+#   (e.g. the upload manifest and encoding settings), so it is known before the geotiff is encoded
+#A local SQLite ledger keeps the hash and metadata of each asset once its ingestion has completed,
+#   a rerun compares against it and only encodes, stages, and ingests the assets whose hash changed
+#The ledger is local: an asset deleted or changed in earth engine by hand is not noticed, use force to upload it again
+
+CHUNK_BYTES = 16*1024**2
+
+
+def _update_metadata(digest,metadata):
+    if metadata is not None:
+        digest.update(json.dumps(metadata,sort_keys=True,default=str).encode('utf-8'))
+
+def hash_arrays(arrays,metadata=None):
+    '''
+    Function to get the content hash of numpy arrays and metadata, returns a hex string
+    '''
+    if not isinstance(arrays,(list,tuple)):
+        arrays = [arrays]
+    digest = hashlib.sha256()
+    for array in arrays:
+        #Shape and type are part of the content, the same bytes read as another type are different data
+        digest.update('{dtype}{shape}'.format(dtype=array.dtype.str,shape=array.shape).encode('utf-8'))
+        digest.update(np.ascontiguousarray(array).data)
+    _update_metadata(digest,metadata)
+    return digest.hexdigest()
+
+def hash_files(filenames,metadata=None):
+    '''
+    Function to get the content hash of files (in the order given) and metadata, returns a hex string
+    '''
+    if isinstance(filenames,str):
+        filenames = [filenames]
+    digest = hashlib.sha256()
+    for filename in filenames:
+        digest.update('{size}'.format(size=os.path.getsize(filename)).encode('utf-8'))
+        with open(filename,'rb') as src:
+            for chunk in iter(lambda: src.read(CHUNK_BYTES),b''):
+                digest.update(chunk)
+    _update_metadata(digest,metadata)
+    return digest.hexdigest()
+
+
+class AssetLedger(object):
+    '''
+    Content hash and metadata of each ingested asset, kept in a local SQLite file
+    Records can be written from the task tracker thread, so every call takes a lock
+    If force is set to true, no asset is current and every asset is uploaded again (and recorded)
+    '''
+    def __init__(self,filename,force=False):
+        folder = os.path.dirname(filename)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.force = force
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(filename,check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS assets (
+            asset_id TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            metadata TEXT,
+            task_id TEXT,
+            ingested REAL)''')
+        self.conn.commit()
+
+    def get(self,asset_id):
+        '''
+        Returns the recorded {'content_hash', 'metadata', 'task_id', 'ingested'} of an asset, None if it is not recorded
+        '''
+        with self.lock:
+            row = self.conn.execute('SELECT content_hash, metadata, task_id, ingested FROM assets WHERE asset_id = ?',(asset_id,)).fetchone()
+        if row is None:
+            return None
+        return {'content_hash':row[0],'metadata':json.loads(row[1]) if row[1] else None,'task_id':row[2],'ingested':row[3]}
+
+    def is_current(self,asset_id,content_hash):
+        '''
+        Returns true if the asset was ingested with this content hash
+        '''
+        if self.force:
+            return False
+        recorded = self.get(asset_id)
+        return recorded is not None and recorded['content_hash'] == content_hash
+
+    def record(self,asset_id,content_hash,metadata=None,task_id=None):
+        '''
+        Records the content hash of an asset once its ingestion has completed
+        '''
+        with self.lock:
+            with self.conn:
+                self.conn.execute('INSERT OR REPLACE INTO assets VALUES (?,?,?,?,?)',
+                                  (asset_id,content_hash,json.dumps(metadata,sort_keys=True,default=str) if metadata is not None else None,task_id,time.time()))
+
+    def recorder(self,asset_id,content_hash,metadata=None):
+        '''
+        Returns a function that records the asset when called with its task id, to pass to TaskTracker.add,
+            None if there is no content hash
+        '''
+        if content_hash is None:
+            return None
+        return lambda task_id: self.record(asset_id,content_hash,metadata,task_id)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
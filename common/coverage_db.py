@@ -0,0 +1,218 @@
+import argparse
+import sqlite3
+import pandas as pd
+
+#The purpose of this code is to query coverage time series without opening one csv per year
+#Coverage scripts (luh_get_ecoregion_coverage.py, get_esa_lc_ecoregion_coverage.py) add their years to one SQLite database
+#   in long format, one row per dataset, ecoregion, class, and year
+#Rows are keyed by (dataset, OBJECTID, class, year) so the history of an ecoregion is one index range,
+#   and a second index on (dataset, year) gives the cross-section of a year
+#Sums over biomes, realms, and biome, realm pairs are found when years are added and kept in the rollups table,
+#   so their series are also one index range instead of a sum over every ecoregion of every year
+#
+#Usage:
+#   python common/coverage_db.py coverage.sqlite series luh_baseline --ecoregion 12 --classes Forest Cropland
+#   python common/coverage_db.py coverage.sqlite series esa_lc --biome "Tundra"
+#   python common/coverage_db.py --output realms_1700.csv coverage.sqlite year luh_baseline 1700 --level realm
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS datasets (dataset_id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS classes (class_id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL);
+CREATE TABLE IF NOT EXISTS zones (dataset_id INTEGER NOT NULL, OBJECTID INTEGER NOT NULL, ECO_NAME TEXT, BIOME_NAME TEXT, REALM TEXT,
+    PRIMARY KEY (dataset_id, OBJECTID));
+CREATE TABLE IF NOT EXISTS areas (dataset_id INTEGER NOT NULL, OBJECTID INTEGER NOT NULL, class_id INTEGER NOT NULL, year INTEGER NOT NULL, value REAL,
+    PRIMARY KEY (dataset_id, OBJECTID, class_id, year)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS areas_year ON areas (dataset_id, year);
+CREATE TABLE IF NOT EXISTS rollups (dataset_id INTEGER NOT NULL, level TEXT NOT NULL, BIOME_NAME TEXT NOT NULL, REALM TEXT NOT NULL,
+    class_id INTEGER NOT NULL, year INTEGER NOT NULL, value REAL,
+    PRIMARY KEY (dataset_id, level, BIOME_NAME, REALM, class_id, year)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS rollups_year ON rollups (dataset_id, level, year);
+'''
+#Levels above the ecoregions and the zones columns they are summed by, the unused column of a level is stored as ''
+ROLLUP_COLUMNS = {'biome':['BIOME_NAME'],'realm':['REALM'],'biome_realm':['BIOME_NAME','REALM']}
+LEVELS = ['ecoregion','biome','realm','biome_realm']
+
+
+def connect(filename):
+    '''
+    Function to open (and create if needed) a coverage database
+    '''
+    conn = sqlite3.connect(filename)
+    #Write ahead logging lets queries run while a coverage script is still adding years
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    #Up to about 256 MB of pages in memory, a year of rows lands all over the (OBJECTID, class, year) key
+    conn.execute('PRAGMA cache_size=-262144')
+    conn.executescript(SCHEMA)
+    return conn
+
+def _get_id(conn,table,id_column,name):
+    '''
+    Gets the id of a dataset or class name, adding it if it is new
+    '''
+    row = conn.execute('SELECT {id} FROM {table} WHERE name = ?'.format(id=id_column,table=table),(name,)).fetchone()
+    if row is not None:
+        return row[0]
+    return conn.execute('INSERT INTO {table} (name) VALUES (?)'.format(table=table),(name,)).lastrowid
+
+def _find_id(conn,table,id_column,name):
+    '''
+    Gets the id of a dataset or class name, raising a ValueError if it is not in the database
+    '''
+    row = conn.execute('SELECT {id} FROM {table} WHERE name = ?'.format(id=id_column,table=table),(name,)).fetchone()
+    if row is None:
+        raise ValueError('{name} is not in the {table} of the database'.format(name=name,table=table))
+    return row[0]
+
+def write_zones(conn,dataset,attributes):
+    '''
+    Function to save the ecoregion attributes (OBJECTID, ECO_NAME, BIOME_NAME, REALM) of a dataset
+    Zones are needed before years are added so the biome and realm sums can be found
+    '''
+    with conn:
+        dataset_id = _get_id(conn,'datasets','dataset_id',dataset)
+        rows = zip([dataset_id]*len(attributes),attributes['OBJECTID'].astype(int).tolist(),attributes['ECO_NAME'].astype(str).tolist(),
+                   attributes['BIOME_NAME'].astype(str).tolist(),attributes['REALM'].astype(str).tolist())
+        conn.executemany('INSERT OR REPLACE INTO zones VALUES (?,?,?,?,?)',rows)
+
+def write_years(conn,dataset,frames,class_columns):
+    '''
+    Function to save (or replace) years of a coverage table in one transaction
+    frames maps each year to a table with an OBJECTID column and one column per class
+    '''
+    class_columns = list(class_columns)
+    with conn:
+        dataset_id = _get_id(conn,'datasets','dataset_id',dataset)
+        class_ids = [_get_id(conn,'classes','class_id',class_name) for class_name in class_columns]
+        zones = pd.read_sql_query('SELECT OBJECTID, BIOME_NAME, REALM FROM zones WHERE dataset_id = ?',conn,params=(dataset_id,))
+        for year in sorted(frames):
+            df = frames[year][['OBJECTID']+class_columns].astype({'OBJECTID':int})
+            obj_ids = df['OBJECTID'].tolist()
+            for class_name, class_id in zip(class_columns,class_ids):
+                values = df[class_name].astype(float).tolist()
+                conn.executemany('INSERT OR REPLACE INTO areas VALUES (?,?,?,?,?)',
+                                 ((dataset_id,obj_id,class_id,int(year),value) for obj_id,value in zip(obj_ids,values)))
+            #Sums over the biomes, realms, and biome, realm pairs of the year
+            zone_df = df.merge(zones,on='OBJECTID')
+            for level, columns in ROLLUP_COLUMNS.items():
+                sums = zone_df.groupby(columns)[class_columns].sum().reset_index()
+                biomes = sums['BIOME_NAME'].tolist() if 'BIOME_NAME' in columns else ['']*len(sums)
+                realms = sums['REALM'].tolist() if 'REALM' in columns else ['']*len(sums)
+                for class_name, class_id in zip(class_columns,class_ids):
+                    values = sums[class_name].astype(float).tolist()
+                    conn.executemany('INSERT OR REPLACE INTO rollups VALUES (?,?,?,?,?,?,?)',
+                                     ((dataset_id,level,biome,realm,class_id,int(year),value) for biome,realm,value in zip(biomes,realms,values)))
+
+def write_year(conn,dataset,year,df,class_columns):
+    '''
+    Function to save (or replace) one year of a coverage table with an OBJECTID column and one column per class
+    '''
+    write_years(conn,dataset,{year:df},class_columns)
+
+def _class_filter(conn,classes):
+    '''
+    Builds the SQL condition and parameters that limit a query to some classes
+    '''
+    if classes is None:
+        return '', []
+    class_ids = [_find_id(conn,'classes','class_id',name) for name in classes]
+    return ' AND a.class_id IN ({marks})'.format(marks=','.join('?'*len(class_ids))), class_ids
+
+def _to_wide(conn,rows,index):
+    '''
+    Turns (index..., class, value) rows into a table with one column per class, classes in the order they were added
+    '''
+    index = [index] if isinstance(index,str) else list(index)
+    df = pd.DataFrame(rows,columns=index+['class','value'])
+    wide = df.pivot(index=index,columns='class',values='value')
+    order = [row[0] for row in conn.execute('SELECT name FROM classes ORDER BY class_id')]
+    wide = wide[[name for name in order if name in wide.columns]]
+    wide.columns.name = None
+    return wide
+
+def _get_level(biome,realm):
+    '''
+    Gets the rollup level of a biome and/or realm query
+    '''
+    if biome is not None and realm is not None:
+        return 'biome_realm'
+    if biome is not None:
+        return 'biome'
+    if realm is not None:
+        return 'realm'
+    raise ValueError('Give an ecoregion, biome, or realm')
+
+def get_series(conn,dataset,ecoregion=None,biome=None,realm=None,classes=None,start=None,end=None):
+    '''
+    Function to get the time series of one ecoregion (OBJECTID), or the sum over the ecoregions of a biome and/or realm
+    Returns a table indexed by year with one column per class
+    '''
+    dataset_id = _find_id(conn,'datasets','dataset_id',dataset)
+    if ecoregion is not None:
+        sql = 'SELECT a.year, c.name, a.value FROM areas a JOIN classes c ON c.class_id = a.class_id WHERE a.dataset_id = ? AND a.OBJECTID = ?'
+        params = [dataset_id,int(ecoregion)]
+    else:
+        sql = ('SELECT a.year, c.name, a.value FROM rollups a JOIN classes c ON c.class_id = a.class_id '
+               'WHERE a.dataset_id = ? AND a.level = ? AND a.BIOME_NAME = ? AND a.REALM = ?')
+        params = [dataset_id,_get_level(biome,realm),biome or '',realm or '']
+    class_sql, class_params = _class_filter(conn,classes)
+    sql = sql+class_sql
+    params = params+class_params
+    if start is not None:
+        sql = sql+' AND a.year >= ?'
+        params.append(int(start))
+    if end is not None:
+        sql = sql+' AND a.year <= ?'
+        params.append(int(end))
+    return _to_wide(conn,conn.execute(sql,params).fetchall(),'year')
+
+def get_year(conn,dataset,year,level='ecoregion',classes=None):
+    '''
+    Function to get the cross-section of one year for every ecoregion, biome, realm, or biome, realm pair
+    Returns a table indexed by OBJECTID, BIOME_NAME, REALM, or both with one column per class
+    '''
+    if level not in LEVELS:
+        raise ValueError('Unknown level: {level}'.format(level=level))
+    dataset_id = _find_id(conn,'datasets','dataset_id',dataset)
+    class_sql, class_params = _class_filter(conn,classes)
+    if level == 'ecoregion':
+        sql = ('SELECT a.OBJECTID, c.name, a.value FROM areas a INDEXED BY areas_year JOIN classes c ON c.class_id = a.class_id '
+               'WHERE a.dataset_id = ? AND a.year = ?'+class_sql)
+        return _to_wide(conn,conn.execute(sql,[dataset_id,int(year)]+class_params).fetchall(),'OBJECTID')
+    columns = ROLLUP_COLUMNS[level]
+    sql = ('SELECT {columns}, c.name, a.value FROM rollups a INDEXED BY rollups_year JOIN classes c ON c.class_id = a.class_id '
+           'WHERE a.dataset_id = ? AND a.level = ? AND a.year = ?{classes}').format(columns=', '.join('a.'+column for column in columns),classes=class_sql)
+    return _to_wide(conn,conn.execute(sql,[dataset_id,level,int(year)]+class_params).fetchall(),columns)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query coverage time series and year cross-sections')
+    parser.add_argument('database')
+    parser.add_argument('--output',help='csv file to save the result to instead of printing it')
+    subparsers = parser.add_subparsers(dest='command')
+    series_parser = subparsers.add_parser('series',help='time series of an ecoregion, biome, realm, or biome, realm pair')
+    series_parser.add_argument('dataset')
+    series_parser.add_argument('--ecoregion',type=int,help='OBJECTID of the ecoregion')
+    series_parser.add_argument('--biome')
+    series_parser.add_argument('--realm')
+    series_parser.add_argument('--classes',nargs='+')
+    series_parser.add_argument('--start',type=int)
+    series_parser.add_argument('--end',type=int)
+    year_parser = subparsers.add_parser('year',help='cross-section of one year')
+    year_parser.add_argument('dataset')
+    year_parser.add_argument('year',type=int)
+    year_parser.add_argument('--level',default='ecoregion',choices=LEVELS)
+    year_parser.add_argument('--classes',nargs='+')
+    args = parser.parse_args()
+
+    conn = connect(args.database)
+    if args.command == 'series':
+        result = get_series(conn,args.dataset,args.ecoregion,args.biome,args.realm,args.classes,args.start,args.end)
+    elif args.command == 'year':
+        result = get_year(conn,args.dataset,args.year,args.level,args.classes)
+    else:
+        parser.error('Choose series or year')
+    if args.output:
+        result.to_csv(args.output)
+    else:
+        print(result.to_string())
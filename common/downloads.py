@@ -0,0 +1,260 @@
+import fcntl
+import ftplib
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+#The purpose of this code is to download source files (e.g. the HYDE zips) once, a few at a time, into a local mirror
+#   that every script reads from
+#Files are stored by the sha256 of their content under objects/, and an index maps each url to its hash, so a rerun
+#   (or another script that uses the same file) does not download it again
+#A download goes to a partial file under partial/ first and picks up where it stopped (HTTP range requests, FTP REST),
+#   its size is checked against the size the server gives, zips are tested, and its hash is checked if one is given
+#A lock file next to the partial file keeps two processes from downloading the same url at the same time, it is not the
+#   partial file itself because that is moved into objects/ once it checks out
+#Urls can be ftp://, http:// or https://, so a local HTTP or FTP server can stand in for the real one when testing
+
+CHUNK_BYTES = 1024**2
+
+
+class ChecksumError(Exception):
+    '''
+    Raised when a downloaded file does not match its expected size, hash, or is not a valid zip
+    '''
+    pass
+
+
+def sha256_file(filename):
+    '''
+    Function to get the sha256 of a file, returns a hex string
+    '''
+    digest = hashlib.sha256()
+    with open(filename,'rb') as src:
+        for chunk in iter(lambda: src.read(CHUNK_BYTES),b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DownloadManager(object):
+    '''
+    Downloads urls into a content addressed mirror with at most max_workers transfers at once
+    Each url is tried max_retries times, waiting backoff_seconds (doubled after each attempt) in between
+    '''
+    def __init__(self,mirror_dir,max_workers=4,max_retries=5,backoff_seconds=5,timeout=600):
+        self.mirror_dir = mirror_dir
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.timeout = timeout
+        for folder in ['objects','partial']:
+            if not os.path.exists(os.path.join(mirror_dir,folder)):
+                os.makedirs(os.path.join(mirror_dir,folder))
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(mirror_dir,'index.sqlite'),timeout=60,check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS files (
+            url TEXT PRIMARY KEY,
+            sha256 TEXT NOT NULL,
+            size INTEGER,
+            fetched REAL)''')
+        self.conn.commit()
+        self.pool = ThreadPoolExecutor(max_workers)
+        #url: future of the downloads started in this process
+        self.futures = {}
+
+    def get_object(self,sha256):
+        '''
+        Returns the path in the mirror of a file with this hash
+        '''
+        return os.path.join(self.mirror_dir,'objects',sha256[:2],sha256)
+
+    def lookup(self,url,sha256=None):
+        '''
+        Returns the path in the mirror of a url that was downloaded before, None if it is not there (or not this hash)
+        '''
+        with self.lock:
+            row = self.conn.execute('SELECT sha256, size FROM files WHERE url = ?',(url,)).fetchone()
+        if row is None or (sha256 is not None and row[0] != sha256):
+            return None
+        path = self.get_object(row[0])
+        if not os.path.exists(path) or os.path.getsize(path) != row[1]:
+            return None
+        return path
+
+    def _get_partial(self,url):
+        return os.path.join(self.mirror_dir,'partial',hashlib.sha256(url.encode('utf-8')).hexdigest()+'.part')
+
+    def _get_lock(self,url):
+        return os.path.join(self.mirror_dir,'partial',hashlib.sha256(url.encode('utf-8')).hexdigest()+'.lock')
+
+    def _fetch_http(self,url,dst,offset):
+        '''
+        Appends the rest of an http(s) url to dst from offset, returns the size of the whole file (None if unknown)
+        '''
+        request = urllib.request.Request(url)
+        if offset > 0:
+            request.add_header('Range','bytes={offset}-'.format(offset=offset))
+        try:
+            response = urllib.request.urlopen(request,timeout=self.timeout)
+        except urllib.error.HTTPError as error:
+            if offset == 0 or error.code != 416:
+                raise
+            #Nothing is left after offset, the partial file is complete (or too long) if the server gives the size
+            content_range = error.headers.get('Content-Range')
+            if content_range is None or not content_range.startswith('bytes */'):
+                raise ChecksumError('{url} has no range from {offset} and no size'.format(url=url,offset=offset))
+            return int(content_range.rsplit('/',1)[1])
+        with response:
+            if offset > 0 and response.status != 206:
+                #The server sent the whole file
+                dst.seek(0)
+                dst.truncate()
+                offset = 0
+            content_range = response.headers.get('Content-Range')
+            content_length = response.headers.get('Content-Length')
+            if content_range is not None and '/' in content_range and not content_range.endswith('*'):
+                size = int(content_range.rsplit('/',1)[1])
+            elif content_length is not None:
+                size = offset+int(content_length)
+            else:
+                size = None
+            for chunk in iter(lambda: response.read(CHUNK_BYTES),b''):
+                dst.write(chunk)
+        return size
+
+    def _fetch_ftp(self,url,dst,offset):
+        '''
+        Appends the rest of an ftp url to dst from offset, returns the size of the whole file
+        '''
+        parsed = urllib.parse.urlparse(url)
+        ftp = ftplib.FTP()
+        ftp.connect(parsed.hostname,parsed.port or 21,timeout=self.timeout)
+        try:
+            ftp.login(urllib.parse.unquote(parsed.username or 'anonymous'),urllib.parse.unquote(parsed.password or ''))
+            ftp.voidcmd('TYPE I')
+            path = urllib.parse.unquote(parsed.path)
+            size = ftp.size(path)
+            if size is not None and offset > size:
+                dst.seek(0)
+                dst.truncate()
+                offset = 0
+            if size is None or offset < size:
+                ftp.retrbinary('RETR '+path,dst.write,CHUNK_BYTES,rest=offset if offset > 0 else None)
+        finally:
+            try:
+                ftp.quit()
+            except Exception:
+                ftp.close()
+        return size
+
+    def _fetch_other(self,url,dst,offset):
+        '''
+        Downloads urls of other schemes (e.g. file://) from the start, returns None for the size
+        '''
+        dst.seek(0)
+        dst.truncate()
+        with urllib.request.urlopen(url,timeout=self.timeout) as response:
+            for chunk in iter(lambda: response.read(CHUNK_BYTES),b''):
+                dst.write(chunk)
+        return None
+
+    def _verify(self,url,partial,size,sha256):
+        '''
+        Checks a downloaded file, returns its hash, raises ChecksumError if it does not match
+        '''
+        if size is not None and os.path.getsize(partial) < size:
+            #The connection was cut, the partial file is kept to pick up from
+            raise IOError('{url} stopped at {num} of {size} bytes'.format(url=url,num=os.path.getsize(partial),size=size))
+        if size is not None and os.path.getsize(partial) != size:
+            raise ChecksumError('{url} is {num} bytes, expected {size}'.format(url=url,num=os.path.getsize(partial),size=size))
+        if urllib.parse.urlparse(url).path.lower().endswith('.zip'):
+            try:
+                with zipfile.ZipFile(partial) as zip_file:
+                    bad_member = zip_file.testzip()
+            except zipfile.BadZipFile as error:
+                raise ChecksumError('{url} is not a valid zip: {error}'.format(url=url,error=error))
+            if bad_member is not None:
+                raise ChecksumError('{url} has a bad member: {member}'.format(url=url,member=bad_member))
+        file_hash = sha256_file(partial)
+        if sha256 is not None and file_hash != sha256:
+            raise ChecksumError('{url} has sha256 {file_hash}, expected {sha256}'.format(url=url,file_hash=file_hash,sha256=sha256))
+        return file_hash
+
+    def _download(self,url,sha256=None):
+        '''
+        Downloads a url into the mirror unless it is there already, returns its path in the mirror
+        '''
+        path = self.lookup(url,sha256)
+        if path is not None:
+            return path
+        partial = self._get_partial(url)
+        scheme = urllib.parse.urlparse(url).scheme
+        fetch = {'http':self._fetch_http,'https':self._fetch_http,'ftp':self._fetch_ftp}.get(scheme,self._fetch_other)
+        with open(self._get_lock(url),'a') as lock_file:
+            #Wait for another process downloading the same url, then use its file
+            fcntl.flock(lock_file,fcntl.LOCK_EX)
+            try:
+                path = self.lookup(url,sha256)
+                if path is not None:
+                    return path
+                with open(partial,'ab') as dst:
+                    for attempt in range(self.max_retries):
+                        try:
+                            dst.seek(0,os.SEEK_END)
+                            size = fetch(url,dst,dst.tell())
+                            dst.flush()
+                            file_hash = self._verify(url,partial,size,sha256)
+                            break
+                        except ChecksumError as error:
+                            #A partial file that does not check out is started over
+                            print('Download of {url} failed: {error}'.format(url=url,error=error))
+                            dst.seek(0)
+                            dst.truncate()
+                        except Exception as error:
+                            #Other errors keep the partial file to pick up from
+                            print('Download of {url} failed: {error}'.format(url=url,error=error))
+                        if attempt == self.max_retries-1:
+                            raise RuntimeError('Could not download {url} in {num} attempts'.format(url=url,num=self.max_retries))
+                        time.sleep(self.backoff_seconds*2**attempt)
+                path = self.get_object(file_hash)
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path),exist_ok=True)
+                os.replace(partial,path)
+                with self.lock:
+                    with self.conn:
+                        self.conn.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,?)',(url,file_hash,os.path.getsize(path),time.time()))
+                print('Downloaded {url}'.format(url=url))
+                return path
+            finally:
+                fcntl.flock(lock_file,fcntl.LOCK_UN)
+
+    def prefetch(self,urls):
+        '''
+        Starts downloading urls in the background, at most max_workers at once
+        '''
+        with self.lock:
+            for url in urls:
+                if url not in self.futures:
+                    self.futures[url] = self.pool.submit(self._download,url)
+
+    def fetch(self,url,sha256=None):
+        '''
+        Returns the path in the mirror of a url, waiting for its download (started now if it was not prefetched)
+        '''
+        with self.lock:
+            future = self.futures.get(url)
+            if future is None or sha256 is not None:
+                future = self.pool.submit(self._download,url,sha256)
+                self.futures[url] = future
+        return future.result()
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+        with self.lock:
+            self.conn.close()
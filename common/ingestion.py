@@ -0,0 +1,65 @@
+import datetime
+
+#The purpose of this code is to ingest staged geotiffs into earth engine with one upload manifest per asset
+#The year, no data value, start and end time, and band names go into the manifest so they are set when the asset is made,
+#   instead of with earthengine asset set calls once every task has finished
+#Manifests are sent through commands that keep one earth engine API client for the whole run (see upload_pipeline.py),
+#   and their tasks are followed by a TaskTracker (see task_tracker.py)
+
+#Assets named like users/... are legacy assets
+EE_ASSET_ROOT = 'projects/earthengine-legacy/assets/'
+EPOCH = datetime.datetime(1970,1,1)
+
+
+def _to_json(value):
+    '''
+    Turns numpy numbers into python numbers so a manifest can be sent as json
+    '''
+    if hasattr(value,'item'):
+        return value.item()
+    return value
+
+def get_timestamp(date):
+    '''
+    Function to format a datetime or ms since the epoch as a manifest timestamp
+    '''
+    if isinstance(date,datetime.datetime):
+        seconds = int((date-EPOCH).total_seconds())
+    else:
+        seconds = int(date)//1000
+    return {'seconds':seconds}
+
+def get_asset_name(asset_id):
+    '''
+    Function to get the full name of an asset (projects/...) from its id
+    Ids must be absolute (users/... or projects/...), relative ids were resolved against the user's root by the
+        earthengine command line tool but are not valid asset names for the API
+    '''
+    if asset_id.startswith('projects/'):
+        return asset_id
+    if asset_id.startswith('users/'):
+        return EE_ASSET_ROOT+asset_id
+    raise ValueError('Asset id {asset_id} is relative, it must start with users/ or projects/'.format(asset_id=asset_id))
+
+def get_image_manifest(asset_id,uris,bands=None,nodata=None,start_time=None,end_time=None,properties=None,pyramiding_policy=None):
+    '''
+    Function to build the upload manifest of an image asset from staged files
+    bands are the names of the bands in order, start_time and end_time are datetimes or ms since the epoch
+    '''
+    if isinstance(uris,str):
+        uris = [uris]
+    manifest = {'name':get_asset_name(asset_id),'tilesets':[{'id':'0','sources':[{'uris':[uri]} for uri in uris]}]}
+    if bands is not None:
+        manifest['bands'] = [{'id':band,'tileset_id':'0','tileset_band_index':band_index} for band_index,band in enumerate(bands)]
+    if nodata is not None:
+        manifest['missing_data'] = {'values':[float(nodata)]}
+    if pyramiding_policy is not None:
+        manifest['pyramiding_policy'] = pyramiding_policy.upper()
+    if start_time is not None:
+        manifest['start_time'] = get_timestamp(start_time)
+    if end_time is not None:
+        manifest['end_time'] = get_timestamp(end_time)
+    if properties:
+        manifest['properties'] = dict((key,_to_json(value)) for key,value in properties.items())
+    return manifest
+
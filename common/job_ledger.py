@@ -0,0 +1,195 @@
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+#The purpose of this code is to keep the progress of an upload run on disk so a run that dies can be started again
+#   and pick up where it stopped instead of losing its task ids
+#Each year (item) of a run moves through the stages downloaded, converted, staged, ingesting, and done, and the staged
+#   file, manifest, and task id are saved with it, so tasks that were ingesting are followed again after a restart
+#Runs are named (e.g. hyde_landuse_BC) and only touch their own rows, so several runs can share one ledger file,
+#   a run that is still going on this machine cannot be started twice
+
+STAGES = ('downloaded','converted','staged','ingesting','done')
+
+
+class RunInProgressError(RuntimeError):
+    '''
+    Raised when a run is started while a process on this machine is still running it
+    '''
+    pass
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid,0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobLedger(object):
+    '''
+    Stage of each item of one run, kept in a SQLite file that can be shared by runs
+    Stages only move forward (a task that completes before its start is saved stays done), use reset to start an item over
+    '''
+    def __init__(self,filename,run_id):
+        folder = os.path.dirname(filename)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.run_id = run_id
+        self.lock = threading.Lock()
+        #Wait for other runs writing to the file instead of failing
+        self.conn = sqlite3.connect(filename,timeout=60,check_same_thread=False,isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS runs (
+            run_id TEXT PRIMARY KEY,
+            host TEXT,
+            pid INTEGER,
+            started REAL)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+            run_id TEXT NOT NULL,
+            item TEXT NOT NULL,
+            stage TEXT NOT NULL,
+            asset_id TEXT,
+            content_hash TEXT,
+            staged TEXT,
+            manifest TEXT,
+            task_id TEXT,
+            updated REAL,
+            PRIMARY KEY (run_id, item))''')
+        self._claim()
+
+    def _claim(self):
+        '''
+        Marks the run as started by this process, raises RunInProgressError if a live process on this machine has it
+        '''
+        host = socket.gethostname()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('SELECT host, pid FROM runs WHERE run_id = ?',(self.run_id,)).fetchone()
+                if row is not None and row[0] == host and row[1] != os.getpid() and _pid_alive(row[1]):
+                    raise RunInProgressError('Run {run_id} is in progress in process {pid}'.format(run_id=self.run_id,pid=row[1]))
+                self.conn.execute('INSERT OR REPLACE INTO runs VALUES (?,?,?,?)',(self.run_id,host,os.getpid(),time.time()))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def get(self,item):
+        '''
+        Returns the job of an item as {'stage', 'asset_id', 'content_hash', 'staged', 'manifest', 'task_id'}, None if it has no stage
+        '''
+        with self.lock:
+            row = self.conn.execute('SELECT stage, asset_id, content_hash, staged, manifest, task_id FROM jobs WHERE run_id = ? AND item = ?',
+                                    (self.run_id,str(item))).fetchone()
+        if row is None:
+            return None
+        return {'stage':row[0],'asset_id':row[1],'content_hash':row[2],'staged':row[3],'manifest':json.loads(row[4]) if row[4] else None,'task_id':row[5]}
+
+    def get_jobs(self,stage):
+        '''
+        Returns item: job of the items of the run at a stage
+        '''
+        with self.lock:
+            rows = self.conn.execute('SELECT item FROM jobs WHERE run_id = ? AND stage = ?',(self.run_id,stage)).fetchall()
+        return dict((row[0],self.get(row[0])) for row in rows)
+
+    def reached(self,item,stage):
+        '''
+        Returns true if an item is at or past a stage
+        '''
+        job = self.get(item)
+        return job is not None and STAGES.index(job['stage']) >= STAGES.index(stage)
+
+    def set_stage(self,item,stage,asset_id=None,content_hash=None,staged=None,manifest=None,task_id=None,reset=False):
+        '''
+        Moves an item to a stage, fields that are not given keep their saved values
+        The stage is not moved back unless reset is set to true
+        '''
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute('SELECT stage FROM jobs WHERE run_id = ? AND item = ?',(self.run_id,str(item))).fetchone()
+                if row is None:
+                    self.conn.execute('INSERT INTO jobs (run_id, item, stage) VALUES (?,?,?)',(self.run_id,str(item),stage))
+                elif reset or STAGES.index(stage) > STAGES.index(row[0]):
+                    self.conn.execute('UPDATE jobs SET stage = ? WHERE run_id = ? AND item = ?',(stage,self.run_id,str(item)))
+                fields = {'asset_id':asset_id,'content_hash':content_hash,'staged':staged,
+                          'manifest':json.dumps(manifest,default=str) if manifest is not None else None,'task_id':task_id,'updated':time.time()}
+                for key, value in fields.items():
+                    if value is not None:
+                        self.conn.execute('UPDATE jobs SET {key} = ? WHERE run_id = ? AND item = ?'.format(key=key),(value,self.run_id,str(item)))
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+
+    def completer(self,item,on_complete=None):
+        '''
+        Returns a function for TaskTracker.add that calls on_complete (if given) with the task id and moves the item to done
+        '''
+        def complete(task_id):
+            if on_complete is not None:
+                on_complete(task_id)
+            self.set_stage(item,'done',task_id=task_id)
+        return complete
+
+    def failer(self,item):
+        '''
+        Returns a function for TaskTracker.add that moves an item that ran out of retries back to the first stage,
+            so the next run makes and stages it again
+        '''
+        def fail(task_id):
+            self.set_stage(item,STAGES[0],reset=True)
+        return fail
+
+    def ingest(self,item,tracker,staged,manifest,asset_id=None,content_hash=None,on_complete=None):
+        '''
+        Saves a staged item with its manifest, starts its ingestion with the tracker and saves the task id, returns the task id
+        '''
+        self.set_stage(item,'staged',asset_id,content_hash,staged,manifest)
+        task_id = tracker.add(staged,manifest,self.completer(item,on_complete),self.failer(item))
+        self.set_stage(item,'ingesting',task_id=task_id)
+        return task_id
+
+    def resume(self,tracker,get_on_complete=None):
+        '''
+        Follows the tasks of items that were ingesting when the run stopped and starts the ingestion of items that were
+            staged, get_on_complete(job) returns the on_complete function of an item (e.g. to record it in an AssetLedger)
+        Returns the items that were resumed
+        '''
+        resumed = []
+        for item, job in self.get_jobs('ingesting').items():
+            on_complete = get_on_complete(job) if get_on_complete is not None else None
+            tracker.resume(job['task_id'],job['staged'],job['manifest'],self.completer(item,on_complete),self.failer(item))
+            resumed.append(item)
+        for item, job in self.get_jobs('staged').items():
+            on_complete = get_on_complete(job) if get_on_complete is not None else None
+            self.ingest(item,tracker,job['staged'],job['manifest'],on_complete=on_complete)
+            resumed.append(item)
+        if resumed:
+            print('Resumed {num} jobs of {run_id}'.format(num=len(resumed),run_id=self.run_id))
+        return resumed
+
+    def close(self):
+        '''
+        Releases the run so it can be started again
+        If every item is done the run is complete and its jobs are removed, so the next run starts over
+            (and skips unchanged assets with an AssetLedger)
+        '''
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            num_left = self.conn.execute("SELECT COUNT(*) FROM jobs WHERE run_id = ? AND stage != 'done'",(self.run_id,)).fetchone()[0]
+            if num_left == 0:
+                self.conn.execute('DELETE FROM jobs WHERE run_id = ?',(self.run_id,))
+            else:
+                print('{num} jobs of {run_id} are not done, they are resumed when the run is started again'.format(num=num_left,run_id=self.run_id))
+            self.conn.execute('DELETE FROM runs WHERE run_id = ? AND pid = ?',(self.run_id,os.getpid()))
+            self.conn.execute('COMMIT')
+            self.conn.close()
@@ -0,0 +1,109 @@
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+#The purpose of this code is to roll zonal land cover tables up a hierarchy of levels (ecoregion -> biome, realm pair -> biome / realm -> global)
+#   for any dataset, ESA Land Cover pixel counts and Land-Use Harmonization areas use the same code
+#The input is a long format table with one row per zone, year, and class, which is turned into one dense array (zones,years,classes)
+#Each level is summed from its parent level with group indices found once from the parent's groups,
+#   so biomes and realms are summed from the biome, realm pairs rather than from every ecoregion again
+#Groups keep the order they first appear in, the same order drop_duplicates gives on the ecoregion table
+
+
+class RollupLevel(object):
+    '''
+    Totals of one level of the hierarchy
+    groups has one row per group with the columns of the level, values has shape (groups,years,classes) and totals (groups,years)
+    '''
+    def __init__(self,name,columns,groups,years,classes,values,totals):
+        self.name = name
+        self.columns = list(columns)
+        self.groups = groups
+        self.years = years
+        self.classes = classes
+        self.values = values
+        self.totals = totals
+
+    def get_percent(self,zero_total=0.0):
+        '''
+        Returns the values as a fraction of the total, zero_total where the total is 0
+        '''
+        totals = np.broadcast_to(self.totals[:,:,None],self.values.shape)
+        return np.divide(self.values,totals,out=np.full(self.values.shape,zero_total,dtype=np.float64),where=totals!=0)
+
+    def to_frame(self,percent=False,zero_total=0.0,year_column='Year',total_column='Total'):
+        '''
+        Returns one row per group and year with the group columns, year, one column per class, and the total
+        '''
+        values = self.get_percent(zero_total) if percent else self.values
+        num_groups, num_years, num_classes = values.shape
+        df = self.groups.iloc[np.repeat(np.arange(num_groups),num_years)].reset_index(drop=True)
+        df[year_column] = np.tile(self.years,num_groups)
+        flat = values.reshape(num_groups*num_years,num_classes)
+        for class_index, class_name in enumerate(self.classes):
+            df[class_name] = flat[:,class_index]
+        df[total_column] = self.totals.reshape(-1)
+        return df
+
+
+def _get_codes(df,columns):
+    '''
+    Gives each unique combination of columns a group index in order of first appearance
+    Returns the index of every row and the position of the first row of each group
+    '''
+    if len(columns) == 0:
+        return np.zeros(len(df),dtype=np.int64), np.zeros(min(len(df),1),dtype=np.int64)
+    codes = df.groupby(list(columns),sort=False,dropna=False,observed=True).ngroup().values
+    first = np.unique(codes,return_index=True)[1]
+    return codes, first
+
+def rollup(table,levels,value='area',total_class=None,zone_columns=None,year_column='year',class_column='class'):
+    '''
+    Function to sum a long format zonal table over a hierarchy of levels
+    levels is a list of (name, columns, parent name), the first level is the zones of the table and has no parent
+        e.g. [('ecoregion',['OBJECTID'],None),('biome_realm',['BIOME_NAME','REALM'],'ecoregion'),('biome',['BIOME_NAME'],'biome_realm')]
+    total_class is a class of the table holding the total of each zone (e.g. pixel counts that include no data),
+        if None the total is the sum of the classes
+    zone_columns are the columns kept for the first level, by default every column other than year, class, and value
+    Returns an OrderedDict of name: RollupLevel
+    '''
+    zone_name, zone_key, zone_parent = levels[0]
+    if zone_parent is not None:
+        raise ValueError('The first level {name} has to be the zones of the table'.format(name=zone_name))
+    if zone_columns is None:
+        zone_columns = [column for column in table.columns if column not in (year_column,class_column,value)]
+    zone_codes, zone_first = _get_codes(table,zone_key)
+    zones = table[list(zone_columns)].iloc[zone_first].reset_index(drop=True)
+    year_codes, years = pd.factorize(table[year_column],sort=True)
+    class_codes, classes = pd.factorize(table[class_column].astype(str),sort=False)
+    #Keep classes in the order of the table's categories when it has them
+    if isinstance(table[class_column].dtype,pd.CategoricalDtype):
+        order = [name for name in table[class_column].cat.categories if name in set(classes)]
+        lookup = dict((name,i) for i,name in enumerate(order))
+        class_codes = np.array([lookup[name] for name in classes])[class_codes]
+        classes = pd.Index(order)
+    classes = list(classes)
+    cube = np.zeros((len(zones),len(years),len(classes)))
+    np.add.at(cube,(zone_codes,year_codes,class_codes),table[value].values.astype(np.float64))
+    if total_class is not None:
+        total_index = classes.index(total_class)
+        totals = cube[:,:,total_index].copy()
+        cube = np.delete(cube,total_index,axis=2)
+        del classes[total_index]
+    else:
+        totals = cube.sum(axis=2)
+    years = np.asarray(years)
+
+    results = OrderedDict()
+    results[zone_name] = RollupLevel(zone_name,zone_key,zones,years,classes,cube,totals)
+    for name, columns, parent_name in levels[1:]:
+        parent = results[parent_name]
+        #Group index of each parent group, found once and used for the values and totals
+        codes, first = _get_codes(parent.groups,columns)
+        groups = parent.groups[list(columns)].iloc[first].reset_index(drop=True)
+        values = np.zeros((len(groups),len(years),len(classes)))
+        np.add.at(values,codes,parent.values)
+        totals_sum = np.zeros((len(groups),len(years)))
+        np.add.at(totals_sum,codes,parent.totals)
+        results[name] = RollupLevel(name,columns,groups,years,classes,values,totals_sum)
+    return results
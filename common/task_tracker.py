@@ -0,0 +1,227 @@
+import threading
+import time
+from .upload_pipeline import FINISHED_STATES, QuotaError
+
+#The purpose of this code is to follow earth engine ingestion tasks without stopping the run to wait for all of them
+#A background thread polls the states of every task in flight with one request, removes each staged file as soon as
+#   its task completes, and starts failed tasks again after a backoff that doubles with each attempt
+#The number of tasks in flight is a sliding window: it grows by one with each completed task up to max_in_flight,
+#   and drops to the number of running tasks when starting one hits the task quota
+#Callers only block when the window is full
+
+
+class TaskTracker(object):
+    '''
+    Starts ingestions from manifests and follows them until they complete or run out of retries
+    '''
+    def __init__(self,commands,max_in_flight=20,min_in_flight=1,poll_seconds=10,max_retries=3,backoff_seconds=30):
+        self.commands = commands
+        self.max_in_flight = max_in_flight
+        self.min_in_flight = min_in_flight
+        self.poll_seconds = poll_seconds
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.window = max_in_flight
+        #task id: task, for tasks that are started and not finished
+        self.in_flight = {}
+        #Number of ingestions being started, they hold a place in the window
+        self.starting = 0
+        #(time to start again, task) of failed tasks waiting for their backoff
+        self.retrying = []
+        #Number of failed tasks taken from retrying that are being started again
+        self.restarting = 0
+        #asset name: final state
+        self.states = {}
+        self.condition = threading.Condition()
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._poll)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _reserve(self,block):
+        '''
+        Takes a place in the window, waiting for one if block is set to true
+        '''
+        with self.condition:
+            while len(self.in_flight)+self.starting >= self.window:
+                if not block:
+                    return False
+                self.condition.wait(1)
+            self.starting = self.starting+1
+            return True
+
+    def _start(self,task):
+        '''
+        Starts the ingestion of a task that holds a place in the window, returns the task id or None at the task quota
+        '''
+        try:
+            task_id = self.commands.ingest_manifest(task['manifest'])
+        except QuotaError:
+            with self.condition:
+                self.starting = self.starting-1
+                #The quota is reached with the tasks running now
+                window = max(self.min_in_flight,len(self.in_flight))
+                if window < self.window:
+                    print('Task quota reached, {num} tasks in flight'.format(num=window))
+                self.window = window
+            return None
+        except Exception:
+            with self.condition:
+                self.starting = self.starting-1
+                self.condition.notify_all()
+            raise
+        with self.condition:
+            self.starting = self.starting-1
+            task['task_id'] = task_id
+            self.in_flight[task_id] = task
+        return task_id
+
+    def add(self,staged,manifest,on_complete=None,on_fail=None):
+        '''
+        Starts the ingestion of a staged file, waiting while the window is full, returns the task id
+        on_complete is called with the task id once the task has completed (e.g. to record it in an AssetLedger),
+            on_fail with the last task id (None if it never started) once it has run out of retries
+        '''
+        task = {'staged':staged,'manifest':manifest,'attempts':0,'on_complete':on_complete,'on_fail':on_fail}
+        while True:
+            self._reserve(True)
+            task_id = self._start(task)
+            if task_id is not None:
+                return task_id
+            #Nothing running to wait for means other runs hold the quota
+            if len(self.in_flight) == 0:
+                time.sleep(self.backoff_seconds)
+
+    def resume(self,task_id,staged,manifest,on_complete=None,on_fail=None):
+        '''
+        Follows a task that was started by an earlier run, it is started again from its manifest if it failed
+        '''
+        task = {'staged':staged,'manifest':manifest,'attempts':0,'on_complete':on_complete,'on_fail':on_fail,'task_id':task_id}
+        with self.condition:
+            self.in_flight[task_id] = task
+
+    def _finish_task(self,task,status):
+        '''
+        Removes the staged file of a completed task, or schedules a failed task to start again
+        Cancelled tasks were stopped on purpose and are not started again
+        '''
+        name = task['manifest']['name']
+        if status['state'] == 'COMPLETED':
+            #The asset is in place, a staged file that cannot be removed now does not fail it
+            try:
+                self.commands.remove_staged([task['staged']])
+            except Exception as error:
+                print('Could not remove {staged}: {error}'.format(staged=task['staged'],error=error))
+            if task['on_complete'] is not None:
+                try:
+                    task['on_complete'](task['task_id'])
+                except Exception as error:
+                    print('Could not record {name}: {error}'.format(name=name,error=error))
+            with self.condition:
+                self.states[name] = 'COMPLETED'
+                self.window = min(self.window+1,self.max_in_flight)
+                self.condition.notify_all()
+            return
+        print('Ingestion of {name} ended as {state}: {error}'.format(name=name,state=status['state'],error=status.get('error_message','')))
+        if status['state'] == 'CANCELLED':
+            self._fail(task,'CANCELLED')
+        else:
+            self._retry_or_fail(task,status['state'])
+
+    def _retry_or_fail(self,task,state):
+        '''
+        Schedules a task that failed (or could not be started) to start again after its backoff, or once it has run out
+            of retries, removes its staged file and records its final state
+        '''
+        task['attempts'] = task['attempts']+1
+        if task['attempts'] <= self.max_retries:
+            with self.condition:
+                delay = self.backoff_seconds*2**(task['attempts']-1)
+                self.retrying.append((time.time()+delay,task))
+                self.condition.notify_all()
+            return
+        self._fail(task,state)
+
+    def _fail(self,task,state):
+        '''
+        Removes the staged file of a task that is not started again, calls its on_fail and records its final state
+        '''
+        name = task['manifest']['name']
+        #Nothing points to the staged file anymore
+        try:
+            self.commands.remove_staged([task['staged']])
+        except Exception as error:
+            print('Could not remove {staged}: {error}'.format(staged=task['staged'],error=error))
+        if task['on_fail'] is not None:
+            try:
+                task['on_fail'](task.get('task_id'))
+            except Exception as error:
+                print('Could not record the failure of {name}: {error}'.format(name=name,error=error))
+        with self.condition:
+            self.states[name] = state
+            self.condition.notify_all()
+
+    def _poll(self):
+        '''
+        Polls the tasks in flight and starts failed tasks whose backoff is over, until stopped
+        '''
+        while not self.stop.is_set():
+            with self.condition:
+                task_ids = list(self.in_flight)
+            if len(task_ids) > 0:
+                try:
+                    statuses = self.commands.get_task_states(task_ids)
+                except Exception as error:
+                    print('Could not get task states: {error}'.format(error=error))
+                    statuses = {}
+                for task_id, status in statuses.items():
+                    #Tasks the service does not know (e.g. from an old run) are started again like failed tasks
+                    if status['state'] in FINISHED_STATES or status['state'] == 'UNKNOWN':
+                        with self.condition:
+                            task = self.in_flight.pop(task_id)
+                        self._finish_task(task,status)
+            with self.condition:
+                now = time.time()
+                ready = [task for start_time,task in self.retrying if start_time <= now]
+                self.retrying = [(start_time,task) for start_time,task in self.retrying if start_time > now]
+                self.restarting = len(ready)
+            for task_index, task in enumerate(ready):
+                if not self._reserve(False):
+                    #No room, try again at the next poll
+                    with self.condition:
+                        self.retrying.extend((now,other) for other in ready[task_index:])
+                        self.restarting = 0
+                        self.condition.notify_all()
+                    break
+                try:
+                    task_id = self._start(task)
+                except Exception as error:
+                    #Errors that do not clear (e.g. a bad manifest) use up the retries of the task
+                    print('Could not start {name} again: {error}'.format(name=task['manifest']['name'],error=error))
+                    self._retry_or_fail(task,'FAILED')
+                else:
+                    if task_id is None:
+                        #The task quota is reached, try again at the next poll
+                        with self.condition:
+                            self.retrying.extend((now,other) for other in ready[task_index:])
+                            self.restarting = 0
+                            self.condition.notify_all()
+                        break
+                with self.condition:
+                    self.restarting = self.restarting-1
+                    self.condition.notify_all()
+            self.stop.wait(self.poll_seconds)
+
+    def finish(self):
+        '''
+        Waits for every task to complete or run out of retries, returns asset name: final state
+        Raises RuntimeError if the polling thread has stopped, the tasks left would never finish
+        '''
+        with self.condition:
+            while len(self.in_flight) > 0 or len(self.retrying) > 0 or self.starting > 0 or self.restarting > 0:
+                if not self.thread.is_alive():
+                    raise RuntimeError('Task polling stopped with {num} tasks in flight'.format(num=len(self.in_flight)+len(self.retrying)+self.restarting))
+                self.condition.wait(1)
+        self.stop.set()
+        self.thread.join()
+        return dict(self.states)
@@ -0,0 +1,381 @@
+import json
+import os
+import shutil
+import subprocess
+import threading
+import time
+import queue
+from .ingestion import EE_ASSET_ROOT, get_asset_name
+
+#The purpose of this code is to overlap reading, encoding, and uploading of the geotiffs sent to earth engine
+#Each stage has its own threads joined by bounded queues: one thread reads (netCDF reads are not thread safe),
+#   a pool encodes geotiffs, and a pool stages them to the bucket and starts the ingestion
+#A full queue blocks the stage before it, and a disk budget blocks encoding while the local geotiffs waiting to be
+#   staged use more than a set number of bytes, so a long run never fills the disk or memory
+#The gsutil and earthengine commands are behind CloudCommands, LocalCommands is a stand-in that copies files to a
+#   local folder so a run can be tested without cloud access
+#Both also ingest from upload manifests (see ingestion.py), CloudCommands through one earth engine API client
+#LocalCommands can act as a fake task service, with tasks that take time, fail, or hit a limit on running tasks
+
+#States of an earth engine task that will not change
+FINISHED_STATES = ('COMPLETED','FAILED','CANCELLED')
+
+
+class QuotaError(Exception):
+    '''
+    Raised when an ingestion cannot be started because too many tasks are running
+    '''
+    pass
+
+
+class CloudCommands(object):
+    '''
+    Stages files to a google cloud storage bucket and ingests them into earth engine with gsutil and earthengine
+    '''
+    def __init__(self,bucket):
+        self.bucket = bucket
+        self.ee = None
+        self.lock = threading.Lock()
+
+    def _get_ee(self):
+        '''
+        Initializes the earth engine API client the first time it is needed
+        '''
+        with self.lock:
+            if self.ee is None:
+                import ee
+                ee.Initialize()
+                self.ee = ee
+        return self.ee
+
+    def get_staged(self,basename):
+        '''
+        Returns the path in the bucket of a staged file name
+        '''
+        return self.bucket+basename
+
+    def stage(self,filename):
+        '''
+        Copies a local file to the bucket, returns its path in the bucket
+        '''
+        subprocess.check_call(['gsutil','-q','cp',filename,self.bucket])
+        return self.get_staged(os.path.basename(filename))
+
+    def ingest(self,staged,asset_id,args=()):
+        '''
+        Starts the ingestion of a staged file as an image asset, returns the task id
+        '''
+        cmd = ['earthengine','upload','image','--asset_id='+asset_id,'--force']+list(args)+[staged]
+        shell_output = subprocess.check_output(cmd).decode('utf-8')
+        if 'Started upload task with ID' not in shell_output:
+            raise RuntimeError('Could not start the upload of {asset_id}: {output}'.format(asset_id=asset_id,output=shell_output))
+        return shell_output.split(': ')[1].strip()
+
+    def wait(self,task_id):
+        subprocess.call(['earthengine','task','wait',task_id])
+
+    def set_property(self,asset_id,string):
+        subprocess.call(['earthengine','asset','set','-p',string,asset_id])
+
+    def remove(self,staged):
+        subprocess.call(['gsutil','-q','rm',staged])
+
+    def ingest_manifest(self,manifest):
+        '''
+        Starts the ingestion of an image from its upload manifest, returns the task id
+        '''
+        ee = self._get_ee()
+        task_id = ee.data.newTaskId()[0]
+        try:
+            ee.data.startIngestion(task_id,manifest,True)
+        except ee.EEException as error:
+            message = str(error).lower()
+            if 'quota' in message or 'too many' in message:
+                raise QuotaError(str(error))
+            raise
+        return task_id
+
+    def get_task_states(self,task_ids):
+        '''
+        Gets the states of many tasks with one request, returns task id: {'state', 'error_message'}
+        '''
+        ee = self._get_ee()
+        return dict((status['id'],status) for status in ee.data.getTaskStatus(list(task_ids)))
+
+    def set_properties(self,asset_id,properties):
+        '''
+        Sets many properties of an asset with one request
+        '''
+        ee = self._get_ee()
+        ee.data.updateAsset(get_asset_name(asset_id),{'properties':properties},['properties.'+key for key in properties])
+
+    def remove_staged(self,staged_list):
+        '''
+        Removes many staged files with one gsutil call
+        '''
+        if len(staged_list) > 0:
+            subprocess.run(['gsutil','-m','-q','rm','-I'],input='\n'.join(staged_list).encode('utf-8'))
+
+
+class LocalCommands(object):
+    '''
+    Stand-in for CloudCommands, the bucket is a local folder and each ingested asset is a json file of its upload arguments
+    Manifest tasks run for task_seconds, every fail_every-th task fails, and starting a task while max_running are
+        running raises a QuotaError
+    '''
+    def __init__(self,bucket_dir,task_seconds=0,fail_every=0,max_running=None):
+        self.bucket_dir = bucket_dir
+        self.asset_dir = os.path.join(bucket_dir,'assets')
+        if not os.path.exists(self.asset_dir):
+            os.makedirs(self.asset_dir)
+        self.task_seconds = task_seconds
+        self.fail_every = fail_every
+        self.max_running = max_running
+        self.lock = threading.Lock()
+        self.num_tasks = 0
+        #Task ids of a restarted run are not mixed up with those of the run before
+        self.task_prefix = 'LOCAL_{start}_'.format(start=int(time.time()*1000))
+        #Start time and outcome of each manifest task
+        self.tasks = {}
+
+    def _get_asset_filename(self,asset_id):
+        if asset_id.startswith(EE_ASSET_ROOT):
+            asset_id = asset_id[len(EE_ASSET_ROOT):]
+        return os.path.join(self.asset_dir,asset_id.replace('/','__')+'.json')
+
+    def get_staged(self,basename):
+        return os.path.join(self.bucket_dir,basename)
+
+    def stage(self,filename):
+        staged = self.get_staged(os.path.basename(filename))
+        shutil.copyfile(filename,staged)
+        return staged
+
+    def ingest(self,staged,asset_id,args=()):
+        with self.lock:
+            self.num_tasks = self.num_tasks+1
+            task_id = self.task_prefix+str(self.num_tasks)
+        asset = {'asset_id':asset_id,'source':staged,'size':os.path.getsize(staged),'args':list(args),'properties':{},'task_id':task_id}
+        with open(self._get_asset_filename(asset_id),'w') as dst:
+            json.dump(asset,dst,indent=1)
+        return task_id
+
+    def wait(self,task_id):
+        pass
+
+    def set_property(self,asset_id,string):
+        with self.lock:
+            filename = self._get_asset_filename(asset_id)
+            #Folders and collections are not ingested, they only get properties
+            asset = {'asset_id':asset_id,'properties':{}}
+            if os.path.exists(filename):
+                with open(filename) as src:
+                    asset = json.load(src)
+            key, value = string.split('=',1)
+            asset['properties'][key] = value
+            with open(filename,'w') as dst:
+                json.dump(asset,dst,indent=1)
+
+    def remove(self,staged):
+        if os.path.exists(staged):
+            os.remove(staged)
+
+    def _get_state(self,task_id,now):
+        start, fails = self.tasks[task_id]
+        if now-start < self.task_seconds:
+            return 'RUNNING'
+        return 'FAILED' if fails else 'COMPLETED'
+
+    def ingest_manifest(self,manifest):
+        with self.lock:
+            now = time.time()
+            if self.max_running is not None:
+                num_running = sum(1 for other in self.tasks if self._get_state(other,now) == 'RUNNING')
+                if num_running >= self.max_running:
+                    raise QuotaError('Too many tasks running: {num}'.format(num=num_running))
+            self.num_tasks = self.num_tasks+1
+            task_id = self.task_prefix+str(self.num_tasks)
+            self.tasks[task_id] = (now,self.fail_every > 0 and self.num_tasks%self.fail_every == 0)
+        sources = [uri for tileset in manifest['tilesets'] for source in tileset['sources'] for uri in source['uris']]
+        asset = {'asset_id':manifest['name'],'manifest':manifest,'size':sum(os.path.getsize(uri) for uri in sources),
+                 'properties':dict(manifest.get('properties',{})),'task_id':task_id}
+        with open(self._get_asset_filename(manifest['name']),'w') as dst:
+            json.dump(asset,dst,indent=1)
+        return task_id
+
+    def get_task_states(self,task_ids):
+        with self.lock:
+            now = time.time()
+            states = {}
+            for task_id in task_ids:
+                #Tasks started by another process are not known
+                state = self._get_state(task_id,now) if task_id in self.tasks else 'UNKNOWN'
+                states[task_id] = {'id':task_id,'state':state,'error_message':'Fake failure' if state == 'FAILED' else ''}
+            return states
+
+    def set_properties(self,asset_id,properties):
+        #Relative ids fail here like they do with CloudCommands
+        get_asset_name(asset_id)
+        for key, value in properties.items():
+            self.set_property(asset_id,'{key}={value}'.format(key=key,value=value))
+
+    def remove_staged(self,staged_list):
+        for staged in staged_list:
+            self.remove(staged)
+
+
+class DiskBudget(object):
+    '''
+    Blocks callers while the bytes reserved for local files would go over max_bytes
+    One reservation is always let through when nothing is reserved so a file larger than the budget cannot stall a run
+    '''
+    def __init__(self,max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.condition = threading.Condition()
+
+    def reserve(self,num_bytes,stop=None):
+        with self.condition:
+            while self.used > 0 and self.used+num_bytes > self.max_bytes:
+                if stop is not None and stop.is_set():
+                    return False
+                self.condition.wait(0.5)
+            self.used = self.used+num_bytes
+            return True
+
+    def release(self,num_bytes):
+        with self.condition:
+            self.used = max(self.used-num_bytes,0)
+            self.condition.notify_all()
+
+
+def _put(out_queue,item,stop):
+    '''
+    Puts an item on a bounded queue, giving up if the pipeline is stopped
+    '''
+    while not stop.is_set():
+        try:
+            out_queue.put(item,timeout=0.5)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _get(in_queue,stop):
+    '''
+    Gets an item from a queue, None once the pipeline is stopped
+    '''
+    while not stop.is_set():
+        try:
+            return in_queue.get(timeout=0.5)
+        except queue.Empty:
+            pass
+    return None
+
+def run_pipeline(items,encode,publish,num_encoders=2,num_publishers=4,queue_size=2,max_disk_bytes=2*1024**3):
+    '''
+    Function to run read -> encode -> stage and ingest with each stage in its own threads
+    items is an iterable of (key, data), it is iterated in one reader thread so reads can come from a generator
+    encode(key,data) writes a local file and returns its name, or None to skip the item (e.g. it has not changed)
+    publish(key,filename) stages and ingests the file and returns a result (e.g. the task id), the local file is
+        removed once publish returns
+    Space for data.nbytes is reserved on disk before each encode and corrected to the file size after it
+    Returns a dictionary of key: result (None for skipped items), the first error of any stage is raised once every thread has stopped
+    '''
+    stop = threading.Event()
+    errors = []
+    results = {}
+    read_queue = queue.Queue(queue_size)
+    encoded_queue = queue.Queue(queue_size)
+    budget = DiskBudget(max_disk_bytes)
+    DONE = object()
+
+    def fail(error):
+        errors.append(error)
+        stop.set()
+
+    def read_items():
+        try:
+            for item in items:
+                if not _put(read_queue,item,stop):
+                    return
+        except Exception as error:
+            fail(error)
+        finally:
+            for _ in range(num_encoders):
+                _put(read_queue,DONE,stop)
+
+    def encode_items():
+        try:
+            while True:
+                item = _get(read_queue,stop)
+                if item is None or item is DONE:
+                    return
+                key, data = item
+                reserved = int(getattr(data,'nbytes',0))
+                if not budget.reserve(reserved,stop):
+                    return
+                filename = None
+                handed_off = False
+                try:
+                    filename = encode(key,data)
+                    if filename is None:
+                        results[key] = None
+                        continue
+                    size = os.path.getsize(filename)
+                    #Correct the reservation to the size of the file, giving up if the pipeline is stopped
+                    if size > reserved:
+                        if not budget.reserve(size-reserved,stop):
+                            return
+                    else:
+                        budget.release(reserved-size)
+                    reserved = size
+                    handed_off = _put(encoded_queue,(key,filename,size),stop)
+                    if not handed_off:
+                        return
+                finally:
+                    #A file that is not handed to a publisher is removed here, with its reservation
+                    if not handed_off:
+                        budget.release(reserved)
+                        if filename is not None and os.path.exists(filename):
+                            os.remove(filename)
+        except Exception as error:
+            fail(error)
+
+    def publish_items():
+        try:
+            while True:
+                item = _get(encoded_queue,stop)
+                if item is None or item is DONE:
+                    return
+                key, filename, size = item
+                try:
+                    results[key] = publish(key,filename)
+                finally:
+                    if os.path.exists(filename):
+                        os.remove(filename)
+                    budget.release(size)
+        except Exception as error:
+            fail(error)
+
+    reader = threading.Thread(target=read_items)
+    encoders = [threading.Thread(target=encode_items) for _ in range(num_encoders)]
+    publishers = [threading.Thread(target=publish_items) for _ in range(num_publishers)]
+    for thread in [reader]+encoders+publishers:
+        thread.daemon = True
+        thread.start()
+    reader.join()
+    for thread in encoders:
+        thread.join()
+    for _ in range(num_publishers):
+        _put(encoded_queue,DONE,stop)
+    for thread in publishers:
+        thread.join()
+    #Remove local files that were encoded but never published after an error
+    while not encoded_queue.empty():
+        item = encoded_queue.get()
+        if item is not DONE and os.path.exists(item[1]):
+            os.remove(item[1])
+    if errors:
+        raise errors[0]
+    return results
@@ -1,6 +1,12 @@
+import sys
+import os
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 from matplotlib import pyplot
+#The rollup engine is shared with the Land-Use Harmonization scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from common.rollup import rollup
 
 pd.options.display.max_colwidth = 1000
 np.set_printoptions(suppress=True)
@@ -24,187 +30,244 @@ realm_perc_csv = direc + 'esa_lc_realm_percent.csv'
 num_years = 2016-1992
 #Land cover column names
 lc_names = ['Agriculture','Forest','Grassland','Wetland','Settlement','Shrubland','Sparse_vegetation','Bare_area','Water','Snow_ice']
+#If vectorized is set to true, every table is found by the rollup engine (see common/rollup.py) instead of looping over rows
+VECTORIZED = True
+#Levels of the rollup as (name, columns, level it is summed from)
+LEVELS = [('ecoregion',['OBJECTID'],None),('biome_realm',['BIOME_NAME','REALM'],'ecoregion'),('biome',['BIOME_NAME'],'biome_realm'),('realm',['REALM'],'biome_realm')]
 #Read in dataframe
 in_df = pd.read_csv(input_csv,header=0,index_col=0)
 
-#1. CONVERT PIXEL COUNTS TO PERCENT COVER FOR EACH ECOREGION
-#The purpose of this section of code is to find the percent coverage of each land cover class over the years for each of the ecoregions
-#Copy over dataframe
-perc_df = in_df.copy()
-#Iterate over dataframe
-for index, row in in_df.iterrows():
-   total = row['Total']
-   for lc in lc_names:
-       for i,year in enumerate(np.arange(1992,2016)):
-           column_name = lc+'_'+str(year)
-           lc_val = perc_df.at[index,column_name]
-           perc_val = lc_val/total
-           perc_df.at[index,column_name] = perc_val
-perc_df.to_csv(all_perc_csv)
-
-#2. PIXEL COUNTS FOR UNIQUE BIOME, REALM PAIRS
-#The purpose of this section of code is to find the land cover information for unique biome, realm pairs
-#Get unique biome, realm pairs
-biomes_realms = in_df[['BIOME_NAME','REALM']]
-biomes_realms = biomes_realms.drop_duplicates()
-#Copy over biome and realm values
-biome_realm_df = pd.DataFrame(columns=['Biome','Realm'])
-biome_realm_df['Biome'] = biomes_realms['BIOME_NAME'].tolist()
-biome_realm_df['Realm'] = biomes_realms['REALM'].tolist()
-biome_realm_df['Total'] = 0.0
-
-#2a. SUM PIXEL COUNTS FOR EACH BIOME, REALM PAIR
-#The purpose of this section of code is to sum the pixel counts of each year and land cover class over the ecoregions that match
-#   the biome, realm pairs as above
-#Iterate over the biome,realm pairs of the biome_realm_df and fill in land cover values
-for biome_index,biome_row in biome_realm_df.iterrows():
-    #Get subset of dataframe of ecoregions that match the biome, realm pair
-    temp_df = in_df[(in_df['BIOME_NAME'] == biome_row['Biome']) & (in_df['REALM'] == biome_row['Realm'])]
-    biome_realm_df.at[biome_index,'Total'] = np.sum(np.array(temp_df['Total'].tolist()))
-    #Iterate over land cover types
-    for lc in lc_names:
-        #Iterate over years
-        for i, year in enumerate(np.arange(1992,2016)):
-            #Get column name
-            column_name = lc+'_'+str(year)
-            #Get array of pixel counts for that year and land cover for ecoregions that match that biome and realm
-            lc_year_array = np.array(temp_df[column_name].tolist())
-            #Sum over pixel counts
-            lc_year_sum = np.sum(lc_year_array)
-            #Save to dataframe
-            biome_realm_df.at[biome_index,column_name] = lc_year_sum
-#Save dataframe to csv
-biome_realm_df.to_csv(biome_realm_csv)
-
-
-#2b. FIND PERCENT COVERAGE OF EACH LAND COVER TYPE FOR EACH UNIQUE BIOME, REALM PAIRS
-#The purpose of this section of code is to find the percent coverage of each land cover class for the 
-#   unique biome, realm pairs
-#Copy over dataframe
-biome_realm_perc_df = biome_realm_df.copy()
-#Iterate over the biome, realm pairs
-for index, row in biome_realm_perc_df.iterrows():
-    #Save total
-    total = row['Total']
-    #Iterate through lc names
-    for lc in lc_names:
-        #Iterate through years
-        for year in np.arange(1992,2016):
-            #Find percent land cover for that land cover type and year
-            column_name = lc+'_'+str(year)
-            lc_year_val = biome_realm_perc_df.at[index,column_name]
-            lc_year_perc = lc_year_val/total
-            #Save back to dataframe
-            biome_realm_perc_df.at[index,column_name] = lc_year_perc
-biome_realm_perc_df.to_csv(biome_realm_perc_csv)
-
-
-
-#3. PIXEL COUNTS FOR BIOMES
-#The purpose of this section of code is to find the pixel counts for each biome
-#Get unique biome names
-biomes = in_df['BIOME_NAME']
-biomes = biomes.drop_duplicates()
-#Copy over biome values
-biome_df = pd.DataFrame(columns=['Biome'])
-biome_df['Biome'] = biomes.tolist()
-#Save empty column for total
-biome_df['Total'] = 0.0
-
-#3a. SUM PIXEL COUNTS FOR EACH BIOME
-#The purpose of this section of code is to sum the pixel counts of each year and land cover class over the ecoregions that match the biomes above
-#Iterate over the biomes of the biome_df and fill in land cover values
-for biome_index,biome_row in biome_df.iterrows():
-    #Get subset of dataframe of ecoregions that match the biome
-    temp_df = in_df[in_df['BIOME_NAME'] == biome_row['Biome']]
-    biome_df.at[biome_index,'Total'] = np.sum(np.array(temp_df['Total'].tolist()))
-    #Iterate over land cover types
-    for lc in lc_names:
-        #Iterate over years
-        for i, year in enumerate(np.arange(1992,2016)):
-            #Get column name
-            column_name = lc+'_'+str(year)
-            #Get array of pixel counts for that year and land cover for ecoregions that match that biome 
-            lc_year_array = np.array(temp_df[column_name].tolist())
-            #Sum over pixel counts
-            lc_year_sum = np.sum(lc_year_array)
-            #Save land cover sum into dataframe
-            biome_df.at[biome_index,column_name] = lc_year_sum
-#Save dataframe to csv
-biome_df.to_csv(biome_csv)
-
-
-#3b. FIND PERCENT COVERAGE OF EACH LAND COVER TYPE FOR EACH UNIQUE BIOME
-#The purpose of this section of code is to find the percent coverage of each land cover class for the biomes
-#Copy over dataframe
-biome_perc_df = biome_df.copy()
-#Iterate over the biomes
-for index, row in biome_perc_df.iterrows():
-    #Save total
-    total = row['Total']
-    #Iterate through lc names
-    for lc in lc_names:
-        #Iterate through years
-        for year in np.arange(1992,2016):
-            #Find percent land cover for that land cover type and year
-            column_name = lc+'_'+str(year)
-            lc_year_val = biome_perc_df.at[index,column_name]
-            lc_year_perc = lc_year_val/total
-            #Save back to dataframe
-            biome_perc_df.at[index,column_name] = lc_year_perc
-biome_perc_df.to_csv(biome_perc_csv)
-
-#4. PIXEL COUNTS FOR Realms
-#The purpose of this section of code is to find the pixel counts for each realm
-#Get unique realm names
-realms = in_df['REALM']
-realms = realms.drop_duplicates()
-#Copy over realm values
-realm_df = pd.DataFrame(columns=['Realm'])
-realm_df['Realm'] = realms.tolist()
-#Save empty column for total
-realm_df['Total'] = 0.0
-
-#4a. SUM PIXEL COUNTS FOR EACH REALM
-#The purpose of this section of code is to sum the pixel counts of each year and land cover class over the ecoregions that match the realms above
-#Iterate over the realms of the realm_df and fill in land cover values
-for realm_index,realm_row in realm_df.iterrows():
-    #Get subset of dataframe of ecoregions that match the realm
-    temp_df = in_df[in_df['REALM'] == realm_row['Realm']]
-    realm_df.at[realm_index,'Total'] = np.sum(np.array(temp_df['Total'].tolist()))
-    #Iterate over land cover types
-    for lc in lc_names:
-        #Iterate over years
-        for i, year in enumerate(np.arange(1992,2016)):
-            #Get column name
-            column_name = lc+'_'+str(year)
-            #Get array of pixel counts for that year and land cover for ecoregions that match that realm 
-            lc_year_array = np.array(temp_df[column_name].tolist())
-            #Sum over pixel counts
-            lc_year_sum = np.sum(lc_year_array)
-            #Save land cover sum into dataframe
-            realm_df.at[realm_index,column_name] = lc_year_sum
-#Save dataframe to csv
-realm_df.to_csv(realm_csv)
-
-
-#4b. FIND PERCENT COVERAGE OF EACH LAND COVER TYPE FOR EACH UNIQUE REALM
-#The purpose of this section of code is to find the percent coverage of each land cover class for the realms
-#Copy over dataframe
-realm_perc_df = realm_df.copy()
-#Iterate over the realms
-for index, row in realm_perc_df.iterrows():
-    #Save total
-    total = row['Total']
-    #Iterate through lc names
-    for lc in lc_names:
-        #Iterate through years
-        for year in np.arange(1992,2016):
-            #Find percent land cover for that land cover type and year
-            column_name = lc+'_'+str(year)
-            lc_year_val = realm_perc_df.at[index,column_name]
-            lc_year_perc = lc_year_val/total
-            #Save back to dataframe
-            realm_perc_df.at[index,column_name] = lc_year_perc
-realm_perc_df.to_csv(realm_perc_csv)
+def getLongTable(in_df):
+    '''
+    Turns the wide table (one column per land cover and year) into long format, one row per ecoregion, year, and class
+    The total pixel count of each ecoregion is kept as a 'Total' class for every year
+    '''
+    value_columns = [lc+'_'+str(year) for year in np.arange(1992,2016) for lc in lc_names]
+    long_df = in_df.melt(id_vars=['OBJECTID','ECO_NAME','BIOME_NAME','REALM'],value_vars=value_columns,var_name='column',value_name='count')
+    #Land cover names have underscores themselves, so split on the last one
+    parts = long_df['column'].str.rsplit('_',n=1,expand=True)
+    long_df['class'] = parts[0]
+    long_df['year'] = parts[1].astype(int)
+    total_df = pd.concat([in_df[['OBJECTID','ECO_NAME','BIOME_NAME','REALM']].assign(year=year,**{'class':'Total','count':in_df['Total'].values}) for year in np.arange(1992,2016)])
+    long_df = pd.concat([long_df.drop(columns=['column']),total_df],ignore_index=True)
+    long_df['class'] = pd.Categorical(long_df['class'],categories=lc_names+['Total'])
+    return long_df
 
+def getWideFrame(level,names,percent=False):
+    '''
+    Gets a level of the rollup in the wide layout, the total pixel count then one column per land cover and year
+    Percent cover is not defined where the total is 0 and is left as NaN
+    '''
+    values = level.get_percent(np.nan) if percent else level.values
+    columns = level.groups[level.columns].rename(columns=dict(zip(level.columns,names)))
+    columns['Total'] = level.totals[:,0]
+    lc_columns = OrderedDict()
+    for class_index, lc in enumerate(level.classes):
+        for year_index, year in enumerate(level.years):
+            lc_columns[lc+'_'+str(year)] = values[:,year_index,class_index]
+    return pd.concat([columns,pd.DataFrame(lc_columns)],axis=1)
+
+if VECTORIZED:
+    #Sum the pixel counts over the ecoregions, biome, realm pairs, biomes, and realms in one pass
+    levels = rollup(getLongTable(in_df),LEVELS,'count','Total',zone_columns=['OBJECTID','ECO_NAME','BIOME_NAME','REALM'])
+
+    #1. CONVERT PIXEL COUNTS TO PERCENT COVER FOR EACH ECOREGION
+    perc_df = in_df.copy()
+    ecoregion_perc = getWideFrame(levels['ecoregion'],['OBJECTID'],percent=True)
+    #Skip the OBJECTID and Total columns, the rest are the land cover and year columns
+    for column in ecoregion_perc.columns[2:]:
+        perc_df[column] = ecoregion_perc[column].values
+    perc_df.to_csv(all_perc_csv)
+
+    #2. PIXEL COUNTS AND PERCENT COVER FOR UNIQUE BIOME, REALM PAIRS
+    getWideFrame(levels['biome_realm'],['Biome','Realm']).to_csv(biome_realm_csv)
+    getWideFrame(levels['biome_realm'],['Biome','Realm'],percent=True).to_csv(biome_realm_perc_csv)
+
+    #3. PIXEL COUNTS AND PERCENT COVER FOR BIOMES
+    getWideFrame(levels['biome'],['Biome']).to_csv(biome_csv)
+    getWideFrame(levels['biome'],['Biome'],percent=True).to_csv(biome_perc_csv)
+
+    #4. PIXEL COUNTS AND PERCENT COVER FOR REALMS
+    getWideFrame(levels['realm'],['Realm']).to_csv(realm_csv)
+    getWideFrame(levels['realm'],['Realm'],percent=True).to_csv(realm_perc_csv)
+else:
+    #1. CONVERT PIXEL COUNTS TO PERCENT COVER FOR EACH ECOREGION
+    #The purpose of this section of code is to find the percent coverage of each land cover class over the years for each of the ecoregions
+    #Copy over dataframe
+    perc_df = in_df.copy()
+    #Iterate over dataframe
+    for index, row in in_df.iterrows():
+       total = row['Total']
+       for lc in lc_names:
+           for i,year in enumerate(np.arange(1992,2016)):
+               column_name = lc+'_'+str(year)
+               lc_val = perc_df.at[index,column_name]
+               perc_val = lc_val/total
+               perc_df.at[index,column_name] = perc_val
+    perc_df.to_csv(all_perc_csv)
+
+    #2. PIXEL COUNTS FOR UNIQUE BIOME, REALM PAIRS
+    #The purpose of this section of code is to find the land cover information for unique biome, realm pairs
+    #Get unique biome, realm pairs
+    biomes_realms = in_df[['BIOME_NAME','REALM']]
+    biomes_realms = biomes_realms.drop_duplicates()
+    #Copy over biome and realm values
+    biome_realm_df = pd.DataFrame(columns=['Biome','Realm'])
+    biome_realm_df['Biome'] = biomes_realms['BIOME_NAME'].tolist()
+    biome_realm_df['Realm'] = biomes_realms['REALM'].tolist()
+    biome_realm_df['Total'] = 0.0
+
+    #2a. SUM PIXEL COUNTS FOR EACH BIOME, REALM PAIR
+    #The purpose of this section of code is to sum the pixel counts of each year and land cover class over the ecoregions that match
+    #   the biome, realm pairs as above
+    #Iterate over the biome,realm pairs of the biome_realm_df and fill in land cover values
+    for biome_index,biome_row in biome_realm_df.iterrows():
+        #Get subset of dataframe of ecoregions that match the biome, realm pair
+        temp_df = in_df[(in_df['BIOME_NAME'] == biome_row['Biome']) & (in_df['REALM'] == biome_row['Realm'])]
+        biome_realm_df.at[biome_index,'Total'] = np.sum(np.array(temp_df['Total'].tolist()))
+        #Iterate over land cover types
+        for lc in lc_names:
+            #Iterate over years
+            for i, year in enumerate(np.arange(1992,2016)):
+                #Get column name
+                column_name = lc+'_'+str(year)
+                #Get array of pixel counts for that year and land cover for ecoregions that match that biome and realm
+                lc_year_array = np.array(temp_df[column_name].tolist())
+                #Sum over pixel counts
+                lc_year_sum = np.sum(lc_year_array)
+                #Save to dataframe
+                biome_realm_df.at[biome_index,column_name] = lc_year_sum
+    #Save dataframe to csv
+    biome_realm_df.to_csv(biome_realm_csv)
+
+
+    #2b. FIND PERCENT COVERAGE OF EACH LAND COVER TYPE FOR EACH UNIQUE BIOME, REALM PAIRS
+    #The purpose of this section of code is to find the percent coverage of each land cover class for the 
+    #   unique biome, realm pairs
+    #Copy over dataframe
+    biome_realm_perc_df = biome_realm_df.copy()
+    #Iterate over the biome, realm pairs
+    for index, row in biome_realm_perc_df.iterrows():
+        #Save total
+        total = row['Total']
+        #Iterate through lc names
+        for lc in lc_names:
+            #Iterate through years
+            for year in np.arange(1992,2016):
+                #Find percent land cover for that land cover type and year
+                column_name = lc+'_'+str(year)
+                lc_year_val = biome_realm_perc_df.at[index,column_name]
+                lc_year_perc = lc_year_val/total
+                #Save back to dataframe
+                biome_realm_perc_df.at[index,column_name] = lc_year_perc
+    biome_realm_perc_df.to_csv(biome_realm_perc_csv)
+
+
+
+    #3. PIXEL COUNTS FOR BIOMES
+    #The purpose of this section of code is to find the pixel counts for each biome
+    #Get unique biome names
+    biomes = in_df['BIOME_NAME']
+    biomes = biomes.drop_duplicates()
+    #Copy over biome values
+    biome_df = pd.DataFrame(columns=['Biome'])
+    biome_df['Biome'] = biomes.tolist()
+    #Save empty column for total
+    biome_df['Total'] = 0.0
+
+    #3a. SUM PIXEL COUNTS FOR EACH BIOME
+    #The purpose of this section of code is to sum the pixel counts of each year and land cover class over the ecoregions that match the biomes above
+    #Iterate over the biomes of the biome_df and fill in land cover values
+    for biome_index,biome_row in biome_df.iterrows():
+        #Get subset of dataframe of ecoregions that match the biome
+        temp_df = in_df[in_df['BIOME_NAME'] == biome_row['Biome']]
+        biome_df.at[biome_index,'Total'] = np.sum(np.array(temp_df['Total'].tolist()))
+        #Iterate over land cover types
+        for lc in lc_names:
+            #Iterate over years
+            for i, year in enumerate(np.arange(1992,2016)):
+                #Get column name
+                column_name = lc+'_'+str(year)
+                #Get array of pixel counts for that year and land cover for ecoregions that match that biome 
+                lc_year_array = np.array(temp_df[column_name].tolist())
+                #Sum over pixel counts
+                lc_year_sum = np.sum(lc_year_array)
+                #Save land cover sum into dataframe
+                biome_df.at[biome_index,column_name] = lc_year_sum
+    #Save dataframe to csv
+    biome_df.to_csv(biome_csv)
+
+
+    #3b. FIND PERCENT COVERAGE OF EACH LAND COVER TYPE FOR EACH UNIQUE BIOME
+    #The purpose of this section of code is to find the percent coverage of each land cover class for the biomes
+    #Copy over dataframe
+    biome_perc_df = biome_df.copy()
+    #Iterate over the biomes
+    for index, row in biome_perc_df.iterrows():
+        #Save total
+        total = row['Total']
+        #Iterate through lc names
+        for lc in lc_names:
+            #Iterate through years
+            for year in np.arange(1992,2016):
+                #Find percent land cover for that land cover type and year
+                column_name = lc+'_'+str(year)
+                lc_year_val = biome_perc_df.at[index,column_name]
+                lc_year_perc = lc_year_val/total
+                #Save back to dataframe
+                biome_perc_df.at[index,column_name] = lc_year_perc
+    biome_perc_df.to_csv(biome_perc_csv)
+
+    #4. PIXEL COUNTS FOR Realms
+    #The purpose of this section of code is to find the pixel counts for each realm
+    #Get unique realm names
+    realms = in_df['REALM']
+    realms = realms.drop_duplicates()
+    #Copy over realm values
+    realm_df = pd.DataFrame(columns=['Realm'])
+    realm_df['Realm'] = realms.tolist()
+    #Save empty column for total
+    realm_df['Total'] = 0.0
+
+    #4a. SUM PIXEL COUNTS FOR EACH REALM
+    #The purpose of this section of code is to sum the pixel counts of each year and land cover class over the ecoregions that match the realms above
+    #Iterate over the realms of the realm_df and fill in land cover values
+    for realm_index,realm_row in realm_df.iterrows():
+        #Get subset of dataframe of ecoregions that match the realm
+        temp_df = in_df[in_df['REALM'] == realm_row['Realm']]
+        realm_df.at[realm_index,'Total'] = np.sum(np.array(temp_df['Total'].tolist()))
+        #Iterate over land cover types
+        for lc in lc_names:
+            #Iterate over years
+            for i, year in enumerate(np.arange(1992,2016)):
+                #Get column name
+                column_name = lc+'_'+str(year)
+                #Get array of pixel counts for that year and land cover for ecoregions that match that realm 
+                lc_year_array = np.array(temp_df[column_name].tolist())
+                #Sum over pixel counts
+                lc_year_sum = np.sum(lc_year_array)
+                #Save land cover sum into dataframe
+                realm_df.at[realm_index,column_name] = lc_year_sum
+    #Save dataframe to csv
+    realm_df.to_csv(realm_csv)
+
+
+    #4b. FIND PERCENT COVERAGE OF EACH LAND COVER TYPE FOR EACH UNIQUE REALM
+    #The purpose of this section of code is to find the percent coverage of each land cover class for the realms
+    #Copy over dataframe
+    realm_perc_df = realm_df.copy()
+    #Iterate over the realms
+    for index, row in realm_perc_df.iterrows():
+        #Save total
+        total = row['Total']
+        #Iterate through lc names
+        for lc in lc_names:
+            #Iterate through years
+            for year in np.arange(1992,2016):
+                #Find percent land cover for that land cover type and year
+                column_name = lc+'_'+str(year)
+                lc_year_val = realm_perc_df.at[index,column_name]
+                lc_year_perc = lc_year_val/total
+                #Save back to dataframe
+                realm_perc_df.at[index,column_name] = lc_year_perc
+    realm_perc_df.to_csv(realm_perc_csv)
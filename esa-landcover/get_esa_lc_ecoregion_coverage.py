@@ -1,9 +1,14 @@
+import sys
+import os
 import rasterio
 from rasterio.mask import mask
 import geopandas as gpd
 import pandas as pd
 import numpy as np
 from shapely.geometry import mapping
+#The coverage database is shared with the Land-Use Harmonization scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from common import coverage_db
 write_zero_frequencies = True
 show_plot = False
 np.set_printoptions(suppress=True)
@@ -19,10 +24,19 @@ output_dir = "ESA_Landcover/"
 rasters = "esa_landcover_tifs/ESA_{year}_ipcc.tif"
 #Output csv names for each year
 outputs = output_dir + 'esa_lc_ecoregions_pixel_count_{year}.csv'
+#If write database is set to true, each year is also added to the coverage database for time series queries (see common/coverage_db.py)
+write_database = True
+database = output_dir + 'coverage.sqlite'
+dataset = 'esa_lc'
+#Pixel count columns saved to the database
+count_columns = ['No_data','Agriculture','Forest','Grassland','Wetland','Settlement','Shrubland','Sparse_vegetation','Bare_area','Water','Snow_ice','Total']
 
 
 #Read in shapefile
 shapefile = gpd.read_file(shape_fn)
+if write_database:
+    conn = coverage_db.connect(database)
+    coverage_db.write_zones(conn,dataset,shapefile[shapefile['OBJECTID']!=207])
 
 #For each year
 for i in np.arange(1992,2016):
@@ -71,4 +85,8 @@ for i in np.arange(1992,2016):
                 #Save to dataframe
                 df.loc[index]=[eco_id,eco_name,biome_name,realm,no_data,agriculture,forest,grassland,wetland,settlement,shrubland,sparse_veg,bare_area,water,snow,total]
         #Save to csv
-        df.to_csv(output_fn,encoding = 'utf-8')
\ No newline at end of file
+        df.to_csv(output_fn,encoding = 'utf-8')
+        if write_database:
+            coverage_db.write_year(conn,dataset,i,df,count_columns)
+if write_database:
+    conn.close()
\ No newline at end of file
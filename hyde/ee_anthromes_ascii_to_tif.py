@@ -9,8 +9,14 @@ from matplotlib import pyplot as plt
 import datetime
 import logging
 import subprocess
-import urllib.request
 import zipfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from common.upload_pipeline import CloudCommands, LocalCommands
+from common.ingestion import get_image_manifest
+from common.task_tracker import TaskTracker
+from common.asset_ledger import AssetLedger, hash_files
+from common.job_ledger import JobLedger
+from common.downloads import DownloadManager
 
 #The purpose of this code is to upload data from HYDE 3.2 land use categorized by anthromes to google earth engine
 #Ascii grids are downloaded, converted to geotiffs, and uploaded to google earth engine
@@ -47,106 +53,117 @@ DOWNLOAD_NAME = '{year}{AD}_anthromes.zip'
 FILE_NAME = 'anthromes{year}{AD}.asc'
 TEMP_FILE_NAME = 'temp_anthromes_{year}{AD}.tif'
 
-PAUSE_FOR_OVERLOAD = True
-NUM_ASSETS_AT_ONCE = 50
+#Most ingestion tasks in flight at once, fewer when the task quota is reached (see common/task_tracker.py)
+MAX_TASKS_IN_FLIGHT = 50
+#If a local bucket folder is given, files are copied there instead of to google cloud and earth engine (for testing)
+LOCAL_BUCKET_DIR = None
+#If skip unchanged is set to true, years whose ascii grids and properties have the same content hash as when they were
+#   last ingested are not converted, staged, or ingested again (see common/asset_ledger.py)
+SKIP_UNCHANGED = True
+LEDGER_FILENAME = DATA_DIR+'upload_ledger.sqlite'
+#The stage of each year of a run is kept in this job ledger so a run that stops can be started again where it stopped,
+#   runs with different run ids (e.g. AD and BC, land use and population) can share it (see common/job_ledger.py)
+JOBS_FILENAME = DATA_DIR+'upload_jobs.sqlite'
+#Zips are downloaded into this mirror, shared by the HYDE scripts, so each zip is only downloaded once
+#   (see common/downloads.py), at most NUM_DOWNLOADS at once
+MIRROR_DIR = DATA_DIR+'hyde_mirror/'
+NUM_DOWNLOADS = 4
 
 #HERE IS WHERE YOU SET AD VS BC
 #Code is set right now for BC years, this is changed by replacing YEARS=BC_YEARS to YEARS=AD_YEARS below
 #       And by replacing AD='BC' below to AD='AD'
 AD = 'BC'
 YEARS= BC_YEARS
+#Name of this run in the job ledger
+RUN_ID = 'hyde_anthromes_'+AD
 
 
 def start_task(year,AD):
     '''
     Function to download datafile, convert to geoTIFF, and upload to earth engine
+    Stages that were done before the run stopped (see the job ledger) are not done again
     '''
-    download_name = DOWNLOAD_NAME.format(year=year,AD=AD)
-    try:
-        urllib.request.urlretrieve(URL.format(filename=download_name), DATA_DIR+download_name)
-    except:
-        urllib.request.urlretrieve(URL.format(filename=download_name), DATA_DIR+download_name,timeout=600)
-    #Extract file from zipped file
-    zip_file = zipfile.ZipFile(DATA_DIR+download_name)
-    zip_file.extractall(DATA_DIR)
-    os.remove(DATA_DIR+download_name)
-    
-    #Read in asc information, create geotiff driver, and copy over information
-    drv = gdal.GetDriverByName('GTiff')
-    ds_in = gdal.Open(DATA_DIR+FILE_NAME.format(year=year,AD=AD))
-    ds_out = drv.CreateCopy(DATA_DIR+TEMP_FILE_NAME.format(year=year,AD=AD), ds_in)
-    
-    #Get no data value
-    NDV = ds_in.GetRasterBand(1).GetNoDataValue()
-    
-    #Get projection information and save to new file
-    Projection = osr.SpatialReference()
-    #Projection.ImportFromWkt(ds_in.GetProjectionRef())
-    Projection.ImportFromEPSG(4326)
-    ds_out.SetProjection(Projection.ExportToWkt())
+    job = JOBS.get(year)
+    asset_id = EE_COLLECTION+'/'+'Anthromes_'+str(year)+AD
+    if JOBS.reached(year,'converted') and os.path.exists(DATA_DIR+TEMP_FILE_NAME.format(year=year,AD=AD)):
+        #Pick up from the geotiff that was converted before the run stopped
+        content_hash = job['content_hash']
+        with rasterio.open(DATA_DIR+TEMP_FILE_NAME.format(year=year,AD=AD)) as src:
+            NDV = src.nodata
+    else:
+        if not (JOBS.reached(year,'downloaded') and os.path.exists(DATA_DIR+FILE_NAME.format(year=year,AD=AD))):
+            download_name = DOWNLOAD_NAME.format(year=year,AD=AD)
+            zip_path = DOWNLOADS.fetch(URL.format(filename=download_name))
+            #Extract file from zipped file, the zip stays in the mirror so it is only downloaded once
+            with zipfile.ZipFile(zip_path) as zip_file:
+                zip_file.extractall(DATA_DIR)
+            JOBS.set_stage(year,'downloaded',reset=True)
+        
+        #Skip the year if its ascii grid and properties have not changed since it was ingested
+        content_hash = hash_files(DATA_DIR+FILE_NAME.format(year=year,AD=AD),{'asset_id':asset_id,'year':-year if AD=='BC' else year})
+        if LEDGER.is_current(asset_id,content_hash):
+            print('Skipped unchanged year: {year} {AD}'.format(year=year,AD=AD))
+            os.remove(DATA_DIR+FILE_NAME.format(year=year,AD=AD))
+            JOBS.set_stage(year,'done',asset_id,content_hash)
+            return None,None
+        
+        #Read in asc information, create geotiff driver, and copy over information
+        drv = gdal.GetDriverByName('GTiff')
+        ds_in = gdal.Open(DATA_DIR+FILE_NAME.format(year=year,AD=AD))
+        ds_out = drv.CreateCopy(DATA_DIR+TEMP_FILE_NAME.format(year=year,AD=AD), ds_in)
+        
+        #Get no data value
+        NDV = ds_in.GetRasterBand(1).GetNoDataValue()
+        
+        #Get projection information and save to new file
+        Projection = osr.SpatialReference()
+        #Projection.ImportFromWkt(ds_in.GetProjectionRef())
+        Projection.ImportFromEPSG(4326)
+        ds_out.SetProjection(Projection.ExportToWkt())
+        
+        #Close files
+        ds_in = None
+        ds_out = None
+        
+        #Remove ascii files
+        os.remove(DATA_DIR+FILE_NAME.format(year=year,AD=AD))
+        JOBS.set_stage(year,'converted',asset_id,content_hash)
     
-    #Close files
-    ds_in = None
-    ds_out = None
+    #Upload geotiff to staging bucket
+    staged = COMMANDS.stage(DATA_DIR+TEMP_FILE_NAME.format(year=year,AD=AD))
     
-    #Remove ascii files
-    os.remove(DATA_DIR+FILE_NAME.format(year=year,AD=AD))
+    #Set year property of asset, BC years are negative
+    if AD=='BC':
+        properties = {'year':-year,'no_data_value':NDV}
+    else:
+        properties = {'year':year,'no_data_value':NDV}
     
-    #Upload geotiff to staging bucket
-    cmd = ['gsutil','-m','cp',DATA_DIR+TEMP_FILE_NAME.format(year=year,AD=AD),GS_BUCKET]
-    subprocess.call(cmd)
+    #Ingest GeoTIFF from google storage bucket to earth engine, the year is recorded in the ledger once its task has completed
+    #The job ledger keeps the staged file, manifest, and task id so the task can be followed after a restart
+    manifest = get_image_manifest(asset_id,staged,None,NDV,properties=properties,pyramiding_policy='sample')
+    task_id = JOBS.ingest(year,TRACKER,staged,manifest,asset_id,content_hash,LEDGER.recorder(asset_id,content_hash,manifest))
     
     #Remove local file as well
     os.remove(DATA_DIR+TEMP_FILE_NAME.format(year=year,AD=AD))
-    
-    #Get asset id 
-    asset_id = EE_COLLECTION+'/'+'Anthromes_'+str(year)+AD
-    
-    #Upload GeoTIFF from google storage bucket to earth engine
-    cmd = ['earthengine','upload','image','--asset_id='+asset_id,'--force','--nodata_value='+str(NDV),'--pyramiding_policy=sample',GS_BUCKET+TEMP_FILE_NAME.format(year=year,AD=AD)]
-    shell_output = subprocess.check_output(cmd)
-    shell_output = shell_output.decode("utf-8")
-    print(shell_output)
-    
-    #Get task id
-    task_id = ''
-    if 'Started upload task with ID' in shell_output:
-        task_id = shell_output.split(': ')[1]
-        task_id = task_id.strip()
-    else:
-        print('Something went wrong!')
-        task_id='ERROR'
+    print('Started upload of {asset_id}: {task_id}'.format(asset_id=asset_id,task_id=task_id))
     return task_id,NDV
 
-def add_properties(task_id,year,AD,NDV,DATA_DIR=DATA_DIR,TEMP_FILE_NAME=TEMP_FILE_NAME):
-    '''
-    Function to add properties to images
-    '''
-    #Get asset id
-    asset_id = EE_COLLECTION+'/'+'Anthromes_'+str(year)+AD
-    
-    #Wait for task to finish
-    cmd = ['earthengine','task','wait',task_id]
-    subprocess.call(cmd)
-    
-    #Set year property of asset
-    string=''
-    if AD=='AD':
-        string = '(number)year='+str(year)
-    if AD=='BC':
-        string = '(number)year=-'+str(year)
-    cmd = ['earthengine', 'asset', 'set', '-p', string, asset_id]
-    subprocess.call(cmd)
-    
-    #Set no data value property of asset
-    string = '(number)no_data_value='+str(NDV)
-    cmd = ['earthengine', 'asset', 'set', '-p', string, asset_id]
-    subprocess.call(cmd)
-    
-    #Remove tiff from google cloud bucket
-    cmd = ['gsutil','rm',GS_BUCKET+TEMP_FILE_NAME.format(year=year,AD=AD)]
-    subprocess.call(cmd)
-    return task_id
+#Commands used to stage files and ingest assets, assets are ingested from manifests that hold their properties
+if LOCAL_BUCKET_DIR is not None:
+    COMMANDS = LocalCommands(LOCAL_BUCKET_DIR)
+else:
+    COMMANDS = CloudCommands(GS_BUCKET)
+#Ingestion tasks are followed in the background, each staged file is removed once its task completes
+TRACKER = TaskTracker(COMMANDS,MAX_TASKS_IN_FLIGHT)
+#Content hashes of ingested years
+LEDGER = AssetLedger(LEDGER_FILENAME,force=not SKIP_UNCHANGED)
+#Stage of each year of this run
+JOBS = JobLedger(JOBS_FILENAME,RUN_ID)
+#Follow the tasks that were ingesting when the run stopped, and ingest the years that were staged
+JOBS.resume(TRACKER,lambda job: LEDGER.recorder(job['asset_id'],job['content_hash'],job['manifest']))
+#Start downloading the zips of the years that are not converted yet in the background
+DOWNLOADS = DownloadManager(MIRROR_DIR,NUM_DOWNLOADS)
+DOWNLOADS.prefetch([URL.format(filename=DOWNLOAD_NAME.format(year=year,AD=AD)) for year in YEARS if not JOBS.reached(year,'converted')])
 
 #Initialize NDV variable, it is always set to -9999.0 but I read it in from the ascii grid file later anyway
 NDV= -9999.0
@@ -155,18 +172,15 @@ task_ids = ['']*len(YEARS)
 
 #For each year
 for i,year in enumerate(YEARS):
+    #Years that were staged, ingesting, or done when the run stopped were resumed above
+    if JOBS.reached(year,'staged'):
+        task_ids[i] = JOBS.get(year)['task_id']
+        continue
     #Start upload task
     task_ids[i],NDV = start_task(year,AD)
-    #If pause for overload is set to true, every NUM_ASSETS_AT_ONCE timesteps, wait for all tasks to finish and remove files from gsutil
-    if PAUSE_FOR_OVERLOAD:
-        if i% NUM_ASSETS_AT_ONCE == 0:
-            #Wait for all tasks to finish
-            cmd = ['earthengine','task','wait','all']
-            subprocess.call(cmd)
-            #Remove tiffs from google cloud bucket
-            cmd = ['gsutil','-m','rm',GS_BUCKET+'*']
-            subprocess.call(cmd)
-
-#Add properties
-for i,year in enumerate(YEARS):
-    add_properties(task_ids[i],year,AD,NDV)
+
+#Properties were set by the manifests, wait for the last tasks to complete (and be recorded in the ledger)
+TRACKER.finish()
+LEDGER.close()
+JOBS.close()
+DOWNLOADS.close()
\ No newline at end of file
@@ -9,8 +9,14 @@ from matplotlib import pyplot as plt
 import datetime
 import logging
 import subprocess
-import urllib.request
 import zipfile
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from common.upload_pipeline import CloudCommands, LocalCommands
+from common.ingestion import get_image_manifest
+from common.task_tracker import TaskTracker
+from common.asset_ledger import AssetLedger, hash_files
+from common.job_ledger import JobLedger
+from common.downloads import DownloadManager
 
 #The purpose of this code is to upload data from HYDE 3.2 land use to google earth engine
 #Ascii grids are downloaded, converted to geotiffs, and uploaded to google earth engine
@@ -47,8 +53,21 @@ FOLDER_NAME = '{year}{AD}_lu'
 FILE_NAME = '{varname}{year}{AD}.asc'
 TEMP_FILE_NAME = 'temp_lu_{varname}{year}{AD}.tif'
 
-PAUSE_FOR_OVERLOAD = True
-NUM_ASSETS_AT_ONCE = 50
+#Most ingestion tasks in flight at once, fewer when the task quota is reached (see common/task_tracker.py)
+MAX_TASKS_IN_FLIGHT = 50
+#If a local bucket folder is given, files are copied there instead of to google cloud and earth engine (for testing)
+LOCAL_BUCKET_DIR = None
+#If skip unchanged is set to true, years whose ascii grids and properties have the same content hash as when they were
+#   last ingested are not converted, staged, or ingested again (see common/asset_ledger.py)
+SKIP_UNCHANGED = True
+LEDGER_FILENAME = DATA_DIR+'upload_ledger.sqlite'
+#The stage of each year of a run is kept in this job ledger so a run that stops can be started again where it stopped,
+#   runs with different run ids (e.g. AD and BC, land use and population) can share it (see common/job_ledger.py)
+JOBS_FILENAME = DATA_DIR+'upload_jobs.sqlite'
+#Zips are downloaded into this mirror, shared by the HYDE scripts, so each zip is only downloaded once
+#   (see common/downloads.py), at most NUM_DOWNLOADS at once
+MIRROR_DIR = DATA_DIR+'hyde_mirror/'
+NUM_DOWNLOADS = 4
 
 VARIABLES = ['cropland', 'grazing', 'pasture', 'rangeland', 'conv_rangeland','ir_rice', 'rf_rice', 'ir_norice', 'rf_norice', 'tot_irri', 'tot_rainfed','tot_rice']
 
@@ -57,21 +76,19 @@ VARIABLES = ['cropland', 'grazing', 'pasture', 'rangeland', 'conv_rangeland','ir
 #       And by replacing AD='BC' below to AD='AD'
 AD = 'BC'
 YEARS= BC_YEARS
+#Name of this run in the job ledger
+RUN_ID = 'hyde_landuse_'+AD
 
 
 def download_files(year,AD):
     '''
-    Function to download files from HYDE's FTP
+    Function to download files from HYDE's FTP, the zip is kept in the local mirror so it is only downloaded once
     '''
     download_name = DOWNLOAD_NAME.format(year=year,AD=AD)
-    try:
-        urllib.request.urlretrieve(URL.format(filename=download_name), DATA_DIR+download_name)
-    except:
-        urllib.request.urlretrieve(URL.format(filename=download_name), DATA_DIR+download_name,timeout=600)
-    #Extract file from zipped file
-    zip_file = zipfile.ZipFile(DATA_DIR+download_name)
-    zip_file.extractall(DATA_DIR)
-    os.remove(DATA_DIR+download_name)
+    zip_path = DOWNLOADS.fetch(URL.format(filename=download_name))
+    #Extract file from zipped file, the zip stays in the mirror
+    with zipfile.ZipFile(zip_path) as zip_file:
+        zip_file.extractall(DATA_DIR)
     return 'hey!'
     
 def convert_ascii_to_tif(year,AD,varname):
@@ -118,76 +135,72 @@ def combine_tiffs(year,AD,NDV,varnames=VARIABLES,DATA_DIR=DATA_DIR):
         os.remove(var_fnames[i])
     return None
 
-def upload_asset(year,AD,NDV,DATA_DIR=DATA_DIR,EE_COLLECTION=EE_COLLECTION,GS_BUCKET=GS_BUCKET,VARIABLES=VARIABLES):
+def get_ascii_files(year,AD):
     '''
-    Function to upload geotiffs as images
+    Function to get the names of the ascii grids of a year
+    '''
+    return [DATA_DIR+FILE_NAME.format(varname=varname,year=year,AD=AD) for varname in VARIABLES]
+
+def get_content_hash(year,AD):
+    '''
+    Function to get the content hash of the ascii grids of a year and its properties, returns the asset id and content hash
     '''
-    #Upload geotiff to staging bucket
-    TEMP_FILE_NAME = 'temp_lu_{year}{AD}.tif'
-    cmd = ['gsutil','-m','cp',DATA_DIR+TEMP_FILE_NAME.format(year=year,AD=AD),GS_BUCKET]
-    subprocess.call(cmd)
-    
-    #Remove local file as well
-    os.remove(DATA_DIR+TEMP_FILE_NAME.format(year=year,AD=AD))
-    
-    #Get asset id 
     asset_id = EE_COLLECTION+'/'+'LandUse_'+str(year)+AD
-    
-    #Get band names
-    bands = ','.join(VARIABLES)
-    print(bands)
-    
-    #Upload GeoTIFF from google storage bucket to earth engine
-    cmd = ['earthengine','upload','image','--asset_id='+asset_id,'--force','--nodata_value='+str(NDV),'--bands='+bands,GS_BUCKET+TEMP_FILE_NAME.format(year=year,AD=AD)]
-    
-    shell_output = subprocess.check_output(cmd)
-    shell_output = shell_output.decode("utf-8")
-    print(shell_output)
-    
-    #Get task id
-    task_id = ''
-    if 'Started upload task with ID' in shell_output:
-        task_id = shell_output.split(': ')[1]
-        task_id = task_id.strip()
-    else:
-        print('Something went wrong!')
-        task_id='ERROR'
-    return task_id,NDV
+    return asset_id, hash_files(get_ascii_files(year,AD),{'asset_id':asset_id,'bands':VARIABLES,'year':-year if AD=='BC' else year})
 
+def remove_ascii_files(year,AD):
+    '''
+    Function to remove the ascii grids of a year that is not converted
+    '''
+    for filename in get_ascii_files(year,AD):
+        os.remove(filename)
 
-def add_properties(task_id,year,AD,NDV):
+def upload_asset(year,AD,NDV,DATA_DIR=DATA_DIR,EE_COLLECTION=EE_COLLECTION,VARIABLES=VARIABLES,content_hash=None):
     '''
-    Function to add properties to assets
+    Function to upload geotiffs as images, the year and no data value properties are set by the upload manifest
+    If a content hash is given, the year is recorded in the ledger once its task has completed
     '''
-    #Get filename in bucket
+    #Upload geotiff to staging bucket
     TEMP_FILE_NAME = 'temp_lu_{year}{AD}.tif'
-    #Get asset id
-    asset_id = EE_COLLECTION+'/'+'LandUse_'+str(year)+AD
+    staged = COMMANDS.stage(DATA_DIR+TEMP_FILE_NAME.format(year=year,AD=AD))
     
-    #Wait for task to finish
-    cmd = ['earthengine','task','wait',task_id]
-    subprocess.call(cmd)
+    #Get asset id 
+    asset_id = EE_COLLECTION+'/'+'LandUse_'+str(year)+AD
     
-    #Set year property of asset
-    string=''
-    if AD=='AD':
-        string = '(number)year='+str(year)
+    #Set year property of asset, BC years are negative
     if AD=='BC':
-        string = '(number)year=-'+str(year)
-    cmd = ['earthengine', 'asset', 'set', '-p', string, asset_id]
-    subprocess.call(cmd)
+        properties = {'year':-year,'no_data_value':NDV}
+    else:
+        properties = {'year':year,'no_data_value':NDV}
     
-    #Set no data value property of asset
-    string = '(number)no_data_value='+str(NDV)
-    cmd = ['earthengine', 'asset', 'set', '-p', string, asset_id]
-    subprocess.call(cmd)
+    #Ingest GeoTIFF from google storage bucket to earth engine
+    #The job ledger keeps the staged file, manifest, and task id so the task can be followed after a restart
+    manifest = get_image_manifest(asset_id,staged,VARIABLES,NDV,properties=properties)
+    task_id = JOBS.ingest(year,TRACKER,staged,manifest,asset_id,content_hash,LEDGER.recorder(asset_id,content_hash,manifest))
     
-    #Remove tiff from google cloud bucket
-    cmd = ['gsutil','rm',GS_BUCKET+TEMP_FILE_NAME.format(year=year,AD=AD)]
-    subprocess.call(cmd)
-    return task_id
+    #Remove local file as well
+    os.remove(DATA_DIR+TEMP_FILE_NAME.format(year=year,AD=AD))
+    print('Started upload of {asset_id}: {task_id}'.format(asset_id=asset_id,task_id=task_id))
+    return task_id,NDV
 
 
+#Commands used to stage files and ingest assets, assets are ingested from manifests that hold their properties
+if LOCAL_BUCKET_DIR is not None:
+    COMMANDS = LocalCommands(LOCAL_BUCKET_DIR)
+else:
+    COMMANDS = CloudCommands(GS_BUCKET)
+#Ingestion tasks are followed in the background, each staged file is removed once its task completes
+TRACKER = TaskTracker(COMMANDS,MAX_TASKS_IN_FLIGHT)
+#Content hashes of ingested years
+LEDGER = AssetLedger(LEDGER_FILENAME,force=not SKIP_UNCHANGED)
+#Stage of each year of this run
+JOBS = JobLedger(JOBS_FILENAME,RUN_ID)
+#Follow the tasks that were ingesting when the run stopped, and ingest the years that were staged
+JOBS.resume(TRACKER,lambda job: LEDGER.recorder(job['asset_id'],job['content_hash'],job['manifest']))
+#Start downloading the zips of the years that are not converted yet in the background
+DOWNLOADS = DownloadManager(MIRROR_DIR,NUM_DOWNLOADS)
+DOWNLOADS.prefetch([URL.format(filename=DOWNLOAD_NAME.format(year=year,AD=AD)) for year in YEARS if not JOBS.reached(year,'converted')])
+
 #Initialize NDV variable, it is always set to -9999.0 but I read it in from the ascii grid file later anyway
 NDV= -9999.0
 #Create empty array for task id's
@@ -195,26 +208,44 @@ task_ids = ['']*len(YEARS)
 
 #For each year
 for i,year in enumerate(YEARS):
-    #Download files
-    download_files(year,AD)
-    NDV_array = np.zeros(len(VARIABLES))
-    #Convert from ascii text to geotiff
-    for j,var in enumerate(VARIABLES):
-        NDV_array[j] = convert_ascii_to_tif(year,AD,var)
-    print(np.unique(NDV_array))
-    NDV = np.unique(NDV_array)[0]
-    #Combine multiple geotiffs to one geotiff with multiple bands
-    combine_tiffs(year,AD,NDV)
+    #Years that were staged, ingesting, or done when the run stopped were resumed above
+    job = JOBS.get(year)
+    if JOBS.reached(year,'staged'):
+        task_ids[i] = job['task_id']
+        continue
+    combined = DATA_DIR+'temp_lu_{year}{AD}.tif'.format(year=year,AD=AD)
+    if JOBS.reached(year,'converted') and os.path.exists(combined):
+        #Pick up from the geotiff that was converted before the run stopped
+        content_hash = job['content_hash']
+        with rasterio.open(combined) as src:
+            NDV = src.nodata
+    else:
+        #Download files, unless they were downloaded before the run stopped
+        if not (JOBS.reached(year,'downloaded') and all(os.path.exists(filename) for filename in get_ascii_files(year,AD))):
+            download_files(year,AD)
+            JOBS.set_stage(year,'downloaded',reset=True)
+        #Skip the year if its ascii grids have not changed since it was ingested
+        asset_id, content_hash = get_content_hash(year,AD)
+        if LEDGER.is_current(asset_id,content_hash):
+            print('Skipped unchanged year: {year} {AD}'.format(year=year,AD=AD))
+            remove_ascii_files(year,AD)
+            JOBS.set_stage(year,'done',asset_id,content_hash)
+            task_ids[i] = None
+            continue
+        NDV_array = np.zeros(len(VARIABLES))
+        #Convert from ascii text to geotiff
+        for j,var in enumerate(VARIABLES):
+            NDV_array[j] = convert_ascii_to_tif(year,AD,var)
+        print(np.unique(NDV_array))
+        NDV = np.unique(NDV_array)[0]
+        #Combine multiple geotiffs to one geotiff with multiple bands
+        combine_tiffs(year,AD,NDV)
+        JOBS.set_stage(year,'converted',asset_id,content_hash)
     #Uplaod asset
-    task_ids[i],NDV = upload_asset(year,AD,NDV)
-    if PAUSE_FOR_OVERLOAD:
-        if i% NUM_ASSETS_AT_ONCE == 0:
-            #Wait for all tasks to finish
-            cmd = ['earthengine','task','wait','all']
-            subprocess.call(cmd)
-            #Remove tiffs from google cloud bucket
-            cmd = ['gsutil','-m','rm',GS_BUCKET+'*']
-            subprocess.call(cmd)
-#Add properties
-for i,year in enumerate(YEARS):
-    task_id = add_properties(task_ids[i],year,AD,NDV)
+    task_ids[i],NDV = upload_asset(year,AD,NDV,content_hash=content_hash)
+
+#Properties were set by the manifests, wait for the last tasks to complete (and be recorded in the ledger)
+TRACKER.finish()
+LEDGER.close()
+JOBS.close()
+DOWNLOADS.close()
\ No newline at end of file
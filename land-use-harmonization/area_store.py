@@ -0,0 +1,120 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+#The purpose of this code is to keep the area tables of every year in one columnar store instead of one csv per year
+#Each table is long format, one row per year, key (OBJECTID, or Biome and Realm), class, and area, in Parquet files
+#   partitioned by year (table/year=850/part-0.parquet), so a reader only opens the years it asks for
+#Names (classes, biomes, realms) are dictionary-encoded so each string is stored once per file
+#Ecoregion names and attributes are kept in their own table and joined on OBJECTID when a wide table is asked for
+#Totals are not stored, they are found from the areas when read, percent tables are stored as their own tables
+#   with a percent value column
+
+COMPRESSION = 'zstd'
+
+
+def to_long(df,id_columns,class_columns,value='area'):
+    '''
+    Function to turn a wide table (one column per class) into the long format of the store
+    '''
+    long_df = df.melt(id_vars=list(id_columns),value_vars=list(class_columns),var_name='class',value_name=value)
+    long_df['class'] = pd.Categorical(long_df['class'],categories=list(class_columns))
+    for column in id_columns:
+        if long_df[column].dtype == object:
+            long_df[column] = long_df[column].astype('category')
+    return long_df
+
+def _write_parquet(filename,df):
+    '''
+    Writes a dataframe to a temporary file and moves it into place so readers never see half a file
+    '''
+    directory = os.path.dirname(filename)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    temp_filename = filename+'.{pid}.tmp'.format(pid=os.getpid())
+    pq.write_table(pa.Table.from_pandas(df,preserve_index=False),temp_filename,compression=COMPRESSION)
+    os.replace(temp_filename,filename)
+    return filename
+
+def get_year_filename(store_dir,table,year):
+    '''
+    Function to get the file holding one year of a table
+    '''
+    return os.path.join(store_dir,table,'year={year}'.format(year=int(year)),'part-0.parquet')
+
+def write_year(store_dir,table,year,long_df):
+    '''
+    Function to write (or replace) one year of a table, long_df should not have a year column
+    '''
+    return _write_parquet(get_year_filename(store_dir,table,year),long_df.drop(columns=['year'],errors='ignore'))
+
+def write_attributes(store_dir,table,df):
+    '''
+    Function to write a table that does not change by year (the ecoregion names, biomes and realms)
+    '''
+    df = df.copy()
+    for column in df.columns:
+        if df[column].dtype == object:
+            df[column] = df[column].astype('category')
+    return _write_parquet(os.path.join(store_dir,table+'.parquet'),df)
+
+def read_attributes(store_dir,table):
+    '''
+    Function to read a table written by write_attributes
+    '''
+    return pd.read_parquet(os.path.join(store_dir,table+'.parquet'))
+
+def list_years(store_dir,table):
+    '''
+    Function to list the years a table has
+    '''
+    table_dir = os.path.join(store_dir,table)
+    if not os.path.exists(table_dir):
+        return []
+    return sorted(int(name.split('=')[1]) for name in os.listdir(table_dir) if name.startswith('year='))
+
+def read_table(store_dir,table,years=None,classes=None,columns=None):
+    '''
+    Function to read a table in long format, only the files of the requested years and the requested columns are read
+    '''
+    dataset = ds.dataset(os.path.join(store_dir,table),format='parquet',partitioning='hive')
+    filters = None
+    if years is not None:
+        filters = ds.field('year').isin([int(year) for year in years])
+    if classes is not None:
+        class_filter = ds.field('class').isin(list(classes))
+        filters = class_filter if filters is None else filters & class_filter
+    if columns is not None:
+        columns = ['year']+[column for column in columns if column != 'year']
+    return dataset.to_table(columns=columns,filter=filters).to_pandas()
+
+def read_wide(store_dir,table,id_columns,years=None,classes=None,value='area',attributes=None,percent=False):
+    '''
+    Function to read a table back in the wide format of the per-year csvs, one column per class plus Year and Total
+    attributes is a dataframe joined on the id columns (e.g. the ecoregion names for OBJECTID)
+    If percent is set to true, classes are given as the fraction of Total (0 where Total is 0) like the percent csvs
+    Total is only added for area tables, tables with other values (e.g. value='percent') are read as they are stored
+    '''
+    id_columns = list(id_columns)
+    long_df = read_table(store_dir,table,years,classes,id_columns+['class',value])
+    class_names = [name for name in long_df['class'].cat.categories if classes is None or name in classes]
+    long_df['class'] = long_df['class'].astype(str)
+    for column in id_columns:
+        if isinstance(long_df[column].dtype,pd.CategoricalDtype):
+            long_df[column] = long_df[column].astype(str)
+    wide = long_df.pivot_table(index=['year']+id_columns,columns='class',values=value,aggfunc='sum',observed=True)
+    wide = wide.reindex(columns=class_names).reset_index().rename(columns={'year':'Year'})
+    wide = wide[id_columns+['Year']+class_names]
+    wide.columns.name = None
+    if value == 'area':
+        wide['Total'] = wide[class_names].sum(axis=1)
+        if percent:
+            total = wide['Total'].values
+            for name in class_names:
+                wide[name] = np.divide(wide[name].values,total,out=np.zeros(len(total)),where=total!=0)
+    if attributes is not None:
+        wide = attributes.merge(wide,on=id_columns,how='right')
+    return wide
@@ -0,0 +1,89 @@
+import multiprocessing
+import numpy as np
+import shapely
+from shapely import wkb
+
+#The purpose of this code is to find the fraction of each grid cell that is covered by each ecoregion
+#Works for any regular latitude/longitude grid given by its cell centers (the 0.25 degree LUH grid, the 5' HYDE grid)
+#Only cells in the bounding box of an ecoregion are tested, and a spatial index of those cells finds the ones that
+#   are inside the polygon (fraction of 1) or on its edge (fraction from the intersection area)
+#Ecoregions are spread over a pool of processes and the result is one sparse set of (OBJECTID, cell, fraction) entries
+
+
+def get_window(lat,lon,bounds):
+    '''
+    Function to get the rows and columns of the grid whose cells overlap a bounding box
+    '''
+    minx, miny, maxx, maxy = bounds
+    xres = abs(lon[1]-lon[0])
+    yres = abs(lat[1]-lat[0])
+    rows = np.flatnonzero((lat+yres/2.0 > miny) & (lat-yres/2.0 < maxy))
+    cols = np.flatnonzero((lon+xres/2.0 > minx) & (lon-xres/2.0 < maxx))
+    return rows, cols, xres, yres
+
+def get_cell_fractions(geometry,lat,lon):
+    '''
+    Function to get the flat index (row*len(lon)+col) of every cell touched by a geometry and the fraction of the cell it covers
+    Fractions are planar in degrees, within one cell the change in area with latitude is negligible
+    '''
+    rows, cols, xres, yres = get_window(lat,lon,geometry.bounds)
+    if len(rows) == 0 or len(cols) == 0:
+        return np.zeros(0,dtype=np.int64), np.zeros(0,dtype=np.float32)
+    #Boxes for the cells in the bounding box
+    row_grid, col_grid = np.meshgrid(rows,cols,indexing='ij')
+    row_grid = row_grid.ravel()
+    col_grid = col_grid.ravel()
+    boxes = shapely.box(lon[col_grid]-xres/2.0,lat[row_grid]-yres/2.0,lon[col_grid]+xres/2.0,lat[row_grid]+yres/2.0)
+    tree = shapely.STRtree(boxes)
+    fractions = np.zeros(len(boxes))
+    #Parts of a multipolygon do not overlap so their fractions add up
+    for part in shapely.get_parts(geometry):
+        touching = tree.query(part,predicate='intersects')
+        if len(touching) == 0:
+            continue
+        inside = tree.query(part,predicate='contains')
+        fractions[inside] = fractions[inside]+1.0
+        edge = np.setdiff1d(touching,inside)
+        fractions[edge] = fractions[edge]+shapely.area(shapely.intersection(boxes[edge],part))/(xres*yres)
+    keep = fractions > 0
+    cells = row_grid[keep].astype(np.int64)*len(lon)+col_grid[keep]
+    return cells, np.minimum(fractions[keep],1.0).astype(np.float32)
+
+def _fractions_worker(args):
+    '''
+    Worker for the process pool, geometries are passed as WKB so they pickle cheaply
+    '''
+    obj_id, geometry_wkb, lat, lon = args
+    cells, fractions = get_cell_fractions(wkb.loads(geometry_wkb),lat,lon)
+    return obj_id, cells, fractions
+
+def get_fractions(shapefile,lat,lon,num_processes=None,skip_ids=(207,)):
+    '''
+    Function to get the cell fractions of every ecoregion in a shapefile using a process pool
+    Returns flat arrays of OBJECTID, cell index and fraction with one entry per ecoregion and cell pair
+    '''
+    tasks = []
+    for index,row in shapefile.iterrows():
+        obj_id = int(row['OBJECTID'])
+        if obj_id not in skip_ids and row['geometry'] is not None:
+            tasks.append((obj_id,row['geometry'],lat,lon))
+    #Start the largest ecoregions first so the pool stays busy to the end
+    tasks.sort(key=lambda task: task[1].area,reverse=True)
+    tasks = [(obj_id,geometry.wkb,lat,lon) for obj_id,geometry,lat,lon in tasks]
+    entry_ids = []
+    entry_cells = []
+    entry_fractions = []
+    pool = multiprocessing.Pool(num_processes)
+    try:
+        for obj_id, cells, fractions in pool.imap_unordered(_fractions_worker,tasks):
+            print('ID: {ID}, cells: {num}'.format(ID=obj_id,num=len(cells)))
+            entry_ids.append(np.full(len(cells),obj_id,dtype=np.int16))
+            entry_cells.append(cells.astype(np.int32))
+            entry_fractions.append(fractions)
+    finally:
+        pool.close()
+        pool.join()
+    #No ecoregions to run (e.g. an empty or filtered shapefile) gives no entries
+    if len(entry_ids) == 0:
+        return np.zeros(0,dtype=np.int16), np.zeros(0,dtype=np.int32), np.zeros(0,dtype=np.float32)
+    return np.concatenate(entry_ids), np.concatenate(entry_cells), np.concatenate(entry_fractions)
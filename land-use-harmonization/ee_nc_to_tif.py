@@ -9,6 +9,14 @@ from matplotlib import pyplot as plt
 import datetime
 import logging
 import subprocess
+from luh_reader import LUHReader
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from common.upload_pipeline import CloudCommands, LocalCommands, run_pipeline
+from common.ingestion import get_image_manifest
+from common.task_tracker import TaskTracker
+from common.asset_ledger import AssetLedger, hash_arrays
+from common.job_ledger import JobLedger
+from geotiff_writer import write_geotiff
 
 #The purpose of this code is to upload data from Land-Use Harmonization version 2 to google earth engine
 #The original netcdf's are converted to geotiffs and uploaded to earth engine
@@ -26,7 +34,8 @@ import subprocess
 #> earthengine acl set public (collection name)
 
 #EE_FOLDER = 'users/resourcewatchlandcover/LandUseHarmonization/Historical/Baseline'
-EE_FOLDER = 'LandUseHarmonization/Projection/REMINDMAGPIE'
+#Asset ids must be absolute (users/... or projects/...) to be used in upload manifests
+EE_FOLDER = 'users/resourcewatchlandcover/LandUseHarmonization/Projection/REMINDMAGPIE'
 EE_COLLECTION = EE_FOLDER+ '/States'
 GS_FOLDER = 'LandUseHarmonization'
 GS_BUCKET = 'gs://upload_bucket/'
@@ -39,7 +48,36 @@ META_VARIABLE = 'primf'
 
 PAUSE_FOR_OVERLOAD = True
 NUM_ASSETS_AT_ONCE = 50
+#Most ingestion tasks in flight at once, fewer when the task quota is reached (see common/task_tracker.py)
+MAX_TASKS_IN_FLIGHT = 50
 START_YEAR = 2015
+#Number of years read from the netCDF at once
+BLOCK_SIZE = 50
+#Number of years read at once by the pipeline, one year of states is about 58 MB as float32, so a block stays small
+#   next to the years waiting in the queues of the pipeline
+PIPELINE_BLOCK_SIZE = 5
+#Compression of the uploaded geotiffs, see geotiff_writer.py
+COMPRESSION = 'DEFLATE'
+#If float32 is set to true, states are uploaded as float32 like they are stored in the netCDF instead of float64
+FLOAT32 = True
+#If pipeline is set to true, reading, encoding, and staging and ingesting run at the same time in their own threads
+#   (see common/upload_pipeline.py) instead of one year after the other
+PIPELINE = True
+NUM_ENCODERS = 2
+NUM_PUBLISHERS = 4
+#Encoding waits while the local geotiffs waiting to be staged take more than this many bytes
+MAX_DISK_BYTES = 4*1024**3
+#If a local bucket folder is given, files are copied there instead of to google cloud and earth engine (for testing)
+LOCAL_BUCKET_DIR = None
+#If skip unchanged is set to true, years whose states and manifest have the same content hash as when they were
+#   last ingested are not encoded, staged, or ingested again (see common/asset_ledger.py)
+SKIP_UNCHANGED = True
+LEDGER_FILENAME = DATA_DIR+'upload_ledger.sqlite'
+#The stage of each year of a run is kept in this job ledger so a run that stops can be started again where it stopped,
+#   runs with different run ids can share it (see common/job_ledger.py)
+#Years that were not staged yet are read and encoded again, encoding is quick next to the ingestion
+JOBS_FILENAME = DATA_DIR+'upload_jobs.sqlite'
+RUN_ID = 'luh_states_'+EE_COLLECTION
 
 
 TARGET_YEARS = np.arange(2015,2101)#[850,1000]#,1200,1400,1600,1800,1900,2000,2015]
@@ -87,140 +125,179 @@ def GetnetCDFInfobyName(in_filename,var_name):
         return NDV, xsize, ysize, GeoT, Projection
         
         
-def GetnetCDFDataByName(in_filename,var_name,index=0):
-    '''
-    Reads data for a specified year from netCDF
-    '''
-    with nc.Dataset(in_filename) as src:
-        return src.variables[var_name][index,:,:]
-    
-    
-def create_geotiff(out_name,Array,NDV,xsize,ysize,GeoT,Projection):
-    """
-    Creates new GeoTiff from array
-    """
-    DataType = gdal_array.NumericTypeCodeToGDALTypeCode(Array.dtype)
-    if type(DataType)!=np.int:
-        if DataType.startswith('gdal.GDT_') == False:
-            DataType=eval('gdal.GDT_'+DataType)
-    NewFileName = out_name+'.tif'
-    num_bands = Array.shape[0]
-    
-    #create a driver
-    driver = gdal.GetDriverByName('GTiff')
-    DataSet = driver.Create(NewFileName, xsize, ysize, num_bands,DataType)
-    DataSet.SetGeoTransform(GeoT)
-    DataSet.SetProjection(Projection.ExportToWkt())
-    
-    #Write data to geotiff
-    for i in range(0,num_bands):
-        DataSet.GetRasterBand(i+1).WriteArray(Array[i])
-        DataSet.GetRasterBand(i+1).SetNoDataValue(NDV)
-    DataSet.FlushCache()
-    return NewFileName
-    
-    
 def formatDate(date):
     '''Format date as ms since last epoch'''
     if isinstance(date, int):
         return date
     seconds = (date - datetime.datetime.utcfromtimestamp(0)).total_seconds()
     return int(seconds * 1000)
+
+def iterYears(reader,years):
+    '''
+    Yields the year and states of each target year from blocks read from the netCDF
+    Each year is copied out of its block, so years waiting in the pipeline do not keep the whole block in memory
+    '''
+    for block_years, block in reader.iter_blocks(years,PIPELINE_BLOCK_SIZE):
+        for block_index, year in enumerate(block_years):
+            yield year, block[block_index].copy() if FLOAT32 else block[block_index].astype(np.float64)
+        #Free the block before the next one is read
+        del block
+
+def getManifest(year,staged):
+    '''
+    Returns the asset id and upload manifest of a year
+    '''
+    start_date = datetime.datetime(year=year,month=1,day=1)
+    end_date = datetime.datetime(year=year,month=12,day=31)
+    asset_id = EE_COLLECTION+'/'+'States_'+str(year)
+    return asset_id, get_image_manifest(asset_id,staged,VARIABLES,NDV,start_date,end_date,{'year':year,'no_data_value':NDV})
+
+def encodeYear(year,nc_data):
+    '''
+    Writes the geotiff of a year, returns the file name, or None if the year has not changed since it was ingested
+    '''
+    asset_id, manifest = getManifest(year,COMMANDS.get_staged('temp_'+str(year)+'.tif'))
+    content_hash = hash_arrays(nc_data,{'manifest':manifest,'compression':COMPRESSION,'float32':FLOAT32})
+    if LEDGER.is_current(asset_id,content_hash):
+        print('Skipped unchanged year: '+str(year))
+        JOBS.set_stage(year,'done',asset_id,content_hash)
+        return None
+    CONTENT_HASHES[year] = content_hash
+    return write_geotiff(DATA_DIR+'temp_'+str(year),nc_data,NDV,GeoT,Projection,VARIABLES,COMPRESSION,FLOAT32,resampling='AVERAGE')
+
+def publishYear(year,filename):
+    '''
+    Stages the geotiff of a year and starts its ingestion from a manifest with its properties, returns the task id
+    '''
+    staged = COMMANDS.stage(filename)
+    asset_id, manifest = getManifest(year,staged)
+    #The job ledger keeps the staged file, manifest, and task id so the task can be followed after a restart,
+    #   and the year is recorded in the asset ledger once its task has completed
+    content_hash = CONTENT_HASHES.pop(year)
+    task_id = JOBS.ingest(year,TRACKER,staged,manifest,asset_id,content_hash,LEDGER.recorder(asset_id,content_hash,manifest))
+    print('Started upload of {year}: {task_id}'.format(year=year,task_id=task_id))
+    return task_id
     
         
+#Commands used to stage files and ingest, wait for, and set properties of assets
+if LOCAL_BUCKET_DIR is not None:
+    COMMANDS = LocalCommands(LOCAL_BUCKET_DIR)
+else:
+    COMMANDS = CloudCommands(GS_BUCKET)
+
+#Ingestion tasks are followed in the background, each staged file is removed once its task completes
+TRACKER = TaskTracker(COMMANDS,MAX_TASKS_IN_FLIGHT)
+#Content hashes of ingested years, and of the years encoded in this run until they are published
+LEDGER = AssetLedger(LEDGER_FILENAME,force=not SKIP_UNCHANGED)
+CONTENT_HASHES = {}
+#Stage of each year of this run
+JOBS = JobLedger(JOBS_FILENAME,RUN_ID)
+
 #Get global metadata properties to be saved in properties of the image collection
 image_collection_properties = GetnetCDFGlobalMetaData(NC_FILENAME)
 
 #Set these metadata values as properties of the image collection
-for key, value in image_collection_properties.items():
-    string = key+'='+value
-    cmd = ['earthengine', 'asset', 'set', '-p', string, EE_COLLECTION]
-    subprocess.call(cmd)
+COMMANDS.set_properties(EE_COLLECTION,image_collection_properties)
     
 #Get metadata properties of the netcdf variables
 NDV, xsize, ysize, GeoT, Projection = GetnetCDFInfobyName(NC_FILENAME,META_VARIABLE)
     
-#Create empty list to save task ID's
-task_ids = ['']*len(TARGET_YEARS)
+if PIPELINE:
+    #Follow the tasks that were ingesting when the run stopped, and ingest the years that were staged
+    JOBS.resume(TRACKER,lambda job: LEDGER.recorder(job['asset_id'],job['content_hash'],job['manifest']))
+    years = [year for year in TARGET_YEARS if not JOBS.reached(year,'staged')]
+    #Open the netCDF once, years are read in the reader thread of the pipeline
+    reader = LUHReader(NC_FILENAME,VARIABLES,START_YEAR)
+    year_task_ids = run_pipeline(iterYears(reader,years),encodeYear,publishYear,NUM_ENCODERS,NUM_PUBLISHERS,max_disk_bytes=MAX_DISK_BYTES)
+    reader.close()
+    #Unchanged years that were skipped have no task id
+    print('Skipped {num} unchanged years'.format(num=list(year_task_ids.values()).count(None)))
+    #Properties were set by the manifests, wait for the last tasks to complete (and be recorded in the ledgers)
+    TRACKER.finish()
+    LEDGER.close()
+    JOBS.close()
+else:
+    #Create empty list to save task ID's
+    task_ids = ['']*len(TARGET_YEARS)
+    #Open the netCDF once and read blocks of years for all variables
+    reader = LUHReader(NC_FILENAME,VARIABLES,START_YEAR)
+    i = 0
+    #iterate over target years and upload geotiffs as images to earth engine
+    for block_years, block in reader.iter_blocks(TARGET_YEARS,BLOCK_SIZE):
+        for block_index, year in enumerate(block_years):
+            #print('Starting year: '+str(year))
 
-#iterate over target years and upload geotiffs as images to earth engine
-for i,year in enumerate(TARGET_YEARS):
-    #Get index for corresponding year to search through netCDF
-    year_index = year-START_YEAR
+            #Format start and end data in miliseconds since the epoch
+            start_date = datetime.datetime(year=year,month=1,day=1)
+            end_date = datetime.datetime(year=year,month=12,day=31)
+            start_date = formatDate(start_date)
+            end_date = formatDate(end_date)
 
-    #print('Starting year: '+str(year))
+            #Get data for variables from the block
+            nc_data = block[block_index] if FLOAT32 else block[block_index].astype(np.float64)
 
-    #Format start and end data in miliseconds since the epoch
-    start_date = datetime.datetime(year=year,month=1,day=1)
-    end_date = datetime.datetime(year=year,month=12,day=31)
-    start_date = formatDate(start_date)
-    end_date = formatDate(end_date)
+            #print('Got data for year: '+str(year))
 
-    #Get data for variables
-    nc_data = np.zeros((len(VARIABLES),ysize,xsize))
-    for var_index, var in enumerate(VARIABLES):
-        nc_data[var_index] = GetnetCDFDataByName(NC_FILENAME,var,index=year_index).data
+            #Create geotiff
+            write_geotiff(DATA_DIR+'temp_'+str(year),nc_data,NDV,GeoT,Projection,VARIABLES,COMPRESSION,FLOAT32,resampling='AVERAGE')
 
-    #print('Got data for year: '+str(year))
+            #print('Created GeoTIFF for year: '+str(year))
 
-    #Create geotiff
-    create_geotiff(DATA_DIR+'temp_'+str(year),nc_data,NDV, xsize, ysize, GeoT, Projection)
+            #Upload geotiff to staging bucket
+            cmd = ['gsutil','-m','cp',DATA_DIR+'temp_{year}.tif'.format(year=year),GS_BUCKET]
+            subprocess.call(cmd)
 
-    #print('Created GeoTIFF for year: '+str(year))
+            #Get asset id and format band names
+            asset_id = EE_COLLECTION+'/'+'States_'+str(year)
+            bands = ','.join(VARIABLES)
 
-    #Upload geotiff to staging bucket
-    cmd = ['gsutil','-m','cp',DATA_DIR+'temp_{year}.tif'.format(year=year),GS_BUCKET]
-    subprocess.call(cmd)
+            #Upload tiff from bucket to image on Earth Engine and get Task ID
+            cmd = ['earthengine','upload','image','--asset_id='+asset_id,'--force','--nodata_value='+str(NDV),'--time_start='+str(start_date),'--time_end='+str(end_date),'--bands='+bands,GS_BUCKET+'temp_{year}.tif'.format(year=year)]
+            shell_output = subprocess.check_output(cmd)
+            shell_output = shell_output.decode("utf-8")
+            print(shell_output)
+            #Get task id
+            if 'Started upload task with ID' in shell_output:
+                task_id = shell_output.split(': ')[1]
+                task_id = task_id.strip()
+                #Save task id to task id list
+                task_ids[i] = task_id
+            else:
+                print('Something went wrong!')
 
-    #Get asset id and format band names
-    asset_id = EE_COLLECTION+'/'+'States_'+str(year)
-    bands = ','.join(VARIABLES)
-
-    #Upload tiff from bucket to image on Earth Engine and get Task ID
-    cmd = ['earthengine','upload','image','--asset_id='+asset_id,'--force','--nodata_value='+str(NDV),'--time_start='+str(start_date),'--time_end='+str(end_date),'--bands='+bands,GS_BUCKET+'temp_{year}.tif'.format(year=year)]
-    shell_output = subprocess.check_output(cmd)
-    shell_output = shell_output.decode("utf-8")
-    print(shell_output)
-    #Get task id
-    if 'Started upload task with ID' in shell_output:
-        task_id = shell_output.split(': ')[1]
-        task_id = task_id.strip()
-        #Save task id to task id list
-        task_ids[i] = task_id
-    else:
-        print('Something went wrong!')
-
-    #print('Uploaded asset for year: '+str(year))
-
-    #Remove tiff from my folder
-    os.remove(DATA_DIR+'temp_{year}.tif'.format(year=year))
-
-    #If pause for overload is set to true, every NUM_ASSETS_AT_ONCE timesteps, wait for all tasks to finish and remove files from gsutil
-    if PAUSE_FOR_OVERLOAD:
-        if i% NUM_ASSETS_AT_ONCE == 0:
-            #Wait for all tasks to finish
-            cmd = ['earthengine','task','wait','all']
-            subprocess.call(cmd)
-            #Remove tiffs from google cloud bucket
-            cmd = ['gsutil','-m','rm',GS_BUCKET+'*']
-            subprocess.call(cmd)
+            #print('Uploaded asset for year: '+str(year))
 
-for i,year in enumerate(TARGET_YEARS):
-    asset_id = EE_COLLECTION+'/'+'States_'+str(year)
-    #earthengine task info TASK_ID
-    cmd = ['earthengine','task','wait',task_ids[i]]
-    subprocess.call(cmd)
-
-    #Set year property of asset
-    string = '(number)year='+str(year)
-    cmd = ['earthengine', 'asset', 'set', '-p', string, asset_id]
-    subprocess.call(cmd)
+            #Remove tiff from my folder
+            os.remove(DATA_DIR+'temp_{year}.tif'.format(year=year))
+
+            #If pause for overload is set to true, every NUM_ASSETS_AT_ONCE timesteps, wait for all tasks to finish and remove files from gsutil
+            if PAUSE_FOR_OVERLOAD:
+                if i% NUM_ASSETS_AT_ONCE == 0:
+                    #Wait for all tasks to finish
+                    cmd = ['earthengine','task','wait','all']
+                    subprocess.call(cmd)
+                    #Remove tiffs from google cloud bucket
+                    cmd = ['gsutil','-m','rm',GS_BUCKET+'*']
+                    subprocess.call(cmd)
+
+            i = i+1
+    reader.close()
+
+    for i,year in enumerate(TARGET_YEARS):
+        asset_id = EE_COLLECTION+'/'+'States_'+str(year)
+        #earthengine task info TASK_ID
+        COMMANDS.wait(task_ids[i])
+
+        #Set year property of asset
+        string = '(number)year='+str(year)
+        COMMANDS.set_property(asset_id,string)
     
-    #Set no data value property of asset
-    string = '(number)no_data_value='+str(NDV)
-    cmd = ['earthengine', 'asset', 'set', '-p', string, asset_id]
-    subprocess.call(cmd)
+        #Set no data value property of asset
+        string = '(number)no_data_value='+str(NDV)
+        COMMANDS.set_property(asset_id,string)
     
-    #Remove tiff from google cloud bucket
-    cmd = ['gsutil','rm',GS_BUCKET+'temp_{year}.tif'.format(year=year)]
-    subprocess.call(cmd)
+        #Remove tiff from google cloud bucket
+        COMMANDS.remove(COMMANDS.get_staged('temp_{year}.tif'.format(year=year)))
+
+    #The legacy loop does not keep jobs in the job ledger
+    JOBS.close()
\ No newline at end of file
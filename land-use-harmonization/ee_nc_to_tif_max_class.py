@@ -9,6 +9,15 @@ from matplotlib import pyplot as plt
 import datetime
 import logging
 import subprocess
+from luh_reader import LUHReader, split_years
+from geotiff_writer import write_geotiff
+from luh_classes import LUH_CLASSES, compile_weights, aggregate_classes
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from common.upload_pipeline import CloudCommands, LocalCommands
+from common.ingestion import get_image_manifest
+from common.task_tracker import TaskTracker
+from common.asset_ledger import AssetLedger, hash_arrays
+from common.job_ledger import JobLedger
 
 #The purpose of this code is to upload data from the Land-Use Harmonization version 2 to google earth engine
 #These rasters are categorized by the majority land cover class in that pixel
@@ -34,15 +43,47 @@ GS_BUCKET = 'gs://upload_bucket/'
 DATA_DIR = 'LUH_data/data/'
 NC_FILENAME = DATA_DIR+'REMIND_states.nc'
 START_YEAR = 2015
+#Number of years read from the netCDF at once
+BLOCK_SIZE = 50
 
 VARIABLES = ['urban','c3ann','c4ann','c3per','c4per','c3nfx','range','pastr','primf','secdf','primn','secdn']
-NEW_VARIABLES = ['urban','crops','range','pastr','forest','nonforest']
+#Classes that the variables are aggregated to
+CLASSES = LUH_CLASSES
+NEW_VARIABLES = list(CLASSES.keys())
+WEIGHTS = compile_weights(CLASSES,VARIABLES)
 META_VARIABLE = 'primf'
 
-PAUSE_FOR_OVERLOAD = True
-NUM_ASSETS_AT_ONCE = 50
+#If vectorized is set to true, the max class, ties, and all equal pixels are found with whole array operations
+#   instead of sorting every pixel in a python loop
+VECTORIZED = True
+#Class given to pixels where every class has the same (nonzero) coverage
+EQUAL_CLASS = len(NEW_VARIABLES)+1
+
+#Most ingestion tasks in flight at once, fewer when the task quota is reached (see common/task_tracker.py)
+MAX_TASKS_IN_FLIGHT = 50
 
 ASSET_ID = EE_COLLECTION+'/'+'Classes_REMIND_{year}'
+#If stack years is set to true, each block of years is written as one uint8 geotiff with a band per year
+#   and uploaded as one asset, instead of one float geotiff and asset per year
+STACK_YEARS = True
+STACK_ASSET_ID = EE_COLLECTION+'/'+'Classes_REMIND_{first_year}_{last_year}'
+#Classes fit in a byte, no data is stored as 255
+STACK_NDV = 255
+STACK_BAND_NAME = 'y{year}'
+#Compression of the uploaded geotiffs, see geotiff_writer.py
+COMPRESSION = 'DEFLATE'
+#If a local bucket folder is given, files are copied there instead of to google cloud and earth engine (for testing)
+LOCAL_BUCKET_DIR = None
+#If skip unchanged is set to true, assets whose classes and manifest have the same content hash as when they were
+#   last ingested are not encoded, staged, or ingested again (see common/asset_ledger.py)
+SKIP_UNCHANGED = True
+LEDGER_FILENAME = DATA_DIR+'upload_ledger.sqlite'
+#The stage of each year (or stack of years) of a run is kept in this job ledger so a run that stops can be started again
+#   where it stopped, runs with different run ids can share it (see common/job_ledger.py)
+#Years that were not staged yet are read and encoded again
+JOBS_FILENAME = DATA_DIR+'upload_jobs.sqlite'
+RUN_ID = 'luh_max_class_'+EE_COLLECTION
+STACK_ITEM = '{first_year}_{last_year}'
 
 #np.arange(850,2020,5)
 TARGET_YEARS = np.arange(2015,2101)
@@ -92,36 +133,41 @@ def GetnetCDFInfobyName(in_filename,var_name):
         
         
         
-def GetnetCDFDataByName(in_filename,var_name,index=0):
+def getMaxClass(nc_data,NDV):
     '''
-    Reads data for a specified year from netCDF
+    Finds the class with the highest coverage of each pixel, classes start at 1
+    Pixels where every class is equal get EQUAL_CLASS, 0 where every class has 0 coverage, and NDV where every class is no data
+    Returns the float max class array and the number of pixels where the top two classes tie
     '''
-    with nc.Dataset(in_filename) as src:
-        return src.variables[var_name][index,:,:]
-    
-    
-def create_geotiff(out_name,Array,NDV,xsize,ysize,GeoT,Projection):
-    """
-    Creates new GeoTiff from array
-    """
-    DataType = gdal_array.NumericTypeCodeToGDALTypeCode(Array.dtype)
-    if type(DataType)!=np.int:
-        if DataType.startswith('gdal.GDT_') == False:
-            DataType=eval('gdal.GDT_'+DataType)
-    NewFileName = out_name+'.tif'
-    #create a driver
-    driver = gdal.GetDriverByName('GTiff')
-    DataSet = driver.Create(NewFileName, xsize, ysize, 1,DataType)
-    DataSet.SetGeoTransform(GeoT)
-    DataSet.SetProjection(Projection.ExportToWkt())
-    
-    #Write data to geotiff
-    DataSet.GetRasterBand(1).WriteArray(Array)
-    DataSet.GetRasterBand(1).SetNoDataValue(NDV)
-    DataSet.FlushCache()
-    return NewFileName
-    
-    
+    #Set no data value to -1 so it is never the max class
+    nc_data = np.where(nc_data>=NDV,-1,nc_data)
+    #Argmax returns the first index when values are the same
+    nc_data_max = (np.argmax(nc_data,axis=0)+1).astype(float)
+    #Partition puts the largest value last and the second largest before it without sorting every pixel
+    top_two = np.partition(nc_data,-2,axis=0)[-2:]
+    first = top_two[1]
+    tie_index = (top_two[0]==first) & (first!=-1) & (first!=0)
+    #All classes are equal when the max equals the min
+    equal_index = first==np.min(nc_data,axis=0)
+    nc_data_max[equal_index] = EQUAL_CLASS
+    nc_data_max[equal_index & (first==0)] = 0
+    nc_data_max[equal_index & (first==-1)] = NDV
+    return nc_data_max, int(np.count_nonzero(tie_index))
+
+def getMaxClassStack(block_data,NDV,stack_ndv=STACK_NDV):
+    '''
+    Finds the max class of each year of a block (years,variables,lat,lon) as a uint8 stack (years,lat,lon)
+    Years are aggregated one at a time so only one year of float classes is held with the block
+    Returns the stack and the number of tied pixels in the block
+    '''
+    stack = np.empty((block_data.shape[0],)+block_data.shape[-2:],dtype=np.uint8)
+    count = 0
+    for block_index in range(block_data.shape[0]):
+        nc_data_max, year_count = getMaxClass(aggregate_classes(block_data[block_index],WEIGHTS,NDV),NDV)
+        stack[block_index] = np.where(nc_data_max==NDV,stack_ndv,nc_data_max)
+        count = count+year_count
+    return stack, count
+
 def formatDate(date):
     '''Format date as ms since last epoch'''
     if isinstance(date, int):
@@ -133,134 +179,149 @@ def formatDate(date):
 #Get metadata properties of the netcdf variables
 NDV, xsize, ysize, GeoT, Projection = GetnetCDFInfobyName(NC_FILENAME,META_VARIABLE)
     
+#Commands used to stage files and ingest assets, assets are ingested from manifests that hold their properties
+if LOCAL_BUCKET_DIR is not None:
+    COMMANDS = LocalCommands(LOCAL_BUCKET_DIR)
+else:
+    COMMANDS = CloudCommands(GS_BUCKET)
+#Ingestion tasks are followed in the background, each staged file is removed once its task completes
+TRACKER = TaskTracker(COMMANDS,MAX_TASKS_IN_FLIGHT)
+#Content hashes of ingested assets
+LEDGER = AssetLedger(LEDGER_FILENAME,force=not SKIP_UNCHANGED)
+#Stage of each year (or stack of years) of this run
+JOBS = JobLedger(JOBS_FILENAME,RUN_ID)
+#Follow the tasks that were ingesting when the run stopped, and ingest the years that were staged
+JOBS.resume(TRACKER,lambda job: LEDGER.recorder(job['asset_id'],job['content_hash'],job['manifest']))
+
 #Create empty list to save task ID's
 task_ids = ['']*len(TARGET_YEARS)
 overall_match_count = 0
+#Open the netCDF once and read blocks of years for all variables
+reader = LUHReader(NC_FILENAME,VARIABLES,START_YEAR)
+#Years (or stacks of years) that were staged, ingesting, or done when the run stopped were resumed above and are not read again
+if STACK_YEARS:
+    blocks = [block_years for block_years in split_years(TARGET_YEARS,BLOCK_SIZE)
+              if not JOBS.reached(STACK_ITEM.format(first_year=block_years[0],last_year=block_years[-1]),'staged')]
+else:
+    blocks = split_years([year for year in TARGET_YEARS if not JOBS.reached(year,'staged')],BLOCK_SIZE)
 # #iterate over target years and upload geotiffs as images to earth engine
-for i,year in enumerate(TARGET_YEARS):
-    #Get index for corresponding year to search through netCDF
-    year_index = year-START_YEAR
-
-    #print('Starting year: '+str(year))
-
-    #Format start and end data in miliseconds since the epoch
-    start_date = datetime.datetime(year=year,month=1,day=1)
-    end_date = datetime.datetime(year=year,month=12,day=31)
-    start_date = formatDate(start_date)
-    end_date = formatDate(end_date)
-
-    #Get data for variables and aggregate when necessary
-    nc_data = np.zeros((len(NEW_VARIABLES),ysize,xsize))
-    for var_index, var in enumerate(NEW_VARIABLES):
-        #If not in the aggregating variables (crops, forest, nonforest) just keep variable
-        temp_variables = [var]
-        #Otherwise aggregate
-        if var == 'crops':
-            temp_variables = ['c3ann','c4ann','c3per','c4per','c3nfx']
-        elif var == 'forest':
-            temp_variables = ['primf','secdf']
-        elif var == 'nonforest':
-            temp_variables = ['primn','secdn']
-        #"Aggregating"
-        for temp_var in temp_variables:
-            nc_data[var_index] = nc_data[var_index]+ GetnetCDFDataByName(NC_FILENAME,temp_var,index=year_index).data
-    
-    #Set no data value to -1 to find max class
-    nc_data[nc_data>=NDV] = -1
-    #Find which variable has the highest percent coverage of each of the variables
-    #Add 1 so that class values start at 1 instead of 0... class values are now 1,2,3,4,5,6
-    nc_data_max = np.argmax(nc_data,axis=0)+1
-    #Using numpy argmax, returns the index along the axis that has the highest value
-    #Argmax will return the first index if all values are the same
-    #Find where array has the same values across axis 0 (across the variables)
-    count=0
-    for k in np.arange(ysize):
-        for l in np.arange(xsize):
-            sorted_arr = np.sort(nc_data[:,k,l])
-            if sorted_arr[-1]==sorted_arr[-2] and sorted_arr[-1]!=-1 and sorted_arr[-1]!=0:
-                count=count+1
-                print(sorted_arr)
-    match_index = np.where((nc_data[0,:,:]==nc_data[1,:,:])& (nc_data[0,:,:]==nc_data[2,:,:]) & (nc_data[0,:,:]==nc_data[3,:,:]) & (nc_data[0,:,:] == nc_data[4,:,:])&\
-        (nc_data[0,:,:]==nc_data[5,:,:]) & (nc_data[1,:,:] == nc_data[2,:,:]) & (nc_data[1,:,:] == nc_data[3,:,:]) & (nc_data[1,:,:] == nc_data[4,:,:])&\
-        (nc_data[1,:,:]==nc_data[5,:,:]) & (nc_data[2,:,:] == nc_data[3,:,:]) & (nc_data[2,:,:] == nc_data[4,:,:]) & (nc_data[2,:,:] == nc_data[5,:,:])&\
-        (nc_data[3,:,:]==nc_data[4,:,:]) & (nc_data[3,:,:] == nc_data[5,:,:]) & (nc_data[4,:,:] == nc_data[5,:,:]),True,False)
-    #Create new class for when they're all equal, class value 7
-    nc_data_max[match_index] == 7
-    print(count)
-    overall_match_count = count+overall_match_count
-    #Find where all classes have 0 coverage
-    zero_index = np.where(nc_data[:,:,:]==0,True,False)
-    zero_index = np.all(zero_index,axis=0)
-    #Set those pixels to 0
-    nc_data_max[zero_index] = 0
-    
-    #Convert to float
-    nc_data_max = nc_data_max.astype(float)
-    
-    #Find where all classes have no data value
-    ndv_index = np.where(nc_data[:,:,:]==-1,True,False)
-    ndv_index = np.all(ndv_index,axis=0)
-    #Set those pixels to no data value (NDV)
-    nc_data_max[ndv_index] = NDV
-    
-    #Create geotiff
-    create_geotiff(DATA_DIR+'temp_'+str(year),nc_data_max,NDV, xsize, ysize, GeoT, Projection)
-
-    #print('Created GeoTIFF for year: '+str(year))
-
-    #Upload geotiff to staging bucket
-    cmd = ['gsutil','-m','cp',DATA_DIR+'temp_{year}.tif'.format(year=year),GS_BUCKET]
-    subprocess.call(cmd)
-
-    #Get asset id and format band names
-    asset_id = ASSET_ID.format(year=year)
-    bands = ','.join(VARIABLES)
-
-    #Upload tiff from bucket to image on Earth Engine and get Task ID
-    cmd = ['earthengine','upload','image','--asset_id='+asset_id,'--force','--time_start='+str(start_date),'--time_end='+str(end_date),'--pyramiding_policy=sample',GS_BUCKET+'temp_{year}.tif'.format(year=year)]
-    shell_output = subprocess.check_output(cmd)
-    shell_output = shell_output.decode("utf-8")
-    print(shell_output)
-    #Get task id
-    if 'Started upload task with ID' in shell_output:
-        task_id = shell_output.split(': ')[1]
-        task_id = task_id.strip()
-        #Save task id to task id list
-        task_ids[i] = task_id
-    else:
-        print('Something went wrong!')
-
-    #print('Uploaded asset for year: '+str(year))
-
-    #Remove tiff from my folder
-    os.remove(DATA_DIR+'temp_{year}.tif'.format(year=year))
-
-    #If pause for overload is set to true, every NUM_ASSETS_AT_ONCE timesteps, wait for all tasks to finish and remove files from gsutil
-    if PAUSE_FOR_OVERLOAD:
-        if i% NUM_ASSETS_AT_ONCE == 0 and i!=0:
-            #Wait for all tasks to finish
-            cmd = ['earthengine','task','wait','all']
-            subprocess.call(cmd)
-            #Remove tiffs from google cloud bucket
-            cmd = ['gsutil','-m','rm',GS_BUCKET+'*']
-            subprocess.call(cmd)
-
-for i,year in enumerate(TARGET_YEARS):
-    asset_id = ASSET_ID.format(year=year)
-    #earthengine task info TASK_ID
-    cmd = ['earthengine','task','wait',task_ids[i]]
-    subprocess.call(cmd)
-
-    #Set year property of asset
-    string = '(number)year='+str(year)
-    cmd = ['earthengine', 'asset', 'set', '-p', string, asset_id]
-    subprocess.call(cmd)
-
-    #Set no data value property of asset
-    string = '(number)no_data_value='+str(NDV)
-    cmd = ['earthengine', 'asset', 'set', '-p', string, asset_id]
-    subprocess.call(cmd)
-
-    #Remove tiff from google cloud bucket
-    cmd = ['gsutil','rm',GS_BUCKET+'temp_{year}.tif'.format(year=year)]
-    subprocess.call(cmd)
+for block_years in blocks:
+    block = reader.read_block(block_years[0],len(block_years))
+    if STACK_YEARS:
+        first_year = block_years[0]
+        last_year = block_years[-1]
+        item = STACK_ITEM.format(first_year=first_year,last_year=last_year)
+        class_stack, count = getMaxClassStack(block,NDV)
+        print(count)
+        overall_match_count = count+overall_match_count
+        temp_name = 'temp_{first_year}_{last_year}'.format(first_year=first_year,last_year=last_year)
+
+        #The stack covers the first day of the first year to the last day of the last year
+        start_date = datetime.datetime(year=first_year,month=1,day=1)
+        end_date = datetime.datetime(year=last_year,month=12,day=31)
+        asset_id = STACK_ASSET_ID.format(first_year=first_year,last_year=last_year)
+        bands = [STACK_BAND_NAME.format(year=year) for year in block_years]
+        properties = {'first_year':first_year,'last_year':last_year,'no_data_value':STACK_NDV}
+        manifest = get_image_manifest(asset_id,COMMANDS.get_staged(temp_name+'.tif'),bands,STACK_NDV,start_date,end_date,properties,'mode')
+
+        #Skip the stack if its classes and manifest have not changed since it was ingested
+        content_hash = hash_arrays(class_stack,{'manifest':manifest,'compression':COMPRESSION})
+        if LEDGER.is_current(asset_id,content_hash):
+            print('Skipped unchanged years: {first_year}-{last_year}'.format(first_year=first_year,last_year=last_year))
+            JOBS.set_stage(item,'done',asset_id,content_hash)
+            continue
+        write_geotiff(DATA_DIR+temp_name,class_stack,STACK_NDV,GeoT,Projection,bands,COMPRESSION,resampling='MODE')
+
+        #Upload geotiff to staging bucket, the job ledger keeps the staged file, manifest, and task id so the task can be
+        #   followed after a restart, and the stack is recorded in the asset ledger once its task has completed
+        staged = COMMANDS.stage(DATA_DIR+temp_name+'.tif')
+        task_id = JOBS.ingest(item,TRACKER,staged,manifest,asset_id,content_hash,LEDGER.recorder(asset_id,content_hash,manifest))
+        print('Started upload of {first_year}-{last_year}: {task_id}'.format(first_year=first_year,last_year=last_year,task_id=task_id))
+
+        #Remove tiff from my folder
+        os.remove(DATA_DIR+temp_name+'.tif')
+        continue
+    for block_index, year in enumerate(block_years):
+        #print('Starting year: '+str(year))
+        i = list(TARGET_YEARS).index(year)
+
+        start_date = datetime.datetime(year=year,month=1,day=1)
+        end_date = datetime.datetime(year=year,month=12,day=31)
+
+        #Aggregate variables to the new classes
+        nc_data = aggregate_classes(block[block_index],WEIGHTS,NDV)
+
+        if VECTORIZED:
+            nc_data_max, count = getMaxClass(nc_data,NDV)
+            print(count)
+            overall_match_count = count+overall_match_count
+        else:
+            #Set no data value to -1 to find max class
+            nc_data[nc_data>=NDV] = -1
+            #Find which variable has the highest percent coverage of each of the variables
+            #Add 1 so that class values start at 1 instead of 0... class values are now 1,2,3,4,5,6
+            nc_data_max = np.argmax(nc_data,axis=0)+1
+            #Using numpy argmax, returns the index along the axis that has the highest value
+            #Argmax will return the first index if all values are the same
+            #Find where array has the same values across axis 0 (across the variables)
+            count=0
+            for k in np.arange(ysize):
+                for l in np.arange(xsize):
+                    sorted_arr = np.sort(nc_data[:,k,l])
+                    if sorted_arr[-1]==sorted_arr[-2] and sorted_arr[-1]!=-1 and sorted_arr[-1]!=0:
+                        count=count+1
+                        print(sorted_arr)
+            match_index = np.where((nc_data[0,:,:]==nc_data[1,:,:])& (nc_data[0,:,:]==nc_data[2,:,:]) & (nc_data[0,:,:]==nc_data[3,:,:]) & (nc_data[0,:,:] == nc_data[4,:,:])&\
+                (nc_data[0,:,:]==nc_data[5,:,:]) & (nc_data[1,:,:] == nc_data[2,:,:]) & (nc_data[1,:,:] == nc_data[3,:,:]) & (nc_data[1,:,:] == nc_data[4,:,:])&\
+                (nc_data[1,:,:]==nc_data[5,:,:]) & (nc_data[2,:,:] == nc_data[3,:,:]) & (nc_data[2,:,:] == nc_data[4,:,:]) & (nc_data[2,:,:] == nc_data[5,:,:])&\
+                (nc_data[3,:,:]==nc_data[4,:,:]) & (nc_data[3,:,:] == nc_data[5,:,:]) & (nc_data[4,:,:] == nc_data[5,:,:]),True,False)
+            #Create new class for when they're all equal, class value 7
+            nc_data_max[match_index] = EQUAL_CLASS
+            print(count)
+            overall_match_count = count+overall_match_count
+            #Find where all classes have 0 coverage
+            zero_index = np.where(nc_data[:,:,:]==0,True,False)
+            zero_index = np.all(zero_index,axis=0)
+            #Set those pixels to 0
+            nc_data_max[zero_index] = 0
+
+            #Convert to float
+            nc_data_max = nc_data_max.astype(float)
+
+            #Find where all classes have no data value
+            ndv_index = np.where(nc_data[:,:,:]==-1,True,False)
+            ndv_index = np.all(ndv_index,axis=0)
+            #Set those pixels to no data value (NDV)
+            nc_data_max[ndv_index] = NDV
+
+        #Skip the year if its classes and manifest have not changed since it was ingested
+        asset_id = ASSET_ID.format(year=year)
+        manifest = get_image_manifest(asset_id,COMMANDS.get_staged('temp_{year}.tif'.format(year=year)),None,None,start_date,end_date,{'year':year,'no_data_value':NDV},'sample')
+        content_hash = hash_arrays(nc_data_max,{'manifest':manifest,'compression':COMPRESSION})
+        if LEDGER.is_current(asset_id,content_hash):
+            print('Skipped unchanged year: '+str(year))
+            JOBS.set_stage(year,'done',asset_id,content_hash)
+            task_ids[i] = None
+            continue
+
+        #Create geotiff
+        write_geotiff(DATA_DIR+'temp_'+str(year),nc_data_max,NDV,GeoT,Projection,compression=COMPRESSION)
+
+        #print('Created GeoTIFF for year: '+str(year))
+
+        #Upload geotiff to staging bucket
+        staged = COMMANDS.stage(DATA_DIR+'temp_{year}.tif'.format(year=year))
+
+        #Upload tiff from bucket to image on Earth Engine with its properties and get Task ID, the job ledger keeps the
+        #   staged file, manifest, and task id, and the year is recorded in the asset ledger once its task has completed
+        task_ids[i] = JOBS.ingest(year,TRACKER,staged,manifest,asset_id,content_hash,LEDGER.recorder(asset_id,content_hash,manifest))
+        print('Started upload of {year}: {task_id}'.format(year=year,task_id=task_ids[i]))
+
+        #Remove tiff from my folder
+        os.remove(DATA_DIR+'temp_{year}.tif'.format(year=year))
+reader.close()
+
+#Properties were set by the manifests, wait for the last tasks to complete (and be recorded in the ledger)
+TRACKER.finish()
+LEDGER.close()
+JOBS.close()
@@ -0,0 +1,44 @@
+import numpy as np
+import rasterio
+from rasterio.io import MemoryFile
+from rasterio.shutil import copy
+from affine import Affine
+
+#The purpose of this code is to write the geotiffs uploaded to earth engine as cloud optimized geotiffs
+#Bands are tiled and compressed losslessly with a predictor (floating point for float data, horizontal for integer data)
+#   using every core, and overviews are built into the file
+#The array is written to an in-memory geotiff and copied to the file with GDAL's COG driver
+
+#DEFLATE can be read everywhere, ZSTD is faster for the same size where GDAL is built with it
+COMPRESSION = 'DEFLATE'
+BLOCK_SIZE = 512
+NUM_THREADS = 'ALL_CPUS'
+
+
+def write_geotiff(out_name,Array,NDV,GeoT,Projection,band_names=None,compression=COMPRESSION,float32=False,overviews=True,resampling='NEAREST'):
+    '''
+    Function to write a (bands,ysize,xsize) or (ysize,xsize) array to out_name.tif as a cloud optimized geotiff
+    GeoT is a GDAL geotransform and Projection an osr SpatialReference or WKT string
+    If float32 is set to true, float data is written as float32
+    resampling is used for the overviews (e.g. NEAREST, AVERAGE, MODE)
+    Returns the file name
+    '''
+    if Array.ndim == 2:
+        Array = Array[np.newaxis]
+    if float32 and np.issubdtype(Array.dtype,np.floating):
+        Array = Array.astype(np.float32)
+    num_bands, ysize, xsize = Array.shape
+    if hasattr(Projection,'ExportToWkt'):
+        Projection = Projection.ExportToWkt()
+    NewFileName = out_name+'.tif'
+    #Band names and no data are kept in the tiff tags, not in a .aux.xml next to it
+    with rasterio.Env(GDAL_PAM_ENABLED='NO'):
+        with MemoryFile() as memfile:
+            with memfile.open(driver='GTiff',width=xsize,height=ysize,count=num_bands,dtype=Array.dtype,nodata=NDV,
+                              transform=Affine.from_gdal(*GeoT),crs=Projection) as DataSet:
+                DataSet.write(Array)
+                if band_names is not None:
+                    DataSet.descriptions = tuple(band_names)
+                copy(DataSet,NewFileName,driver='COG',compress=compression,predictor='YES',num_threads=NUM_THREADS,blocksize=BLOCK_SIZE,
+                     overviews='AUTO' if overviews else 'NONE',resampling=resampling)
+    return NewFileName
@@ -1,6 +1,12 @@
+import sys
+import os
 import numpy as np
 import pandas as pd
 from matplotlib import pyplot
+from area_store import to_long, write_year, read_table, read_wide, read_attributes
+#The rollup engine is shared with the ESA Land Cover scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from common.rollup import rollup
 
 pd.options.display.max_colwidth = 1000
 np.set_printoptions(suppress=True)
@@ -20,182 +26,289 @@ biome_realm_perc_csv = DATA_DIR+'luh_baseline_' + 'biome_realm_percent_{year}.cs
 biome_perc_csv = DATA_DIR+'luh_baseline_' + 'biome_percent_{year}.csv'
 realm_perc_csv = DATA_DIR+'luh_baseline_' + 'realm_percent_{year}.csv'
 
+#Input and output format, 'parquet' uses the columnar store of luh_get_ecoregion_coverage.py (see area_store.py), 'csv' the per-year csvs
+#Percent tables are kept in the store as their own tables with a percent column, read them with read_wide(...,value='percent')
+FORMAT = 'parquet'
+STORE_DIR = 'LUH_data/data/store/'
+AREA_TABLE = 'luh_baseline_ecoregion_area'
+ATTRIBUTES_TABLE = 'ecoregion_attributes'
+biome_realm_table = 'luh_baseline_biome_realm_area'
+biome_table = 'luh_baseline_biome_area'
+realm_table = 'luh_baseline_realm_area'
+perc_table = 'luh_baseline_ecoregion_percent'
+biome_realm_perc_table = 'luh_baseline_biome_realm_percent'
+biome_perc_table = 'luh_baseline_biome_percent'
+realm_perc_table = 'luh_baseline_realm_percent'
+
 
 YEARS = np.arange(850,2016)
 #Land cover column names
 lc_names = ['Urban','Cropland','Rangeland','Pastureland','Forest','Nonforest']
-for year in YEARS:
-    print(year)
-    #Read in dataframe
-    in_df = pd.read_csv(INPUT_CSV.format(year=year),header=0,index_col=0)
-    
+
+def saveArea(df,csv_name,table,id_columns,year):
+    '''
+    Saves an area table for one year to the store or to csv
+    '''
+    if FORMAT == 'parquet':
+        write_year(STORE_DIR,table,year,to_long(df,id_columns,lc_names))
+    else:
+        df.to_csv(csv_name.format(year=year))
+
+def savePercent(df,csv_name,table,id_columns,year):
+    '''
+    Saves a percent table for one year to the store or to csv
+    '''
+    if FORMAT == 'parquet':
+        #The ecoregion tables are indexed by OBJECTID
+        if df.index.name in id_columns:
+            df = df.reset_index()
+        write_year(STORE_DIR,table,year,to_long(df,id_columns,lc_names,value='percent'))
+    else:
+        df.to_csv(csv_name.format(year=year))
+
+#If vectorized is set to true, the tables for all years are found together by the rollup engine (see common/rollup.py)
+#   instead of looping over the rows of each year
+VECTORIZED = True
+#Levels of the rollup as (name, columns, level it is summed from)
+LEVELS = [('ecoregion',['OBJECTID'],None),('biome_realm',['BIOME_NAME','REALM'],'ecoregion'),('biome',['BIOME_NAME'],'biome_realm'),('realm',['REALM'],'biome_realm')]
+
+def readLongTable():
+    '''
+    Reads the ecoregion areas of every year as one long format table (OBJECTID, names, year, class, area)
+    Returns the table and the class holding the totals, the store has no totals so they are summed from the classes
+    '''
+    if FORMAT == 'parquet':
+        attributes = read_attributes(STORE_DIR,ATTRIBUTES_TABLE)
+        return read_table(STORE_DIR,AREA_TABLE,YEARS).merge(attributes,on='OBJECTID'), None
+    in_df = pd.concat([pd.read_csv(INPUT_CSV.format(year=year),header=0) for year in YEARS])
+    return to_long(in_df,['OBJECTID','ECO_NAME','BIOME_NAME','REALM','Year'],lc_names+['Total']).rename(columns={'Year':'year'}), 'Total'
+
+def splitYears(df,index=True):
+    '''
+    Splits a frame of every year into one frame per year, without the Year column for the rolled up tables
+    '''
+    frames = {}
+    for year, year_df in df.groupby('Year',sort=False):
+        if not index:
+            year_df = year_df.drop(columns=['Year']).reset_index(drop=True)
+        frames[year] = year_df
+    return frames
+
+def getGroupFrames(level,names,percent=False):
+    '''
+    Gets the table of each year for a level of the rollup, with the columns of the per-year csvs
+    '''
+    df = level.to_frame(percent).rename(columns=dict(zip(level.columns,names)))
+    return splitYears(df[['Year']+names+['Total']+lc_names],index=False)
+
+if VECTORIZED:
+    #Sum every year over the ecoregions, biome, realm pairs, biomes, and realms in one pass
+    long_df, total_class = readLongTable()
+    levels = rollup(long_df,LEVELS,'area',total_class,zone_columns=['OBJECTID','ECO_NAME','BIOME_NAME','REALM'])
+
     #1. CONVERT AREA TO PERCENT COVER FOR EACH ECOREGION
-    #The purpose of this section of code is to find the percent coverage of each land cover class over the years for each of the ecoregions
-    #Copy over dataframe
-    perc_df = in_df.copy()
-    #Iterate over dataframe
-    for index, row in in_df.iterrows():
-       total = row['Total']
-       for lc in lc_names:
-           lc_val = perc_df.at[index,lc]
-           if total !=0:
-               perc_val = lc_val/total
-           else:
-               perc_val = 0
-           perc_df.at[index,lc] = perc_val
-    perc_df.to_csv(all_perc_csv.format(year=year))
-
-    #2. FIND LAND COVER AREA FOR UNIQUE BIOME, REALM PAIRS
-    #The purpose of this section of code is to find the land cover information for unique biome, realm pairs
-    #Get unique biome, realm pairs
-    biomes_realms = in_df[['BIOME_NAME','REALM']]
-    biomes_realms = biomes_realms.drop_duplicates()
-    #Copy over biome and realm values
-    biome_realm_df = pd.DataFrame(columns=['Biome','Realm'])
-    biome_realm_df['Biome'] = biomes_realms['BIOME_NAME'].tolist()
-    biome_realm_df['Realm'] = biomes_realms['REALM'].tolist()
-    biome_realm_df['Total'] = 0.0
-
-    #2a. SUM LAND COVER AREA FOR EACH BIOME, REALM PAIR
-    #The purpose of this section of code is to sum the area of each year and land cover class over the ecoregions that match
-    #   the biome, realm pairs as above
-    #Iterate over the biome,realm pairs of the biome_realm_df and fill in land cover values
-    for biome_index,biome_row in biome_realm_df.iterrows():
-        #Get subset of dataframe of ecoregions that match the biome, realm pair
-        temp_df = in_df[(in_df['BIOME_NAME'] == biome_row['Biome']) & (in_df['REALM'] == biome_row['Realm'])]
-        biome_realm_df.at[biome_index,'Total'] = np.sum(np.array(temp_df['Total'].tolist()))
-        #Iterate over land cover types
-        for lc in lc_names:
-            #Get array of area for that land cover for ecoregions that match that biome and realm
-            lc_year_array = np.array(temp_df[lc].tolist())
-            #Sum over areas
-            lc_year_sum = np.sum(lc_year_array)
-            #Save to dataframe
-            biome_realm_df.at[biome_index,lc] = lc_year_sum
-    #Save dataframe to csv
-    biome_realm_df.to_csv(biome_realm_csv.format(year=year))
-
-
-    #2b. FIND PERCENT COVERAGE OF EACH LAND COVER TYPE FOR EACH UNIQUE BIOME, REALM PAIRS
-    #The purpose of this section of code is to find the percent coverage of each land cover class for the
-    #   unique biome, realm pairs
-    #Copy over dataframe
-    biome_realm_perc_df = biome_realm_df.copy()
-    #Iterate over the biome, realm pairs
-    for index, row in biome_realm_perc_df.iterrows():
-        #Save total
-        total = row['Total']
-        #Iterate through lc names
-        for lc in lc_names:
-            #Find percent land cover for that land cover type
-            lc_year_val = biome_realm_perc_df.at[index,lc]
-            if total!=0:
-                lc_year_perc = lc_year_val/total
-            else:
-                lc_year_perc = 0
-            #Save back to dataframe
-            biome_realm_perc_df.at[index,lc] = lc_year_perc
-    biome_realm_perc_df.to_csv(biome_realm_perc_csv.format(year=year))
-
-
-
-    #3. AREA FOR BIOMES
-    #The purpose of this section of code is to find the area for each biome
-    #Get unique biome names
-    biomes = in_df['BIOME_NAME']
-    biomes = biomes.drop_duplicates()
-    #Copy over biome values
-    biome_df = pd.DataFrame(columns=['Biome'])
-    biome_df['Biome'] = biomes.tolist()
-    #Save empty column for total
-    biome_df['Total'] = 0.0
-
-    #3a. SUM AREA FOR EACH BIOME
-    #The purpose of this section of code is to sum the area of each year and land cover class over the ecoregions that match the biomes above
-    #Iterate over the biomes of the biome_df and fill in land cover values
-    for biome_index,biome_row in biome_df.iterrows():
-        #Get subset of dataframe of ecoregions that match the biome
-        temp_df = in_df[in_df['BIOME_NAME'] == biome_row['Biome']]
-        biome_df.at[biome_index,'Total'] = np.sum(np.array(temp_df['Total'].tolist()))
-        #Iterate over land cover types
-        for lc in lc_names:
-            #Get array of area for that land cover for ecoregions that match that biome 
-            lc_year_array = np.array(temp_df[lc].tolist())
-            #Sum over area
-            lc_year_sum = np.sum(lc_year_array)
-            #Save land cover sum into dataframe
-            biome_df.at[biome_index,lc] = lc_year_sum
-    #Save dataframe to csv
-    biome_df.to_csv(biome_csv.format(year=year))
-
-
-    #3b. FIND PERCENT COVERAGE OF EACH LAND COVER TYPE FOR EACH UNIQUE BIOME
-    #The purpose of this section of code is to find the percent coverage of each land cover class for the biomes
-    #Copy over dataframe
-    biome_perc_df = biome_df.copy()
-    #Iterate over the biomes
-    for index, row in biome_perc_df.iterrows():
-        #Save total
-        total = row['Total']
-        #Iterate through lc names
-        for lc in lc_names:
-            #Find percent land cover for that land cover type
-            lc_year_val = biome_perc_df.at[index,lc]
-            if total !=0:
-                lc_year_perc = lc_year_val/total
-            else:
-                lc_year_perc = 0
-            #Save back to dataframe
-            biome_perc_df.at[index,lc] = lc_year_perc
-    biome_perc_df.to_csv(biome_perc_csv.format(year=year))
-
-    #4. PIXEL COUNTS FOR Realms
-    #The purpose of this section of code is to find the pixel counts for each realm
-    #Get unique realm names
-    realms = in_df['REALM']
-    realms = realms.drop_duplicates()
-    #Copy over realm values
-    realm_df = pd.DataFrame(columns=['Realm'])
-    realm_df['Realm'] = realms.tolist()
-    #Save empty column for total
-    realm_df['Total'] = 0.0
-
-    #4a. SUM PIXEL COUNTS FOR EACH REALM
-    #The purpose of this section of code is to sum the pixel counts of each year and land cover class over the ecoregions that match the realms above
-    #Iterate over the realms of the realm_df and fill in land cover values
-    for realm_index,realm_row in realm_df.iterrows():
-        #Get subset of dataframe of ecoregions that match the realm
-        temp_df = in_df[in_df['REALM'] == realm_row['Realm']]
-        realm_df.at[realm_index,'Total'] = np.sum(np.array(temp_df['Total'].tolist()))
-        #Iterate over land cover types
-        for lc in lc_names:
-            #Iterate over years
-            #Get array of pixel counts for that land cover for ecoregions that match that realm
-            lc_year_array = np.array(temp_df[lc].tolist())
-            #Sum over pixel counts
-            lc_year_sum = np.sum(lc_year_array)
-            #Save land cover sum into dataframe
-            realm_df.at[realm_index,lc] = lc_year_sum
-    #Save dataframe to csv
-    realm_df.to_csv(realm_csv.format(year=year))
-
-
-    #4b. FIND PERCENT COVERAGE OF EACH LAND COVER TYPE FOR EACH UNIQUE REALM
-    #The purpose of this section of code is to find the percent coverage of each land cover class for the realms
-    #Copy over dataframe
-    realm_perc_df = realm_df.copy()
-    #Iterate over the realms
-    for index, row in realm_perc_df.iterrows():
-        #Save total
-        total = row['Total']
-        #Iterate through lc names
-        for lc in lc_names:
-            lc_year_val = realm_perc_df.at[index,lc]
-            if total !=0:
-                lc_year_perc = lc_year_val/total
-            else:
-                lc_year_perc = 0
-            #Save back to dataframe
-            realm_perc_df.at[index,lc] = lc_year_perc
-    realm_perc_df.to_csv(realm_perc_csv.format(year=year))
+    perc_by_year = splitYears(levels['ecoregion'].to_frame(percent=True).set_index('OBJECTID'))
+
+    #2. FIND LAND COVER AREA AND PERCENT COVER FOR UNIQUE BIOME, REALM PAIRS
+    biome_realm_by_year = getGroupFrames(levels['biome_realm'],['Biome','Realm'])
+    biome_realm_perc_by_year = getGroupFrames(levels['biome_realm'],['Biome','Realm'],percent=True)
+
+    #3. AREA AND PERCENT COVER FOR BIOMES
+    biome_by_year = getGroupFrames(levels['biome'],['Biome'])
+    biome_perc_by_year = getGroupFrames(levels['biome'],['Biome'],percent=True)
+
+    #4. AREA AND PERCENT COVER FOR REALMS
+    realm_by_year = getGroupFrames(levels['realm'],['Realm'])
+    realm_perc_by_year = getGroupFrames(levels['realm'],['Realm'],percent=True)
+
+    #Save the tables of each year
+    for year in YEARS:
+        print(year)
+        savePercent(perc_by_year[year],all_perc_csv,perc_table,['OBJECTID'],year)
+        saveArea(biome_realm_by_year[year],biome_realm_csv,biome_realm_table,['Biome','Realm'],year)
+        savePercent(biome_realm_perc_by_year[year],biome_realm_perc_csv,biome_realm_perc_table,['Biome','Realm'],year)
+        saveArea(biome_by_year[year],biome_csv,biome_table,['Biome'],year)
+        savePercent(biome_perc_by_year[year],biome_perc_csv,biome_perc_table,['Biome'],year)
+        saveArea(realm_by_year[year],realm_csv,realm_table,['Realm'],year)
+        savePercent(realm_perc_by_year[year],realm_perc_csv,realm_perc_table,['Realm'],year)
+else:
+    if FORMAT == 'parquet':
+        attributes = read_attributes(STORE_DIR,ATTRIBUTES_TABLE)
+    for year in YEARS:
+        print(year)
+        #Read in dataframe
+        if FORMAT == 'parquet':
+            #Only the files of this year are read from the store
+            in_df = read_wide(STORE_DIR,AREA_TABLE,['OBJECTID'],[year],attributes=attributes).set_index('OBJECTID')
+        else:
+            in_df = pd.read_csv(INPUT_CSV.format(year=year),header=0,index_col=0)
+    
+        #1. CONVERT AREA TO PERCENT COVER FOR EACH ECOREGION
+        #The purpose of this section of code is to find the percent coverage of each land cover class over the years for each of the ecoregions
+        #Copy over dataframe
+        perc_df = in_df.copy()
+        #Iterate over dataframe
+        for index, row in in_df.iterrows():
+           total = row['Total']
+           for lc in lc_names:
+               lc_val = perc_df.at[index,lc]
+               if total !=0:
+                   perc_val = lc_val/total
+               else:
+                   perc_val = 0
+               perc_df.at[index,lc] = perc_val
+        savePercent(perc_df,all_perc_csv,perc_table,['OBJECTID'],year)
+
+        #2. FIND LAND COVER AREA FOR UNIQUE BIOME, REALM PAIRS
+        #The purpose of this section of code is to find the land cover information for unique biome, realm pairs
+        #Get unique biome, realm pairs
+        biomes_realms = in_df[['BIOME_NAME','REALM']]
+        biomes_realms = biomes_realms.drop_duplicates()
+        #Copy over biome and realm values
+        biome_realm_df = pd.DataFrame(columns=['Biome','Realm'])
+        biome_realm_df['Biome'] = biomes_realms['BIOME_NAME'].tolist()
+        biome_realm_df['Realm'] = biomes_realms['REALM'].tolist()
+        biome_realm_df['Total'] = 0.0
+
+        #2a. SUM LAND COVER AREA FOR EACH BIOME, REALM PAIR
+        #The purpose of this section of code is to sum the area of each year and land cover class over the ecoregions that match
+        #   the biome, realm pairs as above
+        #Iterate over the biome,realm pairs of the biome_realm_df and fill in land cover values
+        for biome_index,biome_row in biome_realm_df.iterrows():
+            #Get subset of dataframe of ecoregions that match the biome, realm pair
+            temp_df = in_df[(in_df['BIOME_NAME'] == biome_row['Biome']) & (in_df['REALM'] == biome_row['Realm'])]
+            biome_realm_df.at[biome_index,'Total'] = np.sum(np.array(temp_df['Total'].tolist()))
+            #Iterate over land cover types
+            for lc in lc_names:
+                #Get array of area for that land cover for ecoregions that match that biome and realm
+                lc_year_array = np.array(temp_df[lc].tolist())
+                #Sum over areas
+                lc_year_sum = np.sum(lc_year_array)
+                #Save to dataframe
+                biome_realm_df.at[biome_index,lc] = lc_year_sum
+        #Save dataframe to csv
+        saveArea(biome_realm_df,biome_realm_csv,biome_realm_table,['Biome','Realm'],year)
+
+
+        #2b. FIND PERCENT COVERAGE OF EACH LAND COVER TYPE FOR EACH UNIQUE BIOME, REALM PAIRS
+        #The purpose of this section of code is to find the percent coverage of each land cover class for the
+        #   unique biome, realm pairs
+        #Copy over dataframe
+        biome_realm_perc_df = biome_realm_df.copy()
+        #Iterate over the biome, realm pairs
+        for index, row in biome_realm_perc_df.iterrows():
+            #Save total
+            total = row['Total']
+            #Iterate through lc names
+            for lc in lc_names:
+                #Find percent land cover for that land cover type
+                lc_year_val = biome_realm_perc_df.at[index,lc]
+                if total!=0:
+                    lc_year_perc = lc_year_val/total
+                else:
+                    lc_year_perc = 0
+                #Save back to dataframe
+                biome_realm_perc_df.at[index,lc] = lc_year_perc
+        savePercent(biome_realm_perc_df,biome_realm_perc_csv,biome_realm_perc_table,['Biome','Realm'],year)
+
+
+
+        #3. AREA FOR BIOMES
+        #The purpose of this section of code is to find the area for each biome
+        #Get unique biome names
+        biomes = in_df['BIOME_NAME']
+        biomes = biomes.drop_duplicates()
+        #Copy over biome values
+        biome_df = pd.DataFrame(columns=['Biome'])
+        biome_df['Biome'] = biomes.tolist()
+        #Save empty column for total
+        biome_df['Total'] = 0.0
+
+        #3a. SUM AREA FOR EACH BIOME
+        #The purpose of this section of code is to sum the area of each year and land cover class over the ecoregions that match the biomes above
+        #Iterate over the biomes of the biome_df and fill in land cover values
+        for biome_index,biome_row in biome_df.iterrows():
+            #Get subset of dataframe of ecoregions that match the biome
+            temp_df = in_df[in_df['BIOME_NAME'] == biome_row['Biome']]
+            biome_df.at[biome_index,'Total'] = np.sum(np.array(temp_df['Total'].tolist()))
+            #Iterate over land cover types
+            for lc in lc_names:
+                #Get array of area for that land cover for ecoregions that match that biome 
+                lc_year_array = np.array(temp_df[lc].tolist())
+                #Sum over area
+                lc_year_sum = np.sum(lc_year_array)
+                #Save land cover sum into dataframe
+                biome_df.at[biome_index,lc] = lc_year_sum
+        #Save dataframe to csv
+        saveArea(biome_df,biome_csv,biome_table,['Biome'],year)
+
+
+        #3b. FIND PERCENT COVERAGE OF EACH LAND COVER TYPE FOR EACH UNIQUE BIOME
+        #The purpose of this section of code is to find the percent coverage of each land cover class for the biomes
+        #Copy over dataframe
+        biome_perc_df = biome_df.copy()
+        #Iterate over the biomes
+        for index, row in biome_perc_df.iterrows():
+            #Save total
+            total = row['Total']
+            #Iterate through lc names
+            for lc in lc_names:
+                #Find percent land cover for that land cover type
+                lc_year_val = biome_perc_df.at[index,lc]
+                if total !=0:
+                    lc_year_perc = lc_year_val/total
+                else:
+                    lc_year_perc = 0
+                #Save back to dataframe
+                biome_perc_df.at[index,lc] = lc_year_perc
+        savePercent(biome_perc_df,biome_perc_csv,biome_perc_table,['Biome'],year)
+
+        #4. PIXEL COUNTS FOR Realms
+        #The purpose of this section of code is to find the pixel counts for each realm
+        #Get unique realm names
+        realms = in_df['REALM']
+        realms = realms.drop_duplicates()
+        #Copy over realm values
+        realm_df = pd.DataFrame(columns=['Realm'])
+        realm_df['Realm'] = realms.tolist()
+        #Save empty column for total
+        realm_df['Total'] = 0.0
+
+        #4a. SUM PIXEL COUNTS FOR EACH REALM
+        #The purpose of this section of code is to sum the pixel counts of each year and land cover class over the ecoregions that match the realms above
+        #Iterate over the realms of the realm_df and fill in land cover values
+        for realm_index,realm_row in realm_df.iterrows():
+            #Get subset of dataframe of ecoregions that match the realm
+            temp_df = in_df[in_df['REALM'] == realm_row['Realm']]
+            realm_df.at[realm_index,'Total'] = np.sum(np.array(temp_df['Total'].tolist()))
+            #Iterate over land cover types
+            for lc in lc_names:
+                #Iterate over years
+                #Get array of pixel counts for that land cover for ecoregions that match that realm
+                lc_year_array = np.array(temp_df[lc].tolist())
+                #Sum over pixel counts
+                lc_year_sum = np.sum(lc_year_array)
+                #Save land cover sum into dataframe
+                realm_df.at[realm_index,lc] = lc_year_sum
+        #Save dataframe to csv
+        saveArea(realm_df,realm_csv,realm_table,['Realm'],year)
+
 
+        #4b. FIND PERCENT COVERAGE OF EACH LAND COVER TYPE FOR EACH UNIQUE REALM
+        #The purpose of this section of code is to find the percent coverage of each land cover class for the realms
+        #Copy over dataframe
+        realm_perc_df = realm_df.copy()
+        #Iterate over the realms
+        for index, row in realm_perc_df.iterrows():
+            #Save total
+            total = row['Total']
+            #Iterate through lc names
+            for lc in lc_names:
+                lc_year_val = realm_perc_df.at[index,lc]
+                if total !=0:
+                    lc_year_perc = lc_year_val/total
+                else:
+                    lc_year_perc = 0
+                #Save back to dataframe
+                realm_perc_df.at[index,lc] = lc_year_perc
+        savePercent(realm_perc_df,realm_perc_csv,realm_perc_table,['Realm'],year)
@@ -0,0 +1,61 @@
+from collections import OrderedDict
+import numpy as np
+
+#The purpose of this code is to aggregate Land-Use Harmonization states into new land cover classes
+#A class scheme maps each new class to the list of LUH states that are summed into it
+#The scheme is compiled to a weight matrix (new classes x states) that is applied with one matrix multiply
+
+
+#Classes used for the coverage csvs and the max class rasters
+LUH_CLASSES = OrderedDict([
+    ('urban',['urban']),
+    ('crops',['c3ann','c4ann','c3per','c4per','c3nfx']),
+    ('range',['range']),
+    ('pastr',['pastr']),
+    ('forest',['primf','secdf']),
+    ('nonforest',['primn','secdn']),
+])
+LUH_CLASS_NAMES = ['Urban','Cropland','Rangeland','Pastureland','Forest','Nonforest']
+
+#IPCC land categories, matching the classes used for ESA Land Cover
+#secma and secmb are the mean age and biomass density of secondary land, not fractions of the cell,
+#   so they can be read along with the states but never get a weight
+IPCC_CLASSES = OrderedDict([
+    ('agriculture',['c3ann','c4ann','c3per','c4per','c3nfx']),
+    ('forest',['primf','secdf']),
+    ('grassland',['range','pastr']),
+    ('settlement',['urban']),
+    ('other',['primn','secdn']),
+])
+IPCC_CLASS_NAMES = ['Agriculture','Forest','Grassland','Settlement','Other']
+
+
+def compile_weights(classes,variables):
+    '''
+    Turns a class scheme into a weight matrix with one row per new class and one column per variable
+    A list of states gets weights of 1, a dictionary of state: weight can be used for fractional weights
+    '''
+    variables = list(variables)
+    weights = np.zeros((len(classes),len(variables)))
+    for class_index, (new_var, temp_variables) in enumerate(classes.items()):
+        if not isinstance(temp_variables,dict):
+            temp_variables = dict.fromkeys(temp_variables,1.0)
+        for temp_var, weight in temp_variables.items():
+            if temp_var not in variables:
+                raise ValueError('{var} for class {new_var} is not one of the variables read'.format(var=temp_var,new_var=new_var))
+            weights[class_index,variables.index(temp_var)] = weight
+    return weights
+
+def aggregate_classes(data,weights,NDV):
+    '''
+    Aggregates original variables to new classes
+    data is one year (variables,lat,lon) or a block of years (years,variables,lat,lon)
+    Returns float64 data with the variable axis replaced by the class axis
+    '''
+    shape = data.shape
+    #Sum the weighted variables for all years and cells in one matrix multiply over the variable axis
+    flat = data.reshape(shape[:-2]+(shape[-2]*shape[-1],))
+    nc_data = np.matmul(weights,flat).reshape(shape[:-3]+(weights.shape[0],)+shape[-2:])
+    #Any class that includes a no data value sums to at least NDV, make NDV values uniform once
+    nc_data[nc_data>=NDV] = NDV
+    return nc_data
@@ -1,5 +1,8 @@
 import sys
 import os
+import shutil
+import tempfile
+import multiprocessing
 from osgeo import gdal, gdalconst, osr, gdal_array
 from collections import OrderedDict
 import netCDF4 as nc
@@ -9,6 +12,16 @@ import geopandas as gpd
 import pandas as pd
 import numpy as np
 from shapely.geometry import mapping
+from luh_reader import LUHReader, split_years
+from luh_zonal import ZonalSums, SparseZonalSums
+from mask_cache import get_lat_lon, get_mask_store
+from mask_store import MaskStore
+from run_manifest import RunManifest
+from area_store import to_long, write_year, write_attributes
+#The coverage database is shared with the ESA Land Cover scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+from common import coverage_db
+from luh_classes import LUH_CLASSES, LUH_CLASS_NAMES, IPCC_CLASSES, IPCC_CLASS_NAMES, compile_weights, aggregate_classes
 np.set_printoptions(suppress=True)
 
 #The purpose of this code is to find the area coverage of each land use category of Land-Use Harmonization in the RESOLVE ecoregions
@@ -19,22 +32,52 @@ NC_FILENAME = DATA_DIR+'baseline_states.nc'
 STATIC_DATA_FILENAME = DATA_DIR+'staticData_quarterdeg.nc'
 SHAPEFILE_NAME = "Ecoregions2017/Ecoregions2017.shp"
 
-MASK_FILENAME = DATA_DIR + "ecoregions_mask/LUH_ecoregions_mask_{id}.npy"
+#Ecoregion masks are cached here by grid and shapefile, and built on the first run (see mask_cache.py)
+MASK_CACHE_DIR = DATA_DIR + "ecoregions_mask/cache/"
+#Number of processes used if fractional masks have to be built, None uses every core
+NUM_PROCESSES = None
+
+#Method used to sum area over the ecoregions
+#   'sparse': sparse ecoregion x cell weights, every year of a block in one product
+#   'bincount': all ecoregions at once from the label grid, one year at a time
+#   'masks': one packed mask per ecoregion, one year at a time
+METHOD = 'sparse'
+#If fractional is set to true, the sparse and masks methods weight cells by the fraction covered by each ecoregion instead of cell centers
+FRACTIONAL = True
 
 
 TARGET_YEARS = np.arange(850,2016)
 START_YEAR = 850
+#Number of years read from the netCDF at once, 20 years of all variables is about 1 GB
+BLOCK_SIZE = 20
+#Number of processes that work on blocks of years at the same time, 1 runs every block in this process
+#Each process holds one block in memory, so lower BLOCK_SIZE when raising this
+#The cell areas and masks are memory-mapped from files and shared by the processes instead of copied to each one
+NUM_WORKERS = 4
 
 VARIABLES = ['urban','c3ann','c4ann','c3per','c4per','c3nfx','range','pastr','primf','secdf','primn','secdn']
-NEW_VARIABLES = ['urban','crops','range','pastr','forest','nonforest']
-NEW_VARIABLE_NAMES = ['Urban','Cropland','Rangeland','Pastureland','Forest','Nonforest']
+#Classes that the variables are aggregated to, swap in IPCC_CLASSES and IPCC_CLASS_NAMES for IPCC categories
+CLASSES = LUH_CLASSES
+NEW_VARIABLES = list(CLASSES.keys())
+NEW_VARIABLE_NAMES = LUH_CLASS_NAMES
+WEIGHTS = compile_weights(CLASSES,VARIABLES)
 META_VARIABLE = 'primf'
 
+#Output format of the areas, 'parquet' adds each year to the columnar store (see area_store.py), 'csv' writes one csv per year
+OUTPUT_FORMAT = 'parquet'
 OUTPUT_CSV = DATA_DIR + 'csv/LUH_baseline_ecoregion_area_{year}.csv'
+STORE_DIR = DATA_DIR + 'store/'
+AREA_TABLE = 'luh_baseline_ecoregion_area'
+ATTRIBUTES_TABLE = 'ecoregion_attributes'
+#If write database is set to true, each year is also added to the coverage database for time series queries (see common/coverage_db.py)
+WRITE_DATABASE = True
+DATABASE = DATA_DIR + 'coverage.sqlite'
+DATASET = 'luh_baseline'
+#Finished years are recorded here with hashes of the inputs, see run_manifest.py
+MANIFEST_FILENAME = DATA_DIR + 'csv/LUH_baseline_ecoregion_area_manifest.json'
+#If resume is set to true, years finished by an earlier run with the same inputs and settings are skipped
+RESUME = True
 
-def get_mask(mask_filename):
-    return np.load(mask_filename)
-    
 def GetnetCDFGlobalMetaData(in_filename):
     """
     Function to read global metadata of netcdf file
@@ -78,13 +121,6 @@ def GetnetCDFInfobyName(in_filename,var_name):
         return NDV, xsize, ysize, GeoT, Projection
         
 
-def GetnetCDFDataByName(in_filename,var_name,index=0):
-    '''
-    Reads data for a specified year from netCDF
-    '''
-    with nc.Dataset(in_filename) as src:
-        return src.variables[var_name][index,:,:]
-    
 def GetStaticnetCDFDataByName(in_filename,var_name):
     '''
     Reads data for a specified year from netCDF
@@ -92,88 +128,185 @@ def GetStaticnetCDFDataByName(in_filename,var_name):
     with nc.Dataset(in_filename) as src:
         return src.variables[var_name][:,:]
         
-def GetNCDataByNewVariable(year_index,ysize,xsize,NDV,NC_FILENAME=NC_FILENAME,NEW_VARIABLES=NEW_VARIABLES):
+def GetNCDataByNewVariable(year_data,NDV,WEIGHTS=WEIGHTS):
     '''
     Aggregate original variables to desired ones
+    year_data holds one year (variables,lat,lon) or a block of years (years,variables,lat,lon) as read by LUHReader
     '''
-    #Get data for variables and aggregate when necessary
-    nc_data = np.zeros((len(NEW_VARIABLES),ysize,xsize))
-    for var_index, var in enumerate(NEW_VARIABLES):
-        #If not in the aggregating variables (crops, forest, nonforest) just keep variable
-        temp_variables = [var]
-        #Otherwise aggregate
-        if var == 'crops':
-            temp_variables = ['c3ann','c4ann','c3per','c4per','c3nfx']
-        elif var == 'forest':
-            temp_variables = ['primf','secdf']
-        elif var == 'nonforest':
-            temp_variables = ['primn','secdn']
-        #"Aggregating"
-        for temp_var in temp_variables:
-            nc_data[var_index] = nc_data[var_index]+ GetnetCDFDataByName(NC_FILENAME,temp_var,index=year_index).data
-        #Make NDV values uniform
-        nc_data[nc_data>=NDV] = NDV
-    return nc_data
+    return aggregate_classes(year_data,WEIGHTS,NDV)
     
-def getEcoregionArea(var_data,cell_area,NDV,ecoregion_mask):
+def getEcoregionArea(nc_data,cell_area,NDV,cells,weights):
+    '''
+    Finds the area of each class in one ecoregion from the flat cell indices and weights of its mask
+    '''
+    var_data = nc_data.reshape(nc_data.shape[0],-1)[:,cells]
     #Set no data value to 0
-    var_data[var_data>=NDV] = 0
-    #Multiply cell_area by ecoregion_mask
-    masked_area = np.multiply(cell_area,ecoregion_mask)
-    #Multiply percent cover matrix by grid cell area matrix
-    masked_area_coverage = np.multiply(var_data,masked_area)
-    #Sum over values to get total coverage
-    area_sum = np.sum(masked_area_coverage)
-    return masked_area_coverage,area_sum
-    
-#Get static data for LUH
-#Get netcdf metadata
-NDV, xsize, ysize, GeoT, Projection = GetnetCDFInfobyName(NC_FILENAME,META_VARIABLE)
-#Get area per grid cell
-cell_area = GetStaticnetCDFDataByName(STATIC_DATA_FILENAME,'carea')
-#Get ice/water fraction of cell, this is the amount of the grid cell covered in ice and water
-ice_water_fraction = GetStaticnetCDFDataByName(STATIC_DATA_FILENAME,'icwtr')
-#Multiply grid cell area by 1 - fraction of cell covered in ice and water to get
-#   area of grid cell that is terrestrial
-cell_area = np.multiply(cell_area,1-ice_water_fraction)
-
-#Iterate through the years and calculate coverage sum
-for index,year in enumerate(TARGET_YEARS):
-    
-    #Re-index year 
-    year_index = year-START_YEAR
-    #Get data for new variables from netcdf
-    nc_data = GetNCDataByNewVariable(year_index,ysize,xsize,NDV,NC_FILENAME,NEW_VARIABLES)
+    var_data = np.where(var_data>=NDV,0,var_data)
+    #Multiply percent cover by the masked grid cell area and sum over the cells
+    return np.dot(var_data,cell_area[cells]*weights)
+
+def getEcoregionAreaFrame(attributes,year,area_sums):
+    '''
+    Builds the dataframe for one year from the ecoregion attributes and the area sums (ecoregions,classes)
+    '''
+    df = attributes[['OBJECTID','ECO_NAME','BIOME_NAME','REALM']].reset_index(drop=True)
+    df['Year'] = year
+    for var_index, name in enumerate(NEW_VARIABLE_NAMES):
+        df[name] = area_sums[:,var_index]
+    df['Total'] = np.sum(area_sums,axis=1)
+    return df
+
+def getZonalSums(store,attributes,cell_area):
+    '''
+    Builds the zonal sums used by METHOD from the masks, the masks method uses the store directly and gets None
+    '''
+    if METHOD == 'bincount':
+        return ZonalSums(store.get_labels(),attributes['OBJECTID'].values,cell_area,len(NEW_VARIABLES))
+    elif METHOD == 'sparse':
+        entry_ids, entry_cells, entry_weights = store.entries()
+        return SparseZonalSums.from_fractions(entry_ids,entry_cells,entry_weights,attributes['OBJECTID'].values,cell_area)
+    return None
+
+def writeBlockAreas(block_years,block,NDV,attributes,zonal,store,flat_cell_area):
+    '''
+    Finds the area of each class in every ecoregion for a block of years and saves each year
+    Returns the files written for each year and the table of each year
+    '''
+    outputs = {}
+    frames = {}
+    if METHOD == 'sparse':
+        #Area of each class in every ecoregion for all years of the block from one sparse product
+        block_sums = zonal.block_sums(GetNCDataByNewVariable(block,NDV),NDV)
+    for block_index, year in enumerate(block_years):
+        print('Year: {year}'.format(year=year))
+        if METHOD == 'sparse':
+            df = getEcoregionAreaFrame(attributes,year,block_sums[block_index])
+        elif METHOD == 'bincount':
+            #Get data for new variables from the block
+            nc_data = GetNCDataByNewVariable(block[block_index],NDV)
+            #Area of each class in every ecoregion from one bincount
+            df = getEcoregionAreaFrame(attributes,year,zonal.sums(nc_data,NDV))
+        else:
+            nc_data = GetNCDataByNewVariable(block[block_index],NDV)
+            area_sums = np.zeros((len(attributes),len(NEW_VARIABLES)))
+            for eco_index, obj_id in enumerate(attributes['OBJECTID']):
+                cells, weights = store.get(obj_id)
+                area_sums[eco_index] = getEcoregionArea(nc_data,flat_cell_area,NDV,cells,weights)
+            df = getEcoregionAreaFrame(attributes,year,area_sums)
+
+        if OUTPUT_FORMAT == 'parquet':
+            #Names are in the attributes table, the store only keeps OBJECTID, class, and area
+            outputs[year] = [write_year(STORE_DIR,AREA_TABLE,year,to_long(df,['OBJECTID'],NEW_VARIABLE_NAMES))]
+        else:
+            #Save to csv
+            df.to_csv(OUTPUT_CSV.format(year=year),index=False,encoding='utf-8')
+            outputs[year] = [OUTPUT_CSV.format(year=year)]
+        frames[year] = df
+    return outputs, frames
+
+def saveBlockToDatabase(conn,block_years,frames):
+    '''
+    Adds the tables of a block of years to the coverage database in one transaction
+    '''
+    coverage_db.write_years(conn,DATASET,dict((year,frames[year]) for year in block_years),NEW_VARIABLE_NAMES+['Total'])
+
+#State of each worker process, set once by initWorker and reused for every block it runs
+WORKER = {}
+
+def initWorker(cell_area_filename,store_filename,attributes,NDV):
+    '''
+    Opens the shared inputs in a worker process, the cell areas and masks are memory-mapped rather than copied
+    Each worker opens its own netCDF reader since open datasets can not be shared between processes
+    '''
+    cell_area = np.load(cell_area_filename,mmap_mode='r')
+    store = MaskStore(store_filename)
+    WORKER['cell_area'] = cell_area
+    WORKER['store'] = store
+    WORKER['attributes'] = attributes
+    WORKER['NDV'] = NDV
+    WORKER['zonal'] = getZonalSums(store,attributes,cell_area)
+    WORKER['reader'] = LUHReader(NC_FILENAME,VARIABLES,START_YEAR)
+
+def runWorkerBlock(block_years):
+    '''
+    Reads and saves one block of years in a worker process, returns the years and the files written for them
+    '''
+    block = WORKER['reader'].read_block(block_years[0],len(block_years))
+    outputs, frames = writeBlockAreas(block_years,block,WORKER['NDV'],WORKER['attributes'],WORKER['zonal'],WORKER['store'],WORKER['cell_area'].ravel())
+    return block_years, outputs, frames
     
-    #Create empty dataframe that will hold area coverage over all ecoregions for that year
-    columns = ['OBJECTID','ECO_NAME','BIOME_NAME','REALM','Year']+NEW_VARIABLE_NAMES+['Total']
-    df = pd.DataFrame(columns=columns)
+#Worker processes import this file, so only run when called as a script
+if __name__ == '__main__':
+    #Get static data for LUH
+    #Get netcdf metadata
+    NDV, xsize, ysize, GeoT, Projection = GetnetCDFInfobyName(NC_FILENAME,META_VARIABLE)
+    #Get area per grid cell
+    cell_area = GetStaticnetCDFDataByName(STATIC_DATA_FILENAME,'carea')
+    #Get ice/water fraction of cell, this is the amount of the grid cell covered in ice and water
+    ice_water_fraction = GetStaticnetCDFDataByName(STATIC_DATA_FILENAME,'icwtr')
+    #Multiply grid cell area by 1 - fraction of cell covered in ice and water to get
+    #   area of grid cell that is terrestrial
+    cell_area = np.multiply(cell_area,1-ice_water_fraction)
+
+    #Read shapefile for the ecoregion attributes
     shapefile = gpd.read_file(SHAPEFILE_NAME)
-    print('Year: {year}'.format(year=year))
-    for index,row in shapefile.iterrows():
-        obj_id = row['OBJECTID']
-        if obj_id != 207:
-            eco_name = row['ECO_NAME']
-            biome_name = row['BIOME_NAME']
-            realm = row['REALM']
-            mask = get_mask(MASK_FILENAME.format(id=int(obj_id)))
-            mask = np.reshape(mask,(ysize,xsize))
-            #Create empty row to be appended to dataframe
-            df_row = np.zeros(len(NEW_VARIABLES)+1)
-            total = 0
-            #For each variable find the area coverage
-            for var_index, var in enumerate(NEW_VARIABLES):
-                area_coverage,area_sum = getEcoregionArea(nc_data[var_index,:,:],cell_area,NDV,mask)
-                df_row[var_index] = area_sum
-                total = total+ area_sum
-            df_row[-1] = total
-            #Insert into dataframe
-            keys = columns
-            values = [obj_id, eco_name, biome_name, realm, year] + df_row.tolist()
-            dictionary = dict(zip(keys, values))
-            df = df.append(dictionary, ignore_index=True)
-
-    #Save to csv
-    df.to_csv(OUTPUT_CSV.format(year=year),index=False,encoding='utf-8')
+    #Skip Antarctica, it is not classified by Resolve Ecoregions
+    #Geometries are not needed once the masks exist, dropping them keeps the table small to send to workers
+    attributes = pd.DataFrame(shapefile.loc[shapefile['OBJECTID']!=207,['OBJECTID','ECO_NAME','BIOME_NAME','REALM']])
+    #Get masks for the grid of the netCDF, masks are memory-mapped so only the cells of each ecoregion are read
+    lat, lon = get_lat_lon(NC_FILENAME)
+    if FRACTIONAL and METHOD != 'bincount':
+        store = get_mask_store(lat,lon,SHAPEFILE_NAME,'fraction',MASK_CACHE_DIR,NUM_PROCESSES)
+    else:
+        store = get_mask_store(lat,lon,SHAPEFILE_NAME,'center',MASK_CACHE_DIR)
 
+    #Years are only skipped if the netCDF, static data, masks (grid and shapefile), and class settings are unchanged
+    manifest = RunManifest(MANIFEST_FILENAME,{'states':NC_FILENAME,'static':STATIC_DATA_FILENAME},
+        {'variables':VARIABLES,'classes':NEW_VARIABLE_NAMES,'weights':WEIGHTS.tolist(),'method':METHOD,'fractional':FRACTIONAL,'masks':os.path.basename(store.filename),'format':OUTPUT_FORMAT})
+    if RESUME:
+        years = manifest.remaining(TARGET_YEARS)
+        print('Skipping {num} finished years'.format(num=len(TARGET_YEARS)-len(years)))
+    else:
+        years = list(TARGET_YEARS)
+    if OUTPUT_FORMAT == 'parquet':
+        write_attributes(STORE_DIR,ATTRIBUTES_TABLE,attributes)
+    #Only this process writes to the database, workers send their tables back
+    if WRITE_DATABASE:
+        conn = coverage_db.connect(DATABASE)
+        coverage_db.write_zones(conn,DATASET,attributes)
 
+    if NUM_WORKERS > 1:
+        #Write the cell areas to a file that every worker memory-maps, masks are already in a memory-mapped store
+        shared_dir = tempfile.mkdtemp(dir=DATA_DIR)
+        cell_area_filename = os.path.join(shared_dir,'cell_area.npy')
+        np.save(cell_area_filename,np.ma.filled(cell_area,0))
+        pool = multiprocessing.Pool(NUM_WORKERS,initializer=initWorker,initargs=(cell_area_filename,store.filename,attributes,NDV))
+        try:
+            #Blocks finish out of order, each one writes its own years
+            for block_years, outputs, frames in pool.imap_unordered(runWorkerBlock,split_years(years,BLOCK_SIZE)):
+                print('Finished: {first}-{last}'.format(first=block_years[0],last=block_years[-1]))
+                if WRITE_DATABASE:
+                    saveBlockToDatabase(conn,block_years,frames)
+                manifest.mark_done(block_years,outputs)
+            pool.close()
+        except BaseException:
+            #Stop the blocks still queued so the error surfaces now, not after every block has been computed
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            shutil.rmtree(shared_dir)
+    else:
+        zonal = getZonalSums(store,attributes,cell_area)
+        flat_cell_area = np.ma.filled(cell_area,0).ravel()
+        #Open the netCDF once and read blocks of years for all variables
+        reader = LUHReader(NC_FILENAME,VARIABLES,START_YEAR)
+        #Iterate through the years and calculate coverage sum
+        for block_years, block in reader.iter_blocks(years,BLOCK_SIZE):
+            outputs, frames = writeBlockAreas(block_years,block,NDV,attributes,zonal,store,flat_cell_area)
+            if WRITE_DATABASE:
+                saveBlockToDatabase(conn,block_years,frames)
+            manifest.mark_done(block_years,outputs)
+        reader.close()
+    if WRITE_DATABASE:
+        conn.close()
@@ -7,16 +7,31 @@ from matplotlib import pyplot as plt
 from matplotlib.colors import ListedColormap, BoundaryNorm
 import matplotlib.colors as colors
 import netCDF4 as nc
+from mask_cache import get_lat_lon, get_mask_store, NO_ECOREGION
 
 #The purpose of this code is to get masks for Land-Use Harmonization data for ecoregions
 #These masks are saved to numpy array files that can be read in again later
 #There is one mask for each ecoregion
+#With RASTERIZE set, every ecoregion is burned into one label grid in a single pass instead
+#With FRACTIONAL set, the fraction of each cell covered by each ecoregion is also saved
+#Masks are packed into one file per rule (see mask_store.py) and cached by grid and shapefile (see mask_cache.py)
+#   so they are only rebuilt when the grid or shapefile changes
 
 
 DATA_DIR = "LUH_data/data/"
 mask_filename = "ecoregions_mask/LUH_ecoregions_mask"
 shapefile_name = "Ecoregions2017/Ecoregions2017.shp"
 netcdf_fn = "LUH_data/data/baseline_states.nc"
+labels_filename = "ecoregions_mask/LUH_ecoregions_labels.npz"
+mask_cache_dir = "ecoregions_mask/cache/"
+
+#If rasterize is set to true, all ecoregions are rasterized at once to a grid of OBJECTIDs
+RASTERIZE = True
+#If save each mask is set to true, the old dense mask file for each ecoregion is also written from the label grid
+SAVE_EACH_MASK = False
+#If fractional is set to true, area weighted masks are computed with a pool of NUM_PROCESSES processes (None uses every core)
+FRACTIONAL = True
+NUM_PROCESSES = None
 
 def get_coordinates(netcdf_name):
     '''
@@ -55,21 +70,43 @@ def get_mask(geometry,coords,lon_shape,lat_shape,obj_id):
     return ecoregion_mask
 
 
-#Get coordinates, longitude shape, and latitude shape from netCDF
-coords, lon_shape, lat_shape = np.array(get_coordinates(netcdf_fn))
-#Read shapefile
-shapefile = gpd.read_file(shapefile_name)
+#Worker processes import this file, so only run when called as a script
+if __name__ == '__main__':
+    #Read shapefile
+    shapefile = gpd.read_file(shapefile_name)
+
+    if RASTERIZE:
+        #Get latitude and longitude of the cell centers from netCDF
+        lat, lon = get_lat_lon(netcdf_fn)
+        #Get masks where each cell is in the ecoregion its center falls in, rasterized in one pass if not cached
+        store = get_mask_store(lat,lon,shapefile_name,'center',DATA_DIR+mask_cache_dir)
+        #Save one grid with the OBJECTID of the ecoregion of each cell along with the grid and the rule used to assign cells
+        labels = store.get_labels(NO_ECOREGION)
+        np.savez(DATA_DIR+labels_filename,labels=labels,lat=lat,lon=lon,rule='center',no_ecoregion=NO_ECOREGION)
+        if SAVE_EACH_MASK:
+            #Every ecoregion gets a mask file, even if no cell centers fall inside it
+            for obj_id in shapefile['OBJECTID']:
+                if obj_id != 207:
+                    np.save(DATA_DIR+mask_filename+'_'+str(int(obj_id)),(labels==obj_id).astype(float))
+    else:
+        #Get coordinates, longitude shape, and latitude shape from netCDF
+        coords, lon_shape, lat_shape = np.array(get_coordinates(netcdf_fn))
+
+        for index,row in shapefile.iterrows():
+            #Get object id
+            obj_id = row['OBJECTID']
+            print(obj_id)
+            #Need to skip the Antarctica shape because it is too big, it is also not classified by Resolve Ecoregions
+            if obj_id != 207 and obj_id in [705]:
+                #Get geometry
+                ecoregion = row['geometry']
+                #Get mask
+                mask = get_mask(ecoregion,coords,lon_shape,lat_shape,obj_id)
+                #Save mask to file to be read later
+                np.save(DATA_DIR+mask_filename+'_'+str(int(obj_id)),mask)
 
-for index,row in shapefile.iterrows():
-    #Get object id
-    obj_id = row['OBJECTID']
-    print(obj_id)
-    #Need to skip the Antarctica shape because it is too big, it is also not classified by Resolve Ecoregions
-    if obj_id != 207 and obj_id in [705]:
-        #Get geometry
-        ecoregion = row['geometry']
-        #Get mask
-        mask = get_mask(ecoregion,coords,lon_shape,lat_shape,obj_id)
-        #Save mask to file to be read later
-        np.save(DATA_DIR+mask_filename+'_'+str(int(obj_id)),mask)
-        
+    if FRACTIONAL:
+        #Get latitude and longitude of the cell centers from netCDF
+        lat, lon = get_lat_lon(netcdf_fn)
+        #Get the fraction of every cell covered by every ecoregion, computed with a process pool if not cached
+        get_mask_store(lat,lon,shapefile_name,'fraction',DATA_DIR+mask_cache_dir,NUM_PROCESSES)
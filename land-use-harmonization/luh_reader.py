@@ -0,0 +1,77 @@
+import numpy as np
+import netCDF4 as nc
+
+#The purpose of this code is to read Land-Use Harmonization states from netCDF without reopening the file for every variable and year
+#One dataset is held open and whole blocks of years are read for every variable at once
+
+
+def split_years(years,block_size=50):
+    '''
+    Splits target years into runs of consecutive years of at most block_size
+    '''
+    years = [int(year) for year in years]
+    blocks = []
+    i = 0
+    while i < len(years):
+        j = i+1
+        while j < len(years) and j-i < block_size and years[j] == years[j-1]+1:
+            j = j+1
+        blocks.append(years[i:j])
+        i = j
+    return blocks
+
+
+class LUHReader(object):
+    '''
+    Holds one open netCDF dataset and reads multi-year blocks of the state variables
+    '''
+    def __init__(self,in_filename,variables,start_year):
+        self.filename = in_filename
+        self.variables = list(variables)
+        self.start_year = start_year
+        self.src = nc.Dataset(in_filename)
+        #Return plain ndarrays, fill values are left in place so NDV checks still work
+        self.src.set_auto_mask(False)
+        first_var = self.src.variables[self.variables[0]]
+        self.num_years, self.ysize, self.xsize = first_var.shape
+        self.dtype = first_var.dtype
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def close(self):
+        if self.src is not None:
+            self.src.close()
+            self.src = None
+
+    def read_block(self,first_year,num_years,variables=None):
+        '''
+        Reads a contiguous block of years for each variable
+        Returns an array with shape (num_years, num_variables, ysize, xsize)
+        '''
+        if variables is None:
+            variables = self.variables
+        start = first_year-self.start_year
+        if start < 0 or start+num_years > self.num_years:
+            raise ValueError('Years {first}-{last} are outside of {fn}'.format(first=first_year,last=first_year+num_years-1,fn=self.filename))
+        block = np.empty((num_years,len(variables),self.ysize,self.xsize),dtype=self.dtype)
+        #One hyperslab read per variable covers every year in the block
+        for var_index, var in enumerate(variables):
+            block[:,var_index] = self.src.variables[var][start:start+num_years,:,:]
+        return block
+
+    def read_year(self,year,variables=None):
+        '''
+        Reads all variables for a single year, shape (num_variables, ysize, xsize)
+        '''
+        return self.read_block(year,1,variables)[0]
+
+    def iter_blocks(self,years,block_size=50,variables=None):
+        '''
+        Yields the years of each run from split_years and the block of data read for them
+        '''
+        for block_years in split_years(years,block_size):
+            yield block_years, self.read_block(block_years[0],len(block_years),variables)
@@ -6,6 +6,9 @@ import numpy as np
 import netCDF4 as nc
 from matplotlib import pyplot as plt
 import pandas as pd
+from luh_reader import LUHReader
+from run_manifest import RunManifest
+from luh_classes import LUH_CLASSES, LUH_CLASS_NAMES, IPCC_CLASSES, IPCC_CLASS_NAMES, compile_weights, aggregate_classes
 
 #The purpose of this code is to find the global area coverage of each land cover category for Land-Use Harmonization version 2 data
 
@@ -15,13 +18,27 @@ STATIC_DATA_FILENAME = DATA_DIR+'staticData_quarterdeg.nc'
 START_YEAR = 850
 
 VARIABLES = ['urban','c3ann','c4ann','c3per','c4per','c3nfx','range','pastr','primf','secdf','primn','secdn']
-NEW_VARIABLES = ['urban','crops','range','pastr','forest','nonforest']
-NEW_VARIABLE_NAMES = ['Urban','Cropland','Rangeland','Pastureland','Forest','Nonforest']
+#Classes that the variables are aggregated to, swap in IPCC_CLASSES and IPCC_CLASS_NAMES for IPCC categories
+CLASSES = LUH_CLASSES
+NEW_VARIABLES = list(CLASSES.keys())
+NEW_VARIABLE_NAMES = LUH_CLASS_NAMES
+WEIGHTS = compile_weights(CLASSES,VARIABLES)
 META_VARIABLE = 'primf'
 
 OUTPUT_CSV = DATA_DIR + 'LUH_baseline_global_area.csv'
+#Rows of each block are saved here as the run goes and finished years are recorded in the manifest, see run_manifest.py
+CHECKPOINT_DIR = DATA_DIR + 'checkpoints/global_area/'
+CHECKPOINT_NPY = CHECKPOINT_DIR + 'LUH_baseline_global_area_{first}_{last}.npy'
+MANIFEST_FILENAME = CHECKPOINT_DIR + 'manifest.json'
+#If resume is set to true, years finished by an earlier run with the same inputs and settings are read from the checkpoints
+RESUME = True
 
 TARGET_YEARS = np.arange(850,2016)
+#Number of years read from the netCDF at once, 20 years of all variables is about 1 GB
+BLOCK_SIZE = 20
+#If vectorized is set to true, the areas for all years of a block are found with one weighted sum over the grid
+#   instead of one multiply and sum per year and variable
+VECTORIZED = True
 
 
 def GetnetCDFGlobalMetaData(in_filename):
@@ -67,13 +84,6 @@ def GetnetCDFInfobyName(in_filename,var_name):
         return NDV, xsize, ysize, GeoT, Projection
         
 
-def GetnetCDFDataByName(in_filename,var_name,index=0):
-    '''
-    Reads data for a specified year from netCDF
-    '''
-    with nc.Dataset(in_filename) as src:
-        return src.variables[var_name][index,:,:]
-    
 def GetStaticnetCDFDataByName(in_filename,var_name):
     '''
     Reads data for a specified year from netCDF
@@ -81,28 +91,12 @@ def GetStaticnetCDFDataByName(in_filename,var_name):
     with nc.Dataset(in_filename) as src:
         return src.variables[var_name][:,:]
         
-def GetNCDataByNewVariable(year_index,ysize,xsize,NDV,NC_FILENAME=NC_FILENAME,NEW_VARIABLES=NEW_VARIABLES):
+def GetNCDataByNewVariable(year_data,NDV,WEIGHTS=WEIGHTS):
     '''
     Aggregate original variables to desired ones
+    year_data holds one year (variables,lat,lon) or a block of years (years,variables,lat,lon) as read by LUHReader
     '''
-    #Get data for variables and aggregate when necessary
-    nc_data = np.zeros((len(NEW_VARIABLES),ysize,xsize))
-    for var_index, var in enumerate(NEW_VARIABLES):
-        #If not in the aggregating variables (crops, forest, nonforest) just keep variable
-        temp_variables = [var]
-        #Otherwise aggregate
-        if var == 'crops':
-            temp_variables = ['c3ann','c4ann','c3per','c4per','c3nfx']
-        elif var == 'forest':
-            temp_variables = ['primf','secdf']
-        elif var == 'nonforest':
-            temp_variables = ['primn','secdn']
-        #"Aggregating"
-        for temp_var in temp_variables:
-            nc_data[var_index] = nc_data[var_index]+ GetnetCDFDataByName(NC_FILENAME,temp_var,index=year_index).data
-        #Make NDV values uniform
-        nc_data[nc_data>=NDV] = NDV
-    return nc_data
+    return aggregate_classes(year_data,WEIGHTS,NDV)
         
 def getGlobalArea(var_data,cell_area,NDV):
     #Set no data value to 0
@@ -112,6 +106,16 @@ def getGlobalArea(var_data,cell_area,NDV):
     #Sum over values to get total coverage
     area_sum = np.sum(area_coverage)
     return area_coverage,area_sum
+
+def getGlobalAreaBlock(block_data,cell_area,NDV):
+    '''
+    Finds the global area of every variable for every year of a block at once
+    Returns an array with shape (years,variables)
+    '''
+    #Set no data value to 0
+    block_data[block_data>=NDV] = 0
+    #Weighted sum of the percent cover over the lat, lon axes with the grid cell area as weights
+    return np.tensordot(block_data,cell_area,axes=([-2,-1],[0,1]))
    
 #Get static data for LUH
 #Get netcdf metadata
@@ -128,27 +132,69 @@ cell_area = np.multiply(cell_area,1-ice_water_fraction)
 columns = ['Year']+NEW_VARIABLE_NAMES+['Total']
 df = pd.DataFrame(columns=columns)
 
-#Iterate through the years and calculate coverage sum
-for index,year in enumerate(TARGET_YEARS):
-    print(year)
-    #Re-index year 
-    year_index = year-START_YEAR
-    #Get data for new variables from netcdf
-    nc_data = GetNCDataByNewVariable(year_index,ysize,xsize,NDV,NC_FILENAME,NEW_VARIABLES)
-    #Create empty row to be appended to dataframe
-    df_row = np.zeros(len(NEW_VARIABLES)+2)
-    #First entry is the year
-    df_row[0] = year
-    total = 0
-    #For each variable find the area coverage
-    for var_index, var in enumerate(NEW_VARIABLES):
-        area_coverage,area_sum = getGlobalArea(nc_data[var_index,:,:],cell_area,NDV)
-        #added 1 to index to reflect first entry is year
-        df_row[var_index+1] = area_sum
-        total = total + area_sum
-    df_row[-1] = total
-    #Insert into dataframe
-    df.loc[index] = df_row
+#Open the netCDF once and read blocks of years for all variables
+reader = LUHReader(NC_FILENAME,VARIABLES,START_YEAR)
+if VECTORIZED:
+    #Years are only skipped if the netCDF, static data, and class settings are unchanged
+    manifest = RunManifest(MANIFEST_FILENAME,{'states':NC_FILENAME,'static':STATIC_DATA_FILENAME},
+        {'variables':VARIABLES,'classes':NEW_VARIABLE_NAMES,'weights':WEIGHTS.tolist()})
+    if RESUME:
+        years = manifest.remaining(TARGET_YEARS)
+        print('Skipping {num} finished years'.format(num=len(TARGET_YEARS)-len(years)))
+    else:
+        years = list(TARGET_YEARS)
+    if not os.path.exists(CHECKPOINT_DIR):
+        os.makedirs(CHECKPOINT_DIR)
+    #Masked cells of the static data do not count toward the area
+    cell_area = np.ma.filled(cell_area,0)
+    for block_years, block in reader.iter_blocks(years,BLOCK_SIZE):
+        print('{first}-{last}'.format(first=block_years[0],last=block_years[-1]))
+        #Get data for new variables for all years of the block
+        nc_data = GetNCDataByNewVariable(block,NDV)
+        area_sums = getGlobalAreaBlock(nc_data,cell_area,NDV)
+        #Each row is the year, the area of each variable, and the total
+        block_rows = np.zeros((len(block_years),len(NEW_VARIABLES)+2))
+        block_rows[:,0] = block_years
+        block_rows[:,1:-1] = area_sums
+        block_rows[:,-1] = np.sum(area_sums,axis=1)
+        #Save the rows of the block before marking its years as finished
+        checkpoint_filename = CHECKPOINT_NPY.format(first=block_years[0],last=block_years[-1])
+        np.save(checkpoint_filename,block_rows)
+        manifest.mark_done(block_years,dict((year,[checkpoint_filename]) for year in block_years))
+    #Gather the row of every year from the checkpoint it was recorded in
+    checkpoints = {}
+    rows = []
+    for year in TARGET_YEARS:
+        checkpoint_filename = manifest.get_outputs(year)[0]
+        if checkpoint_filename not in checkpoints:
+            checkpoints[checkpoint_filename] = np.load(checkpoint_filename)
+        block_rows = checkpoints[checkpoint_filename]
+        rows.append(block_rows[block_rows[:,0]==year][0])
+    df = pd.DataFrame(np.array(rows),columns=columns)
+else:
+    index = 0
+    #Iterate through the years and calculate coverage sum
+    for block_years, block in reader.iter_blocks(TARGET_YEARS,BLOCK_SIZE):
+        for block_index, year in enumerate(block_years):
+            print(year)
+            #Get data for new variables from the block
+            nc_data = GetNCDataByNewVariable(block[block_index],NDV)
+            #Create empty row to be appended to dataframe
+            df_row = np.zeros(len(NEW_VARIABLES)+2)
+            #First entry is the year
+            df_row[0] = year
+            total = 0
+            #For each variable find the area coverage
+            for var_index, var in enumerate(NEW_VARIABLES):
+                area_coverage,area_sum = getGlobalArea(nc_data[var_index,:,:],cell_area,NDV)
+                #added 1 to index to reflect first entry is year
+                df_row[var_index+1] = area_sum
+                total = total + area_sum
+            df_row[-1] = total
+            #Insert into dataframe
+            df.loc[index] = df_row
+            index = index+1
+reader.close()
 
 #Save to csv
 df.to_csv(OUTPUT_CSV,index=False)
\ No newline at end of file
@@ -0,0 +1,98 @@
+import numpy as np
+from scipy import sparse
+
+#The purpose of this code is to find the area of each land cover class in every ecoregion at once
+#A grid of ecoregion ids (see luh_get_ecoregion_mask.py) is turned into a zone index for each cell,
+#   then one weighted np.bincount sums class area into every ecoregion and class together
+#A sparse matrix of ecoregion weights can also sum every year of a block in one product
+
+
+class ZonalSums(object):
+    '''
+    Sums class area over zones given by a label grid
+    The zone index of each cell only depends on the labels, so it is built once and reused for every year
+    '''
+    def __init__(self,labels,obj_ids,cell_area,num_classes):
+        self.obj_ids = np.asarray(obj_ids).astype(int)
+        self.num_zones = len(self.obj_ids)
+        self.num_classes = num_classes
+        labels = np.asarray(labels).ravel()
+        cell_area = np.ma.filled(cell_area,0).ravel()
+        #Look up table from OBJECTID to row of the output, ids not asked for go to the extra last row
+        lookup = np.full(max(labels.max(),self.obj_ids.max())+1,self.num_zones)
+        lookup[self.obj_ids] = np.arange(self.num_zones)
+        zones = lookup[np.maximum(labels,0)]
+        zones[labels<0] = self.num_zones
+        #Only keep cells that fall in a zone and have area
+        self.cells = np.flatnonzero((zones<self.num_zones) & (cell_area!=0))
+        self.cell_area = cell_area[self.cells]
+        #One bin for each zone and class pair, bins are ordered zone first so the result reshapes to (zones,classes)
+        self.bins = (zones[self.cells][None,:]*num_classes+np.arange(num_classes)[:,None]).ravel()
+
+    def sums(self,nc_data,NDV):
+        '''
+        Finds the area of each class in each zone for one year
+        nc_data has shape (classes,lat,lon), returns an array with shape (zones,classes)
+        '''
+        var_data = nc_data.reshape(self.num_classes,-1)[:,self.cells]
+        #Set no data value to 0 and multiply percent cover by grid cell area
+        weights = np.where(var_data>=NDV,0,var_data)*self.cell_area
+        area_sums = np.bincount(self.bins,weights=weights.ravel(),minlength=self.num_zones*self.num_classes)
+        return area_sums.reshape(self.num_zones,self.num_classes)
+
+
+class SparseZonalSums(object):
+    '''
+    Sums class area over zones with a sparse matrix of weights (zones x land cells)
+    Each weight is the fraction of the cell in the zone times the terrestrial area of the cell,
+    so cells shared by several zones are split between them instead of counted twice
+    '''
+    def __init__(self,zone_rows,cells,fractions,obj_ids,cell_area):
+        self.obj_ids = np.asarray(obj_ids).astype(int)
+        self.num_zones = len(self.obj_ids)
+        cell_area = np.ma.filled(cell_area,0).ravel()
+        cells = np.asarray(cells)
+        weights = np.asarray(fractions,dtype=np.float64)*cell_area[cells]
+        keep = weights!=0
+        #Only land cells with a weight become columns of the matrix
+        self.cells, columns = np.unique(cells[keep],return_inverse=True)
+        self.weights = sparse.csr_matrix((weights[keep],(np.asarray(zone_rows)[keep],columns)),shape=(self.num_zones,len(self.cells)))
+
+    @classmethod
+    def from_labels(cls,labels,obj_ids,cell_area):
+        '''
+        Builds the weights from a grid of ecoregion ids, every cell is entirely in the zone of its label
+        '''
+        obj_ids = np.asarray(obj_ids).astype(int)
+        labels = np.asarray(labels).ravel()
+        lookup = np.full(max(labels.max(),obj_ids.max())+1,-1)
+        lookup[obj_ids] = np.arange(len(obj_ids))
+        zones = np.where(labels>=0,lookup[np.maximum(labels,0)],-1)
+        cells = np.flatnonzero(zones>=0)
+        return cls(zones[cells],cells,np.ones(len(cells)),obj_ids,cell_area)
+
+    @classmethod
+    def from_fractions(cls,entry_ids,entry_cells,entry_fractions,obj_ids,cell_area):
+        '''
+        Builds the weights from (OBJECTID, flat cell index, fraction of cell) entries
+        Entries for ids that are not in obj_ids are dropped
+        '''
+        obj_ids = np.asarray(obj_ids).astype(int)
+        entry_ids = np.asarray(entry_ids).astype(int)
+        lookup = np.full(max(entry_ids.max(),obj_ids.max())+1,-1)
+        lookup[obj_ids] = np.arange(len(obj_ids))
+        zones = lookup[entry_ids]
+        keep = zones>=0
+        return cls(zones[keep],np.asarray(entry_cells)[keep],np.asarray(entry_fractions)[keep],obj_ids,cell_area)
+
+    def block_sums(self,block_data,NDV):
+        '''
+        Finds the area of each class in each zone for every year of a block with one sparse-dense product
+        block_data has shape (years,classes,lat,lon), returns an array with shape (years,zones,classes)
+        '''
+        num_years, num_classes = block_data.shape[:2]
+        flat = block_data.reshape(num_years*num_classes,-1)[:,self.cells]
+        #Set no data value to 0
+        flat = np.where(flat>=NDV,0,flat)
+        area_sums = self.weights.dot(flat.T)
+        return np.asarray(area_sums).reshape(self.num_zones,num_years,num_classes).transpose(1,0,2)
@@ -0,0 +1,110 @@
+import glob
+import hashlib
+import os
+import numpy as np
+import netCDF4 as nc
+import geopandas as gpd
+from rasterio import features
+from rasterio.transform import from_origin
+from shapely.geometry import mapping
+from ecoregion_fractions import get_fractions
+from mask_store import write_mask_store, MaskStore
+
+#The purpose of this code is to build ecoregion masks once per grid and shapefile and reuse them
+#Masks are cached under a key made from a hash of the grid (latitude and longitude vectors and geotransform)
+#   and a hash of the shapefile contents, so any dataset on the same grid (LUH baseline, LUH projections) shares them
+#   and a changed grid or shapefile gets new masks instead of stale ones
+
+#Bump when the way masks are built changes so older cached masks are not used
+CACHE_VERSION = 1
+#Value of cells that are not in any ecoregion
+NO_ECOREGION = 0
+
+
+def get_lat_lon(netcdf_name):
+    '''
+    Function to get latitude and longitude vectors from netcdf
+    '''
+    with nc.Dataset(netcdf_name) as src:
+        lat = np.array(src.variables['lat'][:])
+        lon = np.array(src.variables['lon'][:])
+    return lat, lon
+
+def get_transform(lat,lon):
+    '''
+    Function to get the north up transform of a grid from its cell center vectors
+    '''
+    xres = float(abs(lon[1]-lon[0]))
+    yres = float(abs(lat[1]-lat[0]))
+    return from_origin(float(lon.min())-xres/2.0,float(lat.max())+yres/2.0,xres,yres)
+
+def get_label_raster(shapefile,lat,lon,skip_ids=()):
+    '''
+    Function to burn every ecoregion into one int16 grid of OBJECTIDs on the grid
+    A cell gets an ecoregion when the cell center is inside the polygon (GDAL's default rule, all_touched=False)
+    Where polygons overlap the ecoregion that comes later in the shapefile wins
+    '''
+    shapes = ((mapping(row['geometry']),int(row['OBJECTID'])) for index,row in shapefile.iterrows() if row['geometry'] is not None and int(row['OBJECTID']) not in skip_ids)
+    labels = features.rasterize(shapes,out_shape=(len(lat),len(lon)),transform=get_transform(lat,lon),fill=NO_ECOREGION,all_touched=False,dtype='int16')
+    #Flip to match the netcdf if latitude increases with row
+    if lat[0] < lat[-1]:
+        labels = labels[::-1,:]
+    return labels
+
+def grid_key(lat,lon):
+    '''
+    Function to hash a grid definition
+    '''
+    sha = hashlib.sha256()
+    sha.update(np.ascontiguousarray(lat,dtype=np.float64).tobytes())
+    sha.update(np.ascontiguousarray(lon,dtype=np.float64).tobytes())
+    sha.update(repr(tuple(get_transform(lat,lon))).encode('utf-8'))
+    return sha.hexdigest()
+
+def shapefile_key(shapefile_name):
+    '''
+    Function to hash the contents of a shapefile and its sidecar files (.dbf, .shx, .prj, ...)
+    '''
+    sha = hashlib.sha256()
+    stem = os.path.splitext(shapefile_name)[0]
+    for filename in sorted(glob.glob(glob.escape(stem)+'.*')):
+        sha.update(os.path.basename(filename).encode('utf-8'))
+        with open(filename,'rb') as src:
+            for chunk in iter(lambda: src.read(1<<20),b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+def get_cache_filename(cache_dir,lat,lon,shapefile_name,rule,skip_ids=(207,)):
+    '''
+    Function to get the cache file for a grid, shapefile, and rule ('center' or 'fraction')
+    '''
+    sha = hashlib.sha256()
+    for part in [str(CACHE_VERSION),rule,grid_key(lat,lon),shapefile_key(shapefile_name),repr(sorted(skip_ids))]:
+        sha.update(part.encode('utf-8'))
+    return os.path.join(cache_dir,'ecoregions_{rule}_{key}.bin'.format(rule=rule,key=sha.hexdigest()[:20]))
+
+def get_mask_store(lat,lon,shapefile_name,rule='fraction',cache_dir='ecoregions_mask/cache/',num_processes=None,skip_ids=(207,)):
+    '''
+    Function to get ecoregion masks for a grid from the cache, building them if they are not there
+    rule 'center' puts a cell in the ecoregion its center falls in, 'fraction' weights cells by the area covered
+    '''
+    cache_filename = get_cache_filename(cache_dir,lat,lon,shapefile_name,rule,skip_ids)
+    if not os.path.exists(cache_filename):
+        print('Building {rule} masks: {fn}'.format(rule=rule,fn=cache_filename))
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        shapefile = gpd.read_file(shapefile_name)
+        if rule == 'center':
+            labels = get_label_raster(shapefile,lat,lon,skip_ids)
+            entry_cells = np.flatnonzero(labels!=NO_ECOREGION)
+            entry_ids = labels.ravel()[entry_cells]
+            entry_weights = np.ones(len(entry_cells))
+        elif rule == 'fraction':
+            entry_ids, entry_cells, entry_weights = get_fractions(shapefile,lat,lon,num_processes,skip_ids)
+        else:
+            raise ValueError('Unknown mask rule: {rule}'.format(rule=rule))
+        #Write to a temporary file first so an interrupted build is never picked up
+        temp_filename = cache_filename+'.{pid}.tmp'.format(pid=os.getpid())
+        write_mask_store(temp_filename,entry_ids,entry_cells,entry_weights,(len(lat),len(lon)),{'rule':rule,'shapefile':shapefile_name})
+        os.replace(temp_filename,cache_filename)
+    return MaskStore(cache_filename)
@@ -0,0 +1,117 @@
+import json
+import numpy as np
+
+#The purpose of this code is to store every ecoregion mask in one packed file instead of one dense .npy per ecoregion
+#Each mask is kept as its bounding box window plus the flat cell indices and weights of the cells inside it
+#An OBJECTID index gives the offsets of each mask, and the arrays are memory-mapped so reading a mask only touches its cells
+
+#File layout: 8 byte header length, JSON header, then each array at a 64 byte aligned offset
+HEADER_ALIGN = 64
+
+
+def _align(offset):
+    '''
+    Rounds an offset up to the next aligned position
+    '''
+    return (offset+HEADER_ALIGN-1)//HEADER_ALIGN*HEADER_ALIGN
+
+def write_mask_store(filename,entry_ids,entry_cells,entry_weights,shape,metadata=None):
+    '''
+    Function to pack (OBJECTID, flat cell index, weight) entries for a grid of the given shape into one file
+    '''
+    entry_ids = np.asarray(entry_ids).astype(np.int64)
+    #Group entries by ecoregion, keeping cells in order within each one
+    order = np.lexsort((np.asarray(entry_cells),entry_ids))
+    entry_ids = entry_ids[order]
+    cells = np.asarray(entry_cells)[order].astype(np.int32)
+    weights = np.asarray(entry_weights)[order].astype(np.float32)
+    ids, starts = np.unique(entry_ids,return_index=True)
+    offsets = np.append(starts,len(entry_ids)).astype(np.int64)
+    #Bounding box window of each mask as first row, last row + 1, first column, last column + 1
+    rows = cells//shape[1]
+    cols = cells%shape[1]
+    windows = np.zeros((len(ids),4),dtype=np.int32)
+    for i in np.arange(len(ids)):
+        start, end = offsets[i], offsets[i+1]
+        windows[i] = [rows[start:end].min(),rows[start:end].max()+1,cols[start:end].min(),cols[start:end].max()+1]
+    arrays = [('ids',ids.astype(np.int32)),('offsets',offsets),('windows',windows),('cells',cells),('weights',weights)]
+    #Work out where each array goes, leaving room for the offsets to grow the header
+    header = {'shape':list(shape),'metadata':metadata or {},'arrays':{}}
+    for name, array in arrays:
+        header['arrays'][name] = {'dtype':array.dtype.str,'shape':list(array.shape),'offset':0}
+    offset = _align(8+len(json.dumps(header).encode('utf-8'))+256)
+    for name, array in arrays:
+        header['arrays'][name]['offset'] = offset
+        offset = _align(offset+array.nbytes)
+    header_bytes = json.dumps(header).encode('utf-8')
+    with open(filename,'wb') as dst:
+        dst.write(np.int64(len(header_bytes)).tobytes())
+        dst.write(header_bytes)
+        for name, array in arrays:
+            dst.seek(header['arrays'][name]['offset'])
+            dst.write(np.ascontiguousarray(array).tobytes())
+    return filename
+
+
+class MaskStore(object):
+    '''
+    Reads masks from a file written by write_mask_store, arrays are memory-mapped and only read when used
+    '''
+    def __init__(self,filename):
+        self.filename = filename
+        with open(filename,'rb') as src:
+            header_length = int(np.frombuffer(src.read(8),dtype=np.int64)[0])
+            header = json.loads(src.read(header_length).decode('utf-8'))
+        self.shape = tuple(header['shape'])
+        self.metadata = header['metadata']
+        for name, info in header['arrays'].items():
+            if np.prod(info['shape']) == 0:
+                array = np.zeros(info['shape'],dtype=info['dtype'])
+            else:
+                array = np.memmap(filename,dtype=info['dtype'],mode='r',offset=info['offset'],shape=tuple(info['shape']))
+            setattr(self,name,array)
+        #OBJECTID to position in the index
+        self.positions = dict((int(obj_id),i) for i,obj_id in enumerate(self.ids))
+
+    def __contains__(self,obj_id):
+        return int(obj_id) in self.positions
+
+    def get(self,obj_id):
+        '''
+        Returns the flat cell indices and weights of one mask, empty if the ecoregion has no cells
+        '''
+        if int(obj_id) not in self.positions:
+            return np.zeros(0,dtype=np.int32), np.zeros(0,dtype=np.float32)
+        i = self.positions[int(obj_id)]
+        return self.cells[self.offsets[i]:self.offsets[i+1]], self.weights[self.offsets[i]:self.offsets[i+1]]
+
+    def get_window(self,obj_id):
+        '''
+        Returns the bounding box window of one mask as (first row, last row + 1, first column, last column + 1)
+        '''
+        return tuple(int(value) for value in self.windows[self.positions[int(obj_id)]])
+
+    def get_mask(self,obj_id):
+        '''
+        Returns one mask as a dense float grid, matching the old LUH_ecoregions_mask_{id}.npy files
+        '''
+        mask = np.zeros(self.shape[0]*self.shape[1])
+        cells, weights = self.get(obj_id)
+        mask[cells] = weights
+        return mask.reshape(self.shape)
+
+    def entries(self):
+        '''
+        Returns every mask as flat arrays of OBJECTID, cell index and weight
+        '''
+        counts = np.diff(self.offsets)
+        return np.repeat(np.asarray(self.ids),counts), np.asarray(self.cells), np.asarray(self.weights)
+
+    def get_labels(self,fill=0):
+        '''
+        Returns a grid of OBJECTIDs, only meaningful when every cell is in at most one mask (the 'center' rule)
+        '''
+        labels = np.full(self.shape[0]*self.shape[1],fill,dtype=np.int16)
+        entry_ids, cells, weights = self.entries()
+        labels[cells] = entry_ids
+        return labels.reshape(self.shape)
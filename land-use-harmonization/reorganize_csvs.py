@@ -1,12 +1,24 @@
 import pandas as pd
 import os
 import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from area_store import read_wide, read_attributes
 
 folder_conv = '/Users/kristine/WRI/NationalGeographic/Phase1/LUH_historical_baseline_{level}_area'
 fname_conv = 'luh_baseline_{level}_area_{year}.csv'
 out_fname_conv = 'luh_baseline_{level}_{crop}_{type}.csv'
 out_folder_conv = ''
 
+#Input format, 'parquet' reads the columnar store written by luh_get_ecoregion_coverage.py and luh_aggregate_biomes.py
+#   (see area_store.py), 'csv' the per-year csvs
+#The store path is made absolute because the script changes into the output folder of each level
+FORMAT = 'parquet'
+STORE_DIR = os.path.abspath('LUH_data/data/store/')
+ATTRIBUTES_TABLE = 'ecoregion_attributes'
+#Table, key columns, and matching column of the attributes table of each level in the store
+STORE_TABLES = {'biome':('luh_baseline_biome_area',['Biome'],'BIOME_NAME'),'ecoregion':('luh_baseline_ecoregion_area',['OBJECTID'],'OBJECTID')}
+
 
 levels = ['biome','ecoregion']
 categories = ['cropland','pasture','agriculture','forest']
@@ -14,76 +26,153 @@ years = np.arange(1700,2020,10)
 
 
 #years = np.arange(1800,1801)
+#years = np.arange(850,2016)
+
+#If reshape is set to true, the csvs of a level are read in parallel into one frame and the eight tables come from one pivot
+#   instead of growing each table one row at a time, which is fast enough for every year from 850 to 2015
+RESHAPE = True
+#Number of csvs read at once
+NUM_THREADS = 8
 
 
+def readStore(level,years):
+    '''
+    Reads the years of a level from the store in the wide format of the per-year csvs
+    The ecoregion names are joined from the attributes table
+    '''
+    table, id_columns, attribute_column = STORE_TABLES[level]
+    attributes = read_attributes(STORE_DIR,ATTRIBUTES_TABLE)
+    df = read_wide(STORE_DIR,table,id_columns,years,attributes=attributes if level == 'ecoregion' else None)
+    #read_wide sorts the rows by key, put them back in the order of the attributes table (the shapefile) like the csvs
+    keys = attributes[attribute_column].drop_duplicates().values
+    df['Order'] = df[id_columns[0]].map(dict(zip(keys,range(len(keys)))))
+    return df.sort_values(['Year','Order'],kind='stable').drop(columns=['Order']).reset_index(drop=True)
 
+def readLevel(level,years):
+    '''
+    Reads the csvs of every year of a level in parallel into one frame, or every year at once from the store
+    Adds the year and the position of each row in its csv, rows are matched across years by position like the row by row tables
+    '''
+    if FORMAT == 'parquet':
+        #Rows of the store are in the same order in every year, so the position matches the same key across years
+        df = readStore(level,years)
+        df['Position'] = df.groupby('Year').cumcount().values
+        return df
+    def readYear(year):
+        df = pd.read_csv(fname_conv.format(level=level,year=year),header=0)
+        df['Year'] = year
+        df['Position'] = np.arange(len(df))
+        return df
+    with ThreadPoolExecutor(NUM_THREADS) as executor:
+        frames = list(executor.map(readYear,years))
+    return pd.concat(frames,ignore_index=True)
 
-for level in levels:
-    os.chdir(folder_conv.format(level=level))
-    fname = fname_conv.format(level=level, year=years[0])
-    df_format = pd.read_csv(fname,header=0)
-    if level == 'ecoregion':
-        columns = df_format['ECO_NAME'].values
-    elif level == 'biome':
-        columns = df_format['Biome'].values
-    df_crop_area = pd.DataFrame(columns=columns)
-    df_pasture_area = pd.DataFrame(columns=columns)
-    df_agriculture_area = pd.DataFrame(columns=columns)
-    df_forest_area = pd.DataFrame(columns=columns)
-    df_crop_percent = pd.DataFrame(columns=columns)
-    df_pasture_percent = pd.DataFrame(columns=columns)
-    df_agriculture_percent = pd.DataFrame(columns=columns)
-    df_forest_percent = pd.DataFrame(columns=columns)
-    for year in years:
-        fname = fname_conv.format(level=level, year=year)
-        df = pd.read_csv(fname,header=0)
+if RESHAPE:
+    for level in levels:
+        os.chdir(folder_conv.format(level=level))
+        df = readLevel(level,years)
+        #Column names come from the first year
+        if level == 'ecoregion':
+            columns = df.loc[df['Year']==years[0],'ECO_NAME'].values
+        elif level == 'biome':
+            columns = df.loc[df['Year']==years[0],'Biome'].values
         cropland = df['Cropland'].values
         pasture = df['Rangeland'].values + df['Pastureland'].values
         forest = df['Forest'].values
         agriculture = cropland + pasture
         total = df['Total'].values
-        cropland_percent = np.divide(cropland,total, out=np.zeros_like(cropland), where=total!=0)
-        pasture_percent = np.divide(pasture,total, out=np.zeros_like(pasture), where=total!=0)
-        agriculture_percent = np.divide(agriculture,total, out=np.zeros_like(agriculture), where=total!=0)
-        forest_percent = np.divide(forest,total, out=np.zeros_like(forest), where=total!=0)
-        print(len(df_crop_area))
-        if len(df_crop_area) == 0:
-            next_index = 0
+        #Area and percent of each category for every row of every year, named (crop, type) like the output files
+        measures = OrderedDict()
+        measures[('crop','area')] = cropland
+        measures[('pasture','area')] = pasture
+        measures[('agriculture','area')] = agriculture
+        measures[('forest','area')] = forest
+        measures[('crop','percent')] = np.divide(cropland,total, out=np.zeros_like(cropland), where=total!=0)
+        measures[('pasture','percent')] = np.divide(pasture,total, out=np.zeros_like(pasture), where=total!=0)
+        measures[('agriculture','percent')] = np.divide(agriculture,total, out=np.zeros_like(agriculture), where=total!=0)
+        measures[('forest','percent')] = np.divide(forest,total, out=np.zeros_like(forest), where=total!=0)
+        values_df = pd.DataFrame(dict(('{crop}_{type}'.format(crop=crop,type=type),values) for (crop,type),values in measures.items()))
+        values_df['Year'] = df['Year'].values
+        values_df['Position'] = df['Position'].values
+        #One pivot gives every table, columns are (measure, position)
+        wide = values_df.pivot(index='Year',columns='Position')
+        for crop, type in measures:
+            out_df = wide['{crop}_{type}'.format(crop=crop,type=type)].reset_index()
+            out_df.columns = ['Year']+list(columns)
+            out_df.to_csv(out_fname_conv.format(level=level,crop=crop,type=type),encoding='utf-8',index=False)
+else:
+    for level in levels:
+        os.chdir(folder_conv.format(level=level))
+        if FORMAT == 'parquet':
+            df_format = readStore(level,[years[0]])
         else:
-            next_index = df_crop_area.index[-1] + 1
-        df_crop_area.at[next_index] = cropland
-        df_pasture_area.at[next_index] = pasture
-        df_agriculture_area.at[next_index] = agriculture
-        df_forest_area.at[next_index] = forest
-        df_crop_percent.at[next_index] = cropland_percent
-        df_pasture_percent.at[next_index] = pasture_percent
-        df_agriculture_percent.at[next_index] = agriculture_percent
-        df_forest_percent.at[next_index] = forest_percent
-    df_crop_area['Year'] = years
-    df_pasture_area['Year'] = years
-    df_agriculture_area['Year'] = years
-    df_forest_area['Year'] = years
-    df_crop_percent['Year'] = years
-    df_pasture_percent['Year'] = years
-    df_agriculture_percent['Year'] = years
-    df_forest_percent['Year'] = years
+            fname = fname_conv.format(level=level, year=years[0])
+            df_format = pd.read_csv(fname,header=0)
+        if level == 'ecoregion':
+            columns = df_format['ECO_NAME'].values
+        elif level == 'biome':
+            columns = df_format['Biome'].values
+        df_crop_area = pd.DataFrame(columns=columns)
+        df_pasture_area = pd.DataFrame(columns=columns)
+        df_agriculture_area = pd.DataFrame(columns=columns)
+        df_forest_area = pd.DataFrame(columns=columns)
+        df_crop_percent = pd.DataFrame(columns=columns)
+        df_pasture_percent = pd.DataFrame(columns=columns)
+        df_agriculture_percent = pd.DataFrame(columns=columns)
+        df_forest_percent = pd.DataFrame(columns=columns)
+        for year in years:
+            if FORMAT == 'parquet':
+                df = readStore(level,[year])
+            else:
+                fname = fname_conv.format(level=level, year=year)
+                df = pd.read_csv(fname,header=0)
+            cropland = df['Cropland'].values
+            pasture = df['Rangeland'].values + df['Pastureland'].values
+            forest = df['Forest'].values
+            agriculture = cropland + pasture
+            total = df['Total'].values
+            cropland_percent = np.divide(cropland,total, out=np.zeros_like(cropland), where=total!=0)
+            pasture_percent = np.divide(pasture,total, out=np.zeros_like(pasture), where=total!=0)
+            agriculture_percent = np.divide(agriculture,total, out=np.zeros_like(agriculture), where=total!=0)
+            forest_percent = np.divide(forest,total, out=np.zeros_like(forest), where=total!=0)
+            print(len(df_crop_area))
+            if len(df_crop_area) == 0:
+                next_index = 0
+            else:
+                next_index = df_crop_area.index[-1] + 1
+            df_crop_area.at[next_index] = cropland
+            df_pasture_area.at[next_index] = pasture
+            df_agriculture_area.at[next_index] = agriculture
+            df_forest_area.at[next_index] = forest
+            df_crop_percent.at[next_index] = cropland_percent
+            df_pasture_percent.at[next_index] = pasture_percent
+            df_agriculture_percent.at[next_index] = agriculture_percent
+            df_forest_percent.at[next_index] = forest_percent
+        df_crop_area['Year'] = years
+        df_pasture_area['Year'] = years
+        df_agriculture_area['Year'] = years
+        df_forest_area['Year'] = years
+        df_crop_percent['Year'] = years
+        df_pasture_percent['Year'] = years
+        df_agriculture_percent['Year'] = years
+        df_forest_percent['Year'] = years
     
-    cols = df_crop_area.columns.tolist()
-    cols = cols[-1:] + cols[:-1]
-    df_crop_area = df_crop_area[cols]
-    df_pasture_area = df_pasture_area[cols]
-    df_agriculture_area = df_agriculture_area[cols]
-    df_forest_area = df_forest_area[cols]
-    df_crop_percent = df_crop_percent[cols]
-    df_pasture_percent = df_pasture_percent[cols]  
-    df_agriculture_percent = df_agriculture_percent[cols]
-    df_forest_percent = df_forest_percent[cols]   
+        cols = df_crop_area.columns.tolist()
+        cols = cols[-1:] + cols[:-1]
+        df_crop_area = df_crop_area[cols]
+        df_pasture_area = df_pasture_area[cols]
+        df_agriculture_area = df_agriculture_area[cols]
+        df_forest_area = df_forest_area[cols]
+        df_crop_percent = df_crop_percent[cols]
+        df_pasture_percent = df_pasture_percent[cols]  
+        df_agriculture_percent = df_agriculture_percent[cols]
+        df_forest_percent = df_forest_percent[cols]   
     
-    df_crop_area.to_csv(out_fname_conv.format(level=level,crop='crop',type='area'),encoding='utf-8',index=False)
-    df_pasture_area.to_csv(out_fname_conv.format(level=level,crop='pasture',type='area'),encoding='utf-8',index=False)
-    df_agriculture_area.to_csv(out_fname_conv.format(level=level,crop='agriculture',type='area'),encoding='utf-8',index=False)
-    df_forest_area.to_csv(out_fname_conv.format(level=level,crop='forest',type='area'),encoding='utf-8',index=False)
-    df_crop_percent.to_csv(out_fname_conv.format(level=level,crop='crop',type='percent'),encoding='utf-8',index=False)
-    df_pasture_percent.to_csv(out_fname_conv.format(level=level,crop='pasture',type='percent'),encoding='utf-8',index=False)
-    df_agriculture_percent.to_csv(out_fname_conv.format(level=level,crop='agriculture',type='percent'),encoding='utf-8',index=False)
-    df_forest_percent.to_csv(out_fname_conv.format(level=level,crop='forest',type='percent'),encoding='utf-8',index=False)
+        df_crop_area.to_csv(out_fname_conv.format(level=level,crop='crop',type='area'),encoding='utf-8',index=False)
+        df_pasture_area.to_csv(out_fname_conv.format(level=level,crop='pasture',type='area'),encoding='utf-8',index=False)
+        df_agriculture_area.to_csv(out_fname_conv.format(level=level,crop='agriculture',type='area'),encoding='utf-8',index=False)
+        df_forest_area.to_csv(out_fname_conv.format(level=level,crop='forest',type='area'),encoding='utf-8',index=False)
+        df_crop_percent.to_csv(out_fname_conv.format(level=level,crop='crop',type='percent'),encoding='utf-8',index=False)
+        df_pasture_percent.to_csv(out_fname_conv.format(level=level,crop='pasture',type='percent'),encoding='utf-8',index=False)
+        df_agriculture_percent.to_csv(out_fname_conv.format(level=level,crop='agriculture',type='percent'),encoding='utf-8',index=False)
+        df_forest_percent.to_csv(out_fname_conv.format(level=level,crop='forest',type='percent'),encoding='utf-8',index=False)
@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+
+#The purpose of this code is to let long runs over many years be killed and restarted without starting over
+#A JSON manifest records each finished year with the files it wrote and a key made from hashes of the input files
+#   and the run settings, a restart skips years whose key still matches and whose outputs are unchanged on disk
+#Hashes of large inputs are reused while their size and modification time stay the same, so a restart does not
+#   reread the whole netCDF, outputs are compared the same way and only hashed again when asked to verify them
+
+
+def file_sha256(filename):
+    '''
+    Function to hash the contents of a file
+    '''
+    sha = hashlib.sha256()
+    with open(filename,'rb') as src:
+        for chunk in iter(lambda: src.read(1<<20),b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def file_stat(filename):
+    '''
+    Function to get the size and modification time of a file
+    '''
+    stat = os.stat(filename)
+    return {'size':stat.st_size,'mtime':stat.st_mtime}
+
+
+class RunManifest(object):
+    '''
+    Records which years of a run are finished, for the inputs and settings the run was started with
+    '''
+    def __init__(self,filename,input_files,config=None):
+        self.filename = filename
+        self.data = {'inputs':{},'years':{}}
+        if os.path.exists(filename):
+            with open(filename) as src:
+                self.data = json.load(src)
+        #Hash the inputs, reusing the last hash of a file that has not been touched since
+        old_inputs = self.data.get('inputs',{})
+        inputs = {}
+        for name in sorted(input_files):
+            path = input_files[name]
+            stat = file_stat(path)
+            old = old_inputs.get(name)
+            if old is not None and old['path'] == path and old['size'] == stat['size'] and old['mtime'] == stat['mtime']:
+                sha = old['sha256']
+            else:
+                print('Hashing input: {fn}'.format(fn=path))
+                sha = file_sha256(path)
+            inputs[name] = {'path':path,'size':stat['size'],'mtime':stat['mtime'],'sha256':sha}
+        self.data['inputs'] = inputs
+        self.data['config'] = config or {}
+        sha = hashlib.sha256()
+        sha.update(json.dumps([(name,inputs[name]['sha256']) for name in sorted(inputs)]).encode('utf-8'))
+        sha.update(json.dumps(self.data['config'],sort_keys=True).encode('utf-8'))
+        self.key = sha.hexdigest()
+
+    def is_done(self,year,verify=False,hashes=None):
+        '''
+        Checks that a year was finished with the current inputs and settings and that its outputs are still there unchanged
+        Outputs are compared by size and modification time, if verify is set to true their contents are hashed again
+        hashes (path: sha256) can be shared between calls so an output written for many years is hashed once
+        '''
+        entry = self.data['years'].get(str(int(year)))
+        if entry is None or entry['key'] != self.key:
+            return False
+        if hashes is None:
+            hashes = {}
+        for output in entry['outputs']:
+            path = output['path']
+            if not os.path.exists(path) or os.path.getsize(path) != output['size']:
+                return False
+            if not verify and output.get('mtime') == os.path.getmtime(path):
+                continue
+            #Outputs that were touched, or recorded without a modification time, are hashed
+            if path not in hashes:
+                hashes[path] = file_sha256(path)
+            if hashes[path] != output['sha256']:
+                return False
+        return True
+
+    def remaining(self,years,verify=False):
+        '''
+        Returns the years that still have to be run, if verify is set to true the outputs are hashed again (once each)
+        '''
+        hashes = {}
+        return [int(year) for year in years if not self.is_done(year,verify,hashes)]
+
+    def get_outputs(self,year):
+        '''
+        Returns the files recorded for a finished year
+        '''
+        return [output['path'] for output in self.data['years'][str(int(year))]['outputs']]
+
+    def mark_done(self,years,outputs):
+        '''
+        Records years as finished along with the files they wrote and saves the manifest
+        outputs maps each year to a list of files
+        '''
+        hashes = {}
+        for year in years:
+            entry = []
+            for path in outputs[year]:
+                if path not in hashes:
+                    hashes[path] = file_sha256(path)
+                entry.append({'path':path,'size':os.path.getsize(path),'mtime':os.path.getmtime(path),'sha256':hashes[path]})
+            self.data['years'][str(int(year))] = {'key':self.key,'outputs':entry}
+        self.save()
+
+    def save(self):
+        '''
+        Writes the manifest to a temporary file and moves it into place so a kill while saving does not lose it
+        '''
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        temp_filename = self.filename+'.{pid}.tmp'.format(pid=os.getpid())
+        with open(temp_filename,'w') as dst:
+            json.dump(self.data,dst,indent=1,sort_keys=True)
+        os.replace(temp_filename,self.filename)